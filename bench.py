@@ -0,0 +1,521 @@
+"""
+Офлайн-бенчмарк бота: без Telegram и без YouTube.
+
+- поддельная сессия Bot API (aiogram BaseSession) отвечает на запросы бота
+  и засекает, когда пользователь увидел меню и когда получил ссылку/файл;
+- локальный "видеохостинг" на aiohttp: обычный MP4, HLS с фрагментами,
+  медленная отдача с ограничением скорости; ролик настоящий (ffmpeg,
+  testsrc + синус), так что MP3, сжатие и обложки проходят весь путь;
+- заглушка-экстрактор yt-dlp для ссылок https://bench.local/<kind>/<id>.
+
+Апдейты идут через настоящий dp.feed_update, т.е. работают реальные
+handle_url / handle_callback / download_media, очередь и пул воркеров.
+
+Пример:
+    python bench.py --users 8 --rounds 3 --kind mixed --mode safe
+    DOWNLOAD_WORKERS=6 python bench.py --users 16 --kind hls --json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import subprocess
+import logging
+import asyncio
+import argparse
+import datetime
+import resource
+import statistics
+import tempfile
+from pathlib import Path
+
+from aiohttp import web
+
+# окружение до импорта бота: он читает его при загрузке модуля
+BENCH_DIR = Path(tempfile.mkdtemp(prefix="ytd_bench_"))
+FIRST_USER_ID = 100000
+MAX_USERS = 1000
+
+os.environ["BOT_TOKEN"] = "123456:BENCHMARK-TOKEN"
+os.environ["DOWNLOAD_BASE_URL"] = "http://bench.local/files"
+os.environ["DOWNLOAD_PATH"] = str(BENCH_DIR / "download")
+os.environ["COOKIES_PATH"] = str(BENCH_DIR / "cookies")
+os.environ["DATA_PATH"] = str(BENCH_DIR / "data")
+os.environ["ALLOWED_USERS"] = ",".join(str(FIRST_USER_ID + i) for i in range(MAX_USERS))
+os.environ.setdefault("PROGRESS_EDIT_INTERVAL", "1")
+
+import yt_dlp  # noqa: E402
+from yt_dlp.extractor.common import InfoExtractor  # noqa: E402
+from aiogram import types  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+
+import ytd_bot  # noqa: E402
+
+
+# ========================== #
+# 🎞 Локальный видеохостинг
+# ========================== #
+
+class MediaOrigin:
+    """
+    /progressive/<id>.mp4 — один файл, поддерживает Range (.m4a — звук,
+    .jpg — обложка); /hls/<id>/index.m3u8 и /hls/<id>/seg<N>.ts — HLS того
+    же ролика; /slow/<id>.<ext> — то же, что progressive, но с ограничением
+    скорости. Ролик кодируется при старте под размер size_mb.
+    """
+
+    DURATION = 60
+
+    def __init__(self, *, size_mb: int, fragments: int, slow_rate_kb: int):
+        self.root = BENCH_DIR / "origin"
+        self.hls = self.root / "hls"
+        self.hls.mkdir(parents=True, exist_ok=True)
+        self.video = self.root / "video.mp4"
+        self.audio = self.root / "audio.m4a"
+        self.thumb = self.root / "thumb.jpg"
+        self.fragments = fragments
+        self.slow_rate = slow_rate_kb * 1024
+        self._render(size_mb * 1024 * 1024)
+        self.base_url = ""
+        self._runner: web.AppRunner | None = None
+
+    def _render(self, size: int):
+        ffmpeg = ytd_bot.transcoder.ffmpeg
+        if not shutil.which(ffmpeg):
+            raise SystemExit("Для бенчмарка нужен ffmpeg: он кодирует тестовый ролик")
+        seconds = self.DURATION
+        segment = seconds / self.fragments
+        audio_kbps = 128
+        video_kbps = max(100, size * 8 // seconds // 1000 - audio_kbps)
+        source = [
+            "-f", "lavfi", "-i", f"testsrc2=size=640x360:rate=25:duration={seconds}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+        ]
+        run = [ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-y"]
+        subprocess.run(run + source + [
+            "-c:v", "libx264", "-preset", "ultrafast", "-b:v", f"{video_kbps}k",
+            # ключевые кадры на границах HLS-фрагментов: нарезка без перекодирования
+            "-force_key_frames", f"expr:gte(t,n_forced*{segment})",
+            "-c:a", "aac", "-b:a", f"{audio_kbps}k", "-movflags", "+faststart", str(self.video),
+        ], check=True)
+        subprocess.run(run + ["-i", str(self.video), "-vn", "-c:a", "copy", str(self.audio)], check=True)
+        subprocess.run(run + ["-i", str(self.video), "-frames:v", "1", str(self.thumb)], check=True)
+        subprocess.run(run + [
+            "-i", str(self.video), "-c", "copy", "-f", "hls",
+            "-hls_time", f"{segment}", "-hls_list_size", "0",
+            "-hls_segment_filename", str(self.hls / "seg%d.ts"), str(self.hls / "index.m3u8"),
+        ], check=True)
+
+    @property
+    def hls_size(self) -> int:
+        return sum(p.stat().st_size for p in self.hls.glob("*.ts"))
+
+    def _file(self, request: web.Request) -> Path:
+        ext = request.match_info["name"].rpartition(".")[2]
+        return {"m4a": self.audio, "jpg": self.thumb}.get(ext, self.video)
+
+    async def _send(self, request: web.Request, path: Path, rate: int | None) -> web.StreamResponse:
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        status = 200
+        range_header = request.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            start = int(first or 0)
+            end = min(int(last), size - 1) if last else size - 1
+            status = 206
+
+        resp = web.StreamResponse(status=status)
+        resp.content_type = {".mp4": "video/mp4", ".m4a": "audio/mp4", ".jpg": "image/jpeg"}.get(
+            path.suffix, "video/mp2t" if path.suffix == ".ts" else "application/octet-stream"
+        )
+        resp.content_length = end - start + 1
+        resp.headers["Accept-Ranges"] = "bytes"
+        if status == 206:
+            resp.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await resp.prepare(request)
+        if request.method == "HEAD":
+            return resp
+
+        chunk = 64 * 1024
+        with open(path, "rb") as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                data = f.read(min(chunk, left))
+                if not data:
+                    break
+                await resp.write(data)
+                left -= len(data)
+                if rate:
+                    await asyncio.sleep(len(data) / rate)
+        return resp
+
+    async def progressive(self, request: web.Request):
+        return await self._send(request, self._file(request), None)
+
+    async def slow(self, request: web.Request):
+        return await self._send(request, self._file(request), self.slow_rate)
+
+    async def playlist(self, request: web.Request):
+        text = (self.hls / "index.m3u8").read_text()
+        return web.Response(text=text, content_type="application/vnd.apple.mpegurl")
+
+    async def segment(self, request: web.Request):
+        path = self.hls / request.match_info["seg"]
+        if path.parent != self.hls or not path.is_file():
+            raise web.HTTPNotFound()
+        return await self._send(request, path, None)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/progressive/{name}", self.progressive)
+        app.router.add_get("/slow/{name}", self.slow)
+        app.router.add_get("/hls/{vid}/index.m3u8", self.playlist)
+        app.router.add_get("/hls/{vid}/{seg}", self.segment)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        await web.SockSite(self._runner, sock).start()
+        self.base_url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+ORIGIN: MediaOrigin | None = None
+
+
+# ========================== #
+# 🧩 Заглушка экстрактора
+# ========================== #
+
+class BenchIE(InfoExtractor):
+    IE_NAME = "bench"
+    _VALID_URL = r"https?://bench\.local/(?P<kind>progressive|hls|slow)/(?P<id>[\w-]+)"
+
+    def _real_extract(self, url):
+        kind, vid = self._match_valid_url(url).group("kind", "id")
+        base = ORIGIN.base_url
+        size = ORIGIN.video.stat().st_size
+        if kind == "hls":
+            formats = [{
+                "format_id": "hls-480",
+                "url": f"{base}/hls/{vid}/index.m3u8",
+                "protocol": "m3u8_native",
+                "ext": "mp4",
+                "height": 480,
+                "vcodec": "avc1.4d401e",
+                "acodec": "mp4a.40.2",
+                "filesize_approx": ORIGIN.hls_size,
+            }]
+        else:
+            formats = [{
+                "format_id": "prog-360",
+                "url": f"{base}/{kind}/{vid}.mp4",
+                "ext": "mp4",
+                "height": 360,
+                "vcodec": "avc1.4d401e",
+                "acodec": "mp4a.40.2",
+                "filesize": size,
+            }]
+        formats.append({
+            "format_id": "audio",
+            "url": f"{base}/progressive/{vid}.m4a",
+            "ext": "m4a",
+            "vcodec": "none",
+            "acodec": "mp4a.40.2",
+            "filesize": ORIGIN.audio.stat().st_size,
+        })
+        return {
+            "id": vid,
+            "title": f"Bench {kind} {vid}",
+            "duration": MediaOrigin.DURATION,
+            "thumbnail": f"{base}/progressive/{vid}.jpg",
+            "formats": formats,
+        }
+
+
+class BenchYoutubeDL(yt_dlp.YoutubeDL):
+    def add_default_info_extractors(self):
+        # заглушка первой: иначе ссылку перехватит generic
+        self.add_info_extractor(BenchIE())
+        super().add_default_info_extractors()
+
+
+# ========================== #
+# 🤖 Поддельный Bot API
+# ========================== #
+
+LINK_MARKER = "[Скачать файл]"
+MEDIA_METHODS = {
+    "SendVideo": ("video", types.Video),
+    "SendAudio": ("audio", types.Audio),
+    "SendDocument": ("document", types.Document),
+}
+
+
+class FakeSession(BaseSession):
+    """
+    Отвечает на запросы бота как Telegram и отмечает для каждого чата
+    момент появления меню и момент выдачи результата.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._message_id = 0
+        self.requests = 0
+        self.menus: dict[int, asyncio.Future] = {}
+        self.results: dict[int, asyncio.Future] = {}
+
+    def expect(self, chat_id: int):
+        loop = asyncio.get_running_loop()
+        self.menus[chat_id] = loop.create_future()
+        self.results[chat_id] = loop.create_future()
+
+    @staticmethod
+    def _resolve(futures: dict, chat_id: int, value):
+        fut = futures.get(chat_id)
+        if fut and not fut.done():
+            fut.set_result(value)
+
+    def _message(self, bot, chat_id: int, message_id: int | None, text: str | None, reply_markup=None):
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+        data = {
+            "message_id": message_id,
+            "date": datetime.datetime.now(datetime.timezone.utc),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+        if reply_markup is not None:
+            data["reply_markup"] = reply_markup.model_dump()
+        return types.Message.model_validate(data, context={"bot": bot})
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        name = type(method).__name__
+        chat_id = getattr(method, "chat_id", None)
+
+        if name in ("SendMessage", "EditMessageText"):
+            msg = self._message(bot, chat_id, getattr(method, "message_id", None), method.text, method.reply_markup)
+            if method.reply_markup is not None and getattr(method.reply_markup, "inline_keyboard", None):
+                self._resolve(self.menus, chat_id, msg)
+            elif method.text.startswith("❌"):
+                self._resolve(self.results, chat_id, "error")
+            elif LINK_MARKER in method.text:
+                self._resolve(self.results, chat_id, "link")
+            return msg
+
+        if name in MEDIA_METHODS:
+            self._resolve(self.results, chat_id, "upload")
+            msg = self._message(bot, chat_id, None, None)
+            kind, model = MEDIA_METHODS[name]
+            media = model.model_validate({
+                "file_id": f"bench-{msg.message_id}",
+                "file_unique_id": f"u{msg.message_id}",
+                "width": 1,
+                "height": 1,
+                "duration": 1,
+            })
+            return msg.model_copy(update={kind: media})
+
+        if name == "SendPhoto":
+            return self._message(bot, chat_id, None, None)
+
+        # AnswerCallbackQuery, EditMessageReplyMarkup и прочее
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        if False:
+            yield b""
+
+    async def close(self):
+        pass
+
+
+# ========================== #
+# 👥 Сценарий пользователя
+# ========================== #
+
+MODE_BUTTONS = {
+    "safe": "⬇️",
+    "bestq": "💎",
+    "any": "🧩",
+    "audio": "🎵",
+    "audio_copy": "🎧",
+    "fit": "🎯",
+    "fast": "⚡",
+    "shrink": "📉",
+}
+
+
+def find_button(menu: types.Message, mode: str) -> str:
+    prefix = MODE_BUTTONS[mode]
+    for row in menu.reply_markup.inline_keyboard:
+        for button in row:
+            if button.text.startswith(prefix):
+                return button.callback_data
+    raise RuntimeError(f"В меню нет кнопки режима {mode}")
+
+
+class Stats:
+    def __init__(self):
+        self.time_to_menu: list[float] = []
+        self.time_to_link: list[float] = []
+        self.outcomes: dict[str, int] = {}
+
+
+async def simulate_user(idx: int, args, session: FakeSession, stats: Stats, update_ids):
+    bot, dp = ytd_bot.bot, ytd_bot.dp
+    user_id = FIRST_USER_ID + idx
+    user = {"id": user_id, "is_bot": False, "first_name": f"u{idx}"}
+    kinds = ["progressive", "hls", "slow"] if args.kind == "mixed" else [args.kind]
+
+    for rnd in range(args.rounds):
+        kind = kinds[(idx + rnd) % len(kinds)]
+        vid = "shared" if args.repeat_urls else f"v{idx}r{rnd}"
+        url = f"https://bench.local/{kind}/{vid}"
+        session.expect(user_id)
+
+        started = time.monotonic()
+        update = types.Update.model_validate({
+            "update_id": next(update_ids),
+            "message": {
+                "message_id": next(update_ids),
+                "date": datetime.datetime.now(datetime.timezone.utc),
+                "chat": {"id": user_id, "type": "private"},
+                "from": user,
+                "text": url,
+            },
+        }, context={"bot": bot})
+        await dp.feed_update(bot, update)
+        menu = await asyncio.wait_for(session.menus[user_id], args.timeout)
+        stats.time_to_menu.append(time.monotonic() - started)
+
+        clicked = time.monotonic()
+        update = types.Update.model_validate({
+            "update_id": next(update_ids),
+            "callback_query": {
+                "id": str(next(update_ids)),
+                "from": user,
+                "chat_instance": str(user_id),
+                "message": menu.model_dump(),
+                "data": find_button(menu, args.mode),
+            },
+        }, context={"bot": bot})
+        await dp.feed_update(bot, update)
+        try:
+            outcome = await asyncio.wait_for(session.results[user_id], args.timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        stats.outcomes[outcome] = stats.outcomes.get(outcome, 0) + 1
+        if outcome in ("link", "upload"):
+            stats.time_to_link.append(time.monotonic() - clicked)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(q) - 1]
+
+
+async def run(args) -> dict:
+    global ORIGIN
+    ORIGIN = MediaOrigin(size_mb=args.size_mb, fragments=args.fragments, slow_rate_kb=args.slow_rate_kb)
+    await ORIGIN.start()
+
+    yt_dlp.YoutubeDL = BenchYoutubeDL
+    if args.mode == "shrink":
+        # кнопка «сжать» появляется, только если готовый формат не влезает
+        ytd_bot.FIT_SIZE_BYTES = max(1, args.size_mb // 2) * 1024 * 1024
+    if not args.verbose:
+        # консольный прогресс yt-dlp и INFO-логи бота забивают вывод результата
+        build_opts = ytd_bot.build_base_ydl_opts
+        ytd_bot.build_base_ydl_opts = lambda *a, **kw: {
+            **build_opts(*a, **kw),
+            "quiet": True,
+            "noprogress": True,
+            "no_warnings": True,
+        }
+        logging.getLogger().setLevel(logging.WARNING)
+    session = FakeSession()
+    ytd_bot.bot.session = session
+
+    tasks = [
+        asyncio.create_task(ytd_bot.scheduler.run()),
+        asyncio.create_task(ytd_bot.progress.run()),
+    ]
+    stats = Stats()
+    counter = iter(range(1, 10 ** 9))
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*(
+            simulate_user(i, args, session, stats, counter) for i in range(args.users)
+        ))
+    finally:
+        elapsed = time.monotonic() - started
+        for task in tasks:
+            task.cancel()
+        await ORIGIN.stop()
+        await ytd_bot.thumbnails.close()
+        ytd_bot.executor.shutdown()
+
+    done = len(stats.time_to_link)
+    return {
+        "users": args.users,
+        "rounds": args.rounds,
+        "kind": args.kind,
+        "mode": args.mode,
+        "workers": ytd_bot.DOWNLOAD_WORKERS,
+        "elapsed_s": round(elapsed, 2),
+        "time_to_menu_p50_s": round(percentile(stats.time_to_menu, 50), 3),
+        "time_to_menu_p95_s": round(percentile(stats.time_to_menu, 95), 3),
+        "time_to_link_p50_s": round(percentile(stats.time_to_link, 50), 3),
+        "time_to_link_p95_s": round(percentile(stats.time_to_link, 95), 3),
+        "jobs_per_min": round(done / elapsed * 60, 2) if elapsed else 0.0,
+        "outcomes": stats.outcomes,
+        "bot_api_requests": session.requests,
+        # ru_maxrss в Linux — в килобайтах
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк ytd_bot")
+    parser.add_argument("--users", type=int, default=4, help="одновременных пользователей")
+    parser.add_argument("--rounds", type=int, default=2, help="ссылок на пользователя")
+    parser.add_argument("--kind", choices=["progressive", "hls", "slow", "mixed"], default="mixed")
+    parser.add_argument("--mode", choices=sorted(MODE_BUTTONS), default="safe")
+    parser.add_argument("--size-mb", type=int, default=20, help="размер тестового видео")
+    parser.add_argument("--fragments", type=int, default=20, help="фрагментов в HLS")
+    parser.add_argument("--slow-rate-kb", type=int, default=2048, help="скорость медленной отдачи, КБ/с")
+    parser.add_argument("--repeat-urls", action="store_true", help="все запрашивают одно видео (проверка кэша)")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--json", action="store_true", help="вывести результат одной JSON-строкой")
+    parser.add_argument("--verbose", action="store_true", help="не глушить вывод yt-dlp и логи бота")
+    args = parser.parse_args()
+    if args.users > MAX_USERS:
+        parser.error(f"--users не больше {MAX_USERS}")
+
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        for key, value in result.items():
+            print(f"{key:>22}: {value}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
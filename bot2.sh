@@ -25,7 +25,7 @@ SYSTEMD_SERVICE_FILE="/etc/systemd/system/$SERVICE_NAME" # Путь к файл
 # URL файла бота на GitHub (согласно вашим уточнениям)
 GITHUB_BOT_URL="https://raw.githubusercontent.com/OMchik33/ytd_bot/refs/heads/main/ytd_bot.py"
 
-# Команда cron для очистки папки загрузок
+# Команда cron для очистки папки загрузок (устарела: чистку делает бот, строка нужна, чтобы удалить старую задачу)
 CRON_CLEANUP_COMMAND="*/10 * * * * find $DOWNLOAD_DIR -type f -mmin +10 -exec rm -f {} \\;"
 
 
@@ -467,11 +467,13 @@ install_bot() {
     fi
 
 
-    # --- Шаг 6: Настройка Cron ---
-    echo -e "\n--- Настройка Cron для очистки папки загрузок ---"
-    (crontab -l 2>/dev/null | grep -v -F "$CRON_CLEANUP_COMMAND"; echo "$CRON_CLEANUP_COMMAND") | crontab -
-    if [ $? -ne 0 ]; then echo "Ошибка при добавлении/обновлении задачи Cron."; read -p "" -n 1 -s; echo; fi
-    echo "Задача Cron для очистки $DOWNLOAD_DIR добавлена/обновлена."
+    # --- Шаг 6: Cron больше не нужен ---
+    # Папку загрузок чистит сам бот (FILE_TTL/STORAGE_QUOTA_MB в .env):
+    # cron удалял файлы посреди скачивания, поэтому старую задачу убираем.
+    echo -e "\n--- Удаление старой задачи Cron для очистки папки загрузок ---"
+    crontab -l 2>/dev/null | grep -v -F "$CRON_CLEANUP_COMMAND" | crontab -
+    if [ $? -ne 0 ]; then echo "Ошибка при обновлении задач Cron."; read -p "" -n 1 -s; echo; fi
+    echo "Очистку $DOWNLOAD_DIR выполняет бот, задача Cron не используется."
     echo "Текущие задачи Cron пользователя root:"
     crontab -l 2>/dev/null || echo "Нет задач Cron."
 
@@ -3,19 +3,44 @@ import re
 import json
 import time
 import hashlib
+import hmac
 import logging
 import asyncio
-import datetime
 import shutil
+import glob
+import functools
+import copy
+import sqlite3
+import queue
+import multiprocessing
+import zipfile
+import heapq
+import random
+import secrets
+import threading
+import contextlib
+import http.cookiejar
+import signal
+import socket
+from collections import OrderedDict, deque
+from dataclasses import dataclass, asdict, field
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
 from urllib.parse import quote, urlparse, parse_qs, urlunparse
 
 import yt_dlp
+from yt_dlp.cookies import YoutubeDLCookieJar
+from yt_dlp.postprocessor import get_postprocessor
+from yt_dlp.utils import DownloadCancelled
+import aiohttp
+from aiohttp import web
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, FSInputFile, BufferedInputFile
 
 # ========================== #
 # 🔧 Конфигурация окружения
@@ -33,16 +58,138 @@ SPECIAL_CODE = os.getenv("SPECIAL_CODE")
 DOWNLOAD_PATH = Path(os.getenv("DOWNLOAD_PATH", "/download"))
 COOKIES_PATH = Path(os.getenv("COOKIES_PATH", "/opt/telegram-bots/ytd_bot/cookies"))
 DOWNLOAD_BASE_URL = os.getenv("DOWNLOAD_BASE_URL")
+DATA_PATH = Path(os.getenv("DATA_PATH", str(COOKIES_PATH.parent / "data")))
 
 DEBUG_YTDLP = os.getenv("DEBUG_YTDLP", "0") == "1"
 
+# Пул исполнителей yt-dlp
+DOWNLOAD_WORKERS = max(1, int(os.getenv("DOWNLOAD_WORKERS", "3")))
+PROBE_WORKERS = max(1, int(os.getenv("PROBE_WORKERS", "2")))
+PER_USER_DOWNLOADS = max(1, int(os.getenv("PER_USER_DOWNLOADS", "1")))
+EXECUTOR_KIND = os.getenv("EXECUTOR_KIND", "thread").strip().lower()
+
+# Готовые экземпляры YoutubeDL между вызовами (YDL_POOL=0 — каждый раз новый)
+YDL_POOL = os.getenv("YDL_POOL", "1") == "1"
+
+# Очередь задач: средний размер, если yt-dlp не знает размер, и стартовая
+# оценка скорости одного воркера (уточняется по факту скачиваний)
+DEFAULT_JOB_SIZE = 50 * 1024 * 1024
+DEFAULT_WORKER_SPEED = 2 * 1024 * 1024
+
+# Кэш готовых файлов: повторный запрос того же видео в том же режиме
+# отдаёт уже скачанный файл
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_MB", "5120")) * 1024 * 1024
+
+# Кэш результатов анализа ссылок (extract_info без скачивания)
+PROBE_CACHE_TTL = int(os.getenv("PROBE_CACHE_TTL", "600"))
+PROBE_CACHE_SIZE = int(os.getenv("PROBE_CACHE_SIZE", "128"))
+PROBE_CACHE_DISK = os.getenv("PROBE_CACHE_DISK", "0") == "1"
+
+# Меню под ссылками: сколько ждать нажатия и сколько меню помнить.
+# REQUEST_STORE_DISK=1 — меню хранятся в общем состоянии: переживают
+# перезапуск и видны всем экземплярам бота
+REQUEST_TTL = int(os.getenv("REQUEST_TTL", "3600"))
+REQUEST_STORE_SIZE = max(1, int(os.getenv("REQUEST_STORE_SIZE", "2000")))
+REQUEST_STORE_DISK = os.getenv("REQUEST_STORE_DISK", "1") == "1"
+
+# Прогресс скачивания: не чаще одной правки статуса на чат за интервал
+# (Telegram режет частые edit_message_text)
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))
+
+# Параллельная загрузка фрагментов HLS/DASH
+ADAPTIVE_FRAGMENTS = os.getenv("ADAPTIVE_FRAGMENTS", "1") == "1"
+FRAGMENT_CONCURRENCY_MAX = max(1, int(os.getenv("FRAGMENT_CONCURRENCY_MAX", "8")))
+THROTTLE_COOLDOWN = 300
+
+# Встроенный HTTP-сервер для раздачи файлов (вместо nginx)
+HTTP_SERVER = os.getenv("HTTP_SERVER", "0") == "1"
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("HTTP_PORT", "8080"))
+LINK_SECRET = os.getenv("LINK_SECRET") or ""
+LINK_TTL = int(os.getenv("LINK_TTL", "1800"))
+
+# Выбор downloader (штатный или ffmpeg) по статистике: путь, проваливший
+# STRATEGY_BREAKER_FAILS попыток подряд, отключается на STRATEGY_BREAKER_COOLDOWN
+# секунд; STRATEGY_EXPLORE — доля задач, где проигрывающий путь пробуется первым
+STRATEGY_BREAKER_FAILS = max(1, int(os.getenv("STRATEGY_BREAKER_FAILS", "3")))
+STRATEGY_BREAKER_COOLDOWN = int(os.getenv("STRATEGY_BREAKER_COOLDOWN", "1800"))
+STRATEGY_EXPLORE = float(os.getenv("STRATEGY_EXPLORE", "0.05"))
+
+# Управление местом в DOWNLOAD_PATH
+STORAGE_QUOTA_BYTES = int(os.getenv("STORAGE_QUOTA_MB", "20480")) * 1024 * 1024
+MIN_FREE_BYTES = int(os.getenv("MIN_FREE_MB", "1024")) * 1024 * 1024
+FILE_TTL = int(os.getenv("FILE_TTL", "1800"))
+ORPHAN_AGE = 600
+STORAGE_SWEEP_INTERVAL = 60
+
+# Отправка небольших файлов прямо в чат вместо ссылки
+DIRECT_UPLOAD = os.getenv("DIRECT_UPLOAD", "0") == "1"
+UPLOAD_LIMIT_BYTES = int(os.getenv("UPLOAD_LIMIT_MB", "50")) * 1024 * 1024
+AUDIO_EXTS = ("mp3", "m4a", "opus", "ogg", "aac", "flac", "wav")
+
+# Режим «лучшее, что влезает в N МБ»; по умолчанию N — лимит отправки в чат.
+# Тот же предел у режима «сжать до N МБ»: перекодирование кусками на всех ядрах
+FIT_SIZE_BYTES = int(os.getenv("FIT_SIZE_MB", str(UPLOAD_LIMIT_BYTES // 1024 // 1024))) * 1024 * 1024
+SHRINK_PRESET = os.getenv("SHRINK_PRESET", "faster")
+
+# Аудио: MP3 перекодируется ffmpeg прямо из потока, пока байты ещё идут
+# (AUDIO_PIPELINE=1); перекодирований одновременно — не больше TRANSCODE_WORKERS
+AUDIO_PIPELINE = os.getenv("AUDIO_PIPELINE", "1") == "1"
+TRANSCODE_WORKERS = max(1, int(os.getenv("TRANSCODE_WORKERS", str(os.cpu_count() or 2))))
+MP3_BITRATE = "192k"
+
+# Обложки: качаются один раз, приводятся к JPEG и кэшируются (байты на
+# диске, file_id — в Telegram); EMBED_COVER=1 — вшивать обложку в MP3
+EMBED_COVER = os.getenv("EMBED_COVER", "1") == "1"
+THUMB_CACHE_FILES = int(os.getenv("THUMB_CACHE_FILES", "2000"))
+
+# Пакетный режим: плейлисты и сообщения с несколькими ссылками
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+
+# Пул cookies: cookies.txt аккаунтов оператора в COOKIE_POOL_PATH.
+# Пользователи без своих cookies ходят через наименее загруженный живой
+# профиль; на 429 и «подтвердите, что вы не бот» профиль уходит на паузу
+# COOKIE_COOLDOWN секунд (при повторах — дольше, до 8 раз)
+COOKIE_POOL_PATH = Path(os.getenv("COOKIE_POOL_PATH", str(COOKIES_PATH / "pool")))
+COOKIE_COOLDOWN = int(os.getenv("COOKIE_COOLDOWN", "900"))
+
+# Несколько экземпляров на одном токене. ROLE: bot — принимает обновления
+# и ставит задачи, worker — разбирает очередь, all — всё в одном процессе.
+# Общее состояние (меню, очередь, пользователи): SQLite в DATA_PATH или Redis.
+ROLE = os.getenv("ROLE", "all").strip().lower()
+REDIS_URL = os.getenv("REDIS_URL", "")
+# WORKER_ID — владелец аренд задач. Заданный явно, он переживает перезапуск
+# (прерванные задачи возвращаются сразу); по умолчанию уникален на процесс
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(3)}"
+JOB_LEASE = 60
+QUEUE_POLL_INTERVAL = float(os.getenv("QUEUE_POLL_INTERVAL", "1"))
+
+# Webhook вместо polling: публичный URL, на который Telegram шлёт обновления
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or ""
+
+# Метрики: /metrics на локальном порту (0 — выключено) и JSON-события в лог
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_JSON_LOG = os.getenv("METRICS_JSON_LOG", "0") == "1"
+
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
 if not DOWNLOAD_BASE_URL:
     raise RuntimeError("DOWNLOAD_BASE_URL is not set")
+if HTTP_SERVER and not LINK_SECRET:
+    # по умолчанию подпись ссылок выводим из токена: переживает перезапуск
+    LINK_SECRET = hashlib.sha256(f"links:{BOT_TOKEN}".encode()).hexdigest()
+if EXECUTOR_KIND not in ("thread", "process"):
+    raise RuntimeError("EXECUTOR_KIND must be 'thread' or 'process'")
+if ROLE not in ("bot", "worker", "all"):
+    raise RuntimeError("ROLE must be 'bot', 'worker' or 'all'")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    WEBHOOK_SECRET = hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()[:32]
 
 DOWNLOAD_PATH.mkdir(parents=True, exist_ok=True)
 COOKIES_PATH.mkdir(parents=True, exist_ok=True)
+DATA_PATH.mkdir(parents=True, exist_ok=True)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("ytd_bot")
@@ -50,9 +197,6 @@ logger = logging.getLogger("ytd_bot")
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
-active_url_requests: dict[int, dict] = {}
-REQUEST_TTL = datetime.timedelta(hours=1)
-
 
 # ========================== #
 # 🧩 Хелперы
@@ -81,6 +225,30 @@ def get_cookie_file(user_id: int) -> Path | None:
     return cookie_file if cookie_file.exists() else None
 
 
+def cookie_for(user_id: int, *, charge: bool = True) -> Path | None:
+    """
+    Свои cookies пользователя, иначе — профиль из пула.
+    charge=False — только выбрать профиль, не записывая на него запрос.
+    """
+    own = get_cookie_file(user_id)
+    if own:
+        return own
+    profile = cookie_pool.pick(charge=charge)
+    return profile.path if profile else None
+
+
+def load_cookie_jar(path: Path) -> YoutubeDLCookieJar:
+    """
+    Разбор cookies.txt (Netscape). LoadError — файл не в этом формате.
+    """
+    jar = YoutubeDLCookieJar(str(path))
+    jar.load()
+    if not len(jar):
+        raise http.cookiejar.LoadError("no cookies in file")
+    return jar
+
+
+@functools.lru_cache(maxsize=1)
 def detect_node_path() -> str | None:
     p = shutil.which("node")
     if p:
@@ -91,17 +259,6 @@ def detect_node_path() -> str | None:
     return None
 
 
-def purge_old_requests():
-    now = datetime.datetime.now(datetime.timezone.utc)
-    dead = []
-    for mid, data in active_url_requests.items():
-        ts = data.get("timestamp")
-        if not ts or (now - ts > REQUEST_TTL):
-            dead.append(mid)
-    for mid in dead:
-        active_url_requests.pop(mid, None)
-
-
 def fmt_size(size_bytes: int | None) -> str:
     if not size_bytes:
         return ""
@@ -109,15 +266,38 @@ def fmt_size(size_bytes: int | None) -> str:
     return f" (~{mb} МБ)"
 
 
-def build_base_ydl_opts(user_id: int, *, skip_download: bool, quiet: bool) -> dict:
+def fmt_mb(size_bytes: float | None) -> str:
+    return f"{(size_bytes or 0) / 1024 / 1024:.1f} МБ"
+
+
+def fmt_eta(seconds: float) -> str:
+    if seconds < 60:
+        return "меньше минуты"
+    return f"~{round(seconds / 60)} мин"
+
+
+def build_base_ydl_opts(
+    user_id: int | None,
+    *,
+    skip_download: bool,
+    quiet: bool,
+    tag: str | None = None,
+    cookie_file: Path | None = None,
+) -> dict:
     """
     База. downloader НЕ задаём здесь, чтобы можно было сделать retry с ffmpeg.
+    tag добавляется в имя файла, чтобы параллельные задачи по одному видео
+    не писали в один и тот же файл.
+    user_id=None — cookies берутся из cookie_file как есть, профиль пула
+    не выбирается.
     """
-    cookie_file = get_cookie_file(user_id)
+    if user_id is not None:
+        cookie_file = cookie_for(user_id)
     node_path = detect_node_path()
+    name_tmpl = f"%(id)s.{tag}.%(ext)s" if tag else "%(id)s.%(ext)s"
 
     opts: dict = {
-        "outtmpl": str(DOWNLOAD_PATH / "%(id)s.%(ext)s"),
+        "outtmpl": str(DOWNLOAD_PATH / name_tmpl),
         "paths": {"home": str(DOWNLOAD_PATH)},
         "noplaylist": True,
 
@@ -182,18 +362,381 @@ def get_format_string(mode: str, format_id: str | None) -> str:
     if mode == "any":
         return "best"
 
+    # format_id — уже выбранная FormatIndex связка вида "137+140"
+    if mode == "fit":
+        return f"{format_id}/best[ext=mp4]/best" if format_id else "best[ext=mp4]/best"
+
+    if mode == "fast":
+        return f"{format_id}/best[ext=mp4]/best" if format_id else "best[protocol^=http][ext=mp4]/best[ext=mp4]/best"
+
+    # исходник для сжатия: выше SHRINK_MAX_HEIGHT всё равно не оставим
+    if mode == "shrink":
+        h = SHRINK_MAX_HEIGHT
+        return f"bv*[height<={h}]+ba/b[height<={h}]/b"
+
     return "best"
 
 
-def ydl_extract(url: str, opts: dict, *, download: bool):
+AUDIO_MODES = ("audio", "audio_copy")
+
+
+def media_profile(mode: str, format_id: str | None) -> dict:
+    """
+    Формат и постпроцессоры режима. По ним же строится ключ кэша.
+    """
+    if mode == "audio_copy":
+        # без перекодирования: m4a остаётся как есть, opus из webm — в .opus
+        return {
+            "format": "bestaudio[ext=m4a]/bestaudio[acodec=opus]/bestaudio/best",
+            "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "best"}],
+        }
+    if mode == "audio":
+        return {
+            "format": "bestaudio/best",
+            "postprocessors": [{
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": "mp3",
+                "preferredquality": "192",
+            }],
+        }
+    if mode == "shrink":
+        # shrink_to не для yt-dlp: fetch_media забирает его из opts, а в ключе кэша
+        # он отделяет файлы, сжатые под разные пределы
+        return {"format": get_format_string(mode, format_id), "shrink_to": FIT_SIZE_BYTES}
+    return {"format": get_format_string(mode, format_id)}
+
+
+def mode_emoji(mode: str) -> str:
+    if mode == "audio":
+        return "🎵"
+    if mode == "audio_copy":
+        return "🎧"
+    if mode == "fit":
+        return "🎯"
+    if mode == "fast":
+        return "⚡"
+    if mode == "shrink":
+        return "📉"
+    return "🎬" if mode in ("safe", "pick", "any") else "💎"
+
+
+def cache_key_for(extractor: str | None, video_id: str | None, profile: dict) -> str | None:
+    if not extractor or not video_id:
+        return None
+    raw = json.dumps([extractor, video_id, profile], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def sign_link(file_name: str, expires: int) -> str:
+    msg = f"{file_name}:{expires}".encode()
+    return hmac.new(LINK_SECRET.encode(), msg, hashlib.sha256).hexdigest()[:32]
+
+
+def make_download_link(file_name: str, title: str, ext: str) -> str:
+    clean_title = sanitize_filename(title)
+    link = f"{DOWNLOAD_BASE_URL}/{quote(file_name)}?filename={quote(clean_title + '.' + ext)}"
+    if LINK_SECRET:
+        expires = int(time.time()) + LINK_TTL
+        link += f"&e={expires}&s={sign_link(file_name, expires)}"
+    return link
+
+
+@dataclass(slots=True)
+class PooledYdl:
+    ydl: yt_dlp.YoutubeDL
+    base: dict
+    # mtime файла cookies, с которым совпадает cookie jar экземпляра
+    jar_mtime: int
+
+
+class YdlPool:
+    """
+    Готовые экземпляры YoutubeDL по профилю cookies (файл): без повторной
+    загрузки экстракторов, разбора cookies и JS-рантайма на каждом вызове.
+    Параметры вызова (format, постпроцессоры, хуки, шаблон имени)
+    накладываются на взятый экземпляр. Если наложить не удалось — вызов идёт
+    через новый YoutubeDL; экземпляр, на котором вызов упал, выбрасывается.
+    Файл cookies изменился (сайт обновил их через другой экземпляр или
+    процесс, пользователь загрузил новые) — экземпляр перечитывает cookie
+    jar, а не создаётся заново. Файлы пула оператора только читаются.
+    Свой пул у каждого процесса-воркера.
+    """
+
+    # нормализуются в YoutubeDL.__init__ и одинаковы в пределах профиля
+    FIXED = ("http_headers", "js_runtimes", "remote_components", "compat_opts", "cookiefile")
+    # внутренности YoutubeDL, которые _apply сбрасывает между вызовами: если
+    # в новой версии yt-dlp их нет, присваивание молча создало бы лишний атрибут
+    RESET = ("_pps", "_progress_hooks", "_postprocessor_hooks", "_download_retcode", "format_selector")
+
+    def __init__(self, max_idle: int):
+        self.max_idle = max_idle
+        self._idle: dict[tuple, list[PooledYdl]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def profile(opts: dict) -> tuple:
+        # quiet влияет на то, куда экземпляр пишет вывод: задаётся при создании
+        return opts.get("cookiefile") or "", bool(opts.get("quiet"))
+
+    @staticmethod
+    def _mtime(cookiefile: str) -> int:
+        try:
+            return os.stat(cookiefile).st_mtime_ns if cookiefile else 0
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _read_only(cookiefile: str) -> bool:
+        # cookies аккаунтов пула меняет только оператор: по mtime пул
+        # узнаёт новые файлы и снимает с них паузу
+        return bool(cookiefile) and Path(cookiefile).parent == COOKIE_POOL_PATH
+
+    @staticmethod
+    def _discard(ydl: yt_dlp.YoutubeDL):
+        # close() сохранил бы устаревший cookie jar поверх нового файла
+        ydl.params.pop("cookiefile", None)
+        ydl.close()
+
+    @staticmethod
+    def _jar_state(ydl: yt_dlp.YoutubeDL) -> int:
+        if not ydl.params.get("cookiefile"):
+            return 0
+        return hash(tuple(sorted((c.domain, c.path, c.name, c.value or "") for c in ydl.cookiejar)))
+
+    def _take(self, key: tuple) -> PooledYdl | None:
+        with self._lock:
+            idle = self._idle.get(key)
+            entry = idle.pop() if idle else None
+        if entry and key[0]:
+            mtime = self._mtime(key[0])
+            if mtime != entry.jar_mtime:
+                try:
+                    entry.ydl.cookiejar.clear()
+                    entry.ydl.cookiejar.load()
+                except (OSError, http.cookiejar.LoadError) as e:
+                    logger.warning(f"YoutubeDL pool cookies reload failed: {e}")
+                    self._discard(entry.ydl)
+                    return None
+                entry.jar_mtime = mtime
+        return entry
+
+    def _create(self, opts: dict) -> PooledYdl:
+        mtime = self._mtime(opts.get("cookiefile") or "")
+        ydl = yt_dlp.YoutubeDL(dict(opts))
+        missing = [attr for attr in self.RESET if not hasattr(ydl, attr)]
+        if missing:
+            ydl.close()
+            raise AttributeError(f"YoutubeDL has no {', '.join(missing)}")
+        # база профиля: нормализованные FIXED и умолчания, которые __init__
+        # дописал сам; всё, что пришло в opts, относится к вызову
+        base = {k: v for k, v in ydl.params.items() if k in self.FIXED or k not in opts}
+        return PooledYdl(ydl, base, mtime)
+
+    def _apply(self, ydl: yt_dlp.YoutubeDL, base: dict, opts: dict):
+        ydl.params = {**base, **{k: v for k, v in opts.items() if k not in self.FIXED}}
+        ydl._parse_outtmpl()
+        fmt = ydl.params.get("format")
+        ydl.format_selector = fmt if fmt in (None, "-") or callable(fmt) else ydl.build_format_selector(fmt)
+        ydl._pps = {when: [] for when in ydl._pps}
+        ydl._progress_hooks = []
+        ydl._postprocessor_hooks = []
+        ydl._download_retcode = 0
+        for pp_def_raw in ydl.params.get("postprocessors", []):
+            pp_def = dict(pp_def_raw)
+            when = pp_def.pop("when", "post_process")
+            ydl.add_post_processor(get_postprocessor(pp_def.pop("key"))(ydl, **pp_def), when=when)
+        for hook in ydl.params.get("progress_hooks", []):
+            ydl.add_progress_hook(hook)
+        for hook in ydl.params.get("postprocessor_hooks", []):
+            ydl.add_postprocessor_hook(hook)
+
+    def _release(self, key: tuple, entry: PooledYdl, jar_before: int):
+        cookiefile = key[0]
+        if not self._read_only(cookiefile) and self._jar_state(entry.ydl) != jar_before:
+            # сайт обновил cookies: сохраняем, как это сделал бы close();
+            # остальные экземпляры перечитают файл, когда их возьмут
+            entry.ydl.save_cookies()
+            entry.jar_mtime = self._mtime(cookiefile)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(entry)
+                return
+        self._discard(entry.ydl)
+
+    @contextlib.contextmanager
+    def _fresh(self, opts: dict):
+        ydl = yt_dlp.YoutubeDL(opts)
+        try:
+            yield ydl
+        finally:
+            if self._read_only(opts.get("cookiefile") or ""):
+                self._discard(ydl)
+            else:
+                ydl.close()
+
+    @contextlib.contextmanager
+    def session(self, opts: dict):
+        if not YDL_POOL:
+            with self._fresh(opts) as ydl:
+                yield ydl
+            return
+
+        key = self.profile(opts)
+        entry = self._take(key)
+        try:
+            if entry:
+                self._apply(entry.ydl, entry.base, opts)
+            else:
+                entry = self._create(opts)
+            jar_before = self._jar_state(entry.ydl)
+        except Exception as e:
+            logger.warning(f"YoutubeDL pool failed, using a fresh instance: {e}")
+            if entry:
+                self._discard(entry.ydl)
+            with self._fresh(opts) as ydl:
+                yield ydl
+            return
+
+        try:
+            yield entry.ydl
+        except BaseException:
+            self._discard(entry.ydl)
+            raise
+        self._release(key, entry, jar_before)
+
+    def warm(self, opts: dict) -> bool:
+        """
+        Экземпляр для профиля заранее: экстракторы, cookies и JS-рантайм
+        (node для EJS) готовы к первому запросу.
+        """
+        with self.session(opts) as ydl:
+            try:
+                ydl._js_runtimes
+            except Exception as e:
+                logger.warning(f"JS runtime warm-up failed: {e}")
+        return True
+
+
+ydl_pool = YdlPool(DOWNLOAD_WORKERS + PROBE_WORKERS)
+
+
+def warm_profile(opts: dict) -> bool:
+    # функция модуля, а не метод: уходит в процесс-воркер по имени,
+    # YdlPool с блокировкой не сериализуется
+    return ydl_pool.warm(opts)
+
+
+def ydl_extract(url: str, opts: dict, *, download: bool, info: dict | None = None):
     """
     Отдельная функция, чтобы проще было делать retry с другим downloader.
+    Если передан info из кэша анализа — страница повторно не разбирается,
+    yt-dlp только выбирает формат и качает (как --load-info-json).
+    Возвращаем sanitize-версию info: её можно передать из процесса-воркера.
+    """
+    with ydl_pool.session(opts) as ydl:
+        if info is not None:
+            result = ydl.process_ie_result(copy.deepcopy(info), download=download)
+        else:
+            result = ydl.extract_info(url, download=download)
+        return ydl.sanitize_info(result)
+
+
+DOWNLOADERS = {
+    "native": {},
+    # внешний ffmpeg (часто спасает m3u8/HLS/SABR)
+    "ffmpeg": {"external_downloader": {"default": "ffmpeg"}},
+}
+
+# Короткий бюджет ретраев для пути, который по статистике проигрывает
+FAST_FAIL = {"retries": 2, "fragment_retries": 2, "extractor_retries": 1}
+
+DEFAULT_PLAN = (("native", False), ("ffmpeg", True))
+
+
+class DownloadAttemptsFailed(Exception):
+    """
+    Все попытки плана провалились. attempts — [(downloader, error, seconds)]
+    для статистики стратегий; str() — ошибка последней попытки.
+    """
+
+    def __init__(self, message: str, attempts: list):
+        super().__init__(message, attempts)
+        self.attempts = attempts
+
+    def __str__(self) -> str:
+        return self.args[0]
+
+
+def run_download(
+    url: str,
+    opts: dict,
+    info: dict | None = None,
+    plan: tuple[tuple[str, bool], ...] = DEFAULT_PLAN,
+) -> dict:
+    """
+    Блокирующее скачивание целиком по плану: [(downloader, fast_fail)],
+    следующая попытка — только если предыдущая упала.
+    Выполняется в воркере пула, слот занят на все попытки.
+    """
+    attempts: list[tuple[str, str | None, float]] = []
+    for downloader, fast in plan:
+        attempt_opts = {**opts, **DOWNLOADERS[downloader], **(FAST_FAIL if fast else {})}
+        started = time.monotonic()
+        try:
+            logger.info(
+                f"Downloading url={url} format={opts.get('format')} downloader={downloader} "
+                f"fast_fail={fast} cached_info={info is not None and not attempts}"
+            )
+            # повторная попытка разбирает страницу заново: ссылки на форматы в кэше могли протухнуть
+            result = ydl_extract(url, attempt_opts, download=True, info=None if attempts else info)
+        except DownloadCancelled:
+            # остановка бота, а не сбой: других попыток не будет
+            raise
+        except Exception as e:
+            attempts.append((downloader, str(e), time.monotonic() - started))
+            logger.warning(f"Download via {downloader} failed. err={e}")
+            continue
+        attempts.append((downloader, None, time.monotonic() - started))
+        result["_attempts"] = attempts
+        return result
+    raise DownloadAttemptsFailed(attempts[-1][1] if attempts else "empty plan", attempts)
+
+
+# протоколы, которые ffmpeg читает сам
+PIPE_PROTOCOLS = ("http", "https", "m3u8", "m3u8_native")
+
+
+def resolve_audio_stream(url: str, opts: dict, info: dict) -> dict | None:
+    """
+    Прямая ссылка на аудиопоток, который выбрал бы yt-dlp, с заголовками
+    и cookies — чтобы ffmpeg читал его сам. None, если поток не по
+    HTTP/HLS (DASH-фрагменты, SABR) или сайт требует качать его кусками
+    (http_chunk_size: googlevideo режет скорость одного большого запроса,
+    а ffmpeg читает одним GET): тогда качаем обычным путём.
     """
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        return ydl.extract_info(url, download=download)
+    with ydl_pool.session(opts) as ydl:
+        selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+        stream = selected.get("url")
+        if not stream or selected.get("protocol") not in PIPE_PROTOCOLS:
+            return None
+        if (selected.get("downloader_options") or {}).get("http_chunk_size"):
+            return None
+        cookies = "".join(
+            f"{c.name}={c.value}; path={c.path}; domain={c.domain};\r\n"
+            for c in ydl.cookiejar.get_cookies_for_url(stream)
+        )
+        return {
+            "url": stream,
+            "id": selected.get("id") or "audio",
+            "headers": dict(selected.get("http_headers") or {}),
+            "cookies": cookies,
+            "duration": selected.get("duration") or 0,
+            "size": selected.get("filesize") or selected.get("filesize_approx") or 0,
+        }
 
 
-def find_downloaded_file(info: dict) -> str | None:
+def find_downloaded_file(info: dict, tag: str | None = None) -> str | None:
     """
     Пытаемся найти именно итоговый файл после download=True.
     Сначала предпочитаем merged/final path из info,
@@ -242,7 +785,8 @@ def find_downloaded_file(info: dict) -> str | None:
     if not vid:
         return None
 
-    candidates = list(DOWNLOAD_PATH.glob(f"{vid}.*"))
+    prefix = f"{vid}.{tag}." if tag else f"{vid}."
+    candidates = list(DOWNLOAD_PATH.glob(f"{glob.escape(prefix)}*"))
     candidates = [p for p in candidates if not str(p).endswith(".part")]
     if not candidates:
         return None
@@ -262,295 +806,4159 @@ def find_downloaded_file(info: dict) -> str | None:
 
 
 # ========================== #
-# 🧭 Команды
+# 📊 Метрики
 # ========================== #
 
-main_keyboard = ReplyKeyboardMarkup(
-    keyboard=[
-        [KeyboardButton(text="⬇️ Скачать видео"), KeyboardButton(text="🍪 Cookies")],
-        [KeyboardButton(text="ℹ️ Инструкция")],
-    ],
-    resize_keyboard=True,
-    persistent=True,
-)
-
-
-@dp.message(Command("start"))
-async def cmd_start(message: types.Message):
-    user_id = message.from_user.id
-    args = message.text.split(maxsplit=1)
-
-    if len(args) > 1 and args[1] == SPECIAL_CODE and user_id not in ALLOWED_USERS:
-        ALLOWED_USERS.append(user_id)
-        await message.answer("✅ Доступ разрешён! Добро пожаловать.")
-    elif user_id not in ALLOWED_USERS:
-        await message.answer("❌ Доступ запрещён. Введите специальный код.")
-        return
+class Metric:
+    """
+    Минимальная реализация метрик в формате Prometheus, без зависимостей.
+    Значения хранятся по кортежу значений меток.
+    """
 
-    await message.answer("Привет! Отправь ссылку на видео для скачивания.", reply_markup=main_keyboard)
+    kind = "untyped"
 
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
 
-@dp.message(F.text == "ℹ️ Инструкция")
-async def show_help(message: types.Message):
-    await message.answer(
-        "*Инструкция для использования бота:*\n\n"
-        "*⬇️ Скачать видео* - Нажмите эту кнопку, затем отправьте боту ссылку на видео.\n"
-        "  - Бот предложит выбрать качество видео.\n"
-        "  - Будет кнопка \"🎵 Скачать MP3\" для извлечения аудиодорожки.\n"
-        "  - Будет кнопка \"🖼️ Обложка\" для скачивания превью.\n"
-        "*🍪 Cookies* - Используйте, если видео требует авторизации или не скачивается.\n"
-        "1. Установите [Get cookies.txt LOCALLY](https://chromewebstore.google.com/detail/get-cookiestxt-locally/cclelndahbckbenkjhflpdbgdldlbecc).\n"
-        "2. Зайдите в аккаунт на нужном сайте.\n"
-        "3. Нажмите иконку расширения -> Export (формат **Netscape**).\n"
-        "4. Нажмите \"🍪 Cookies\" в боте -> отправьте `.txt` файл.\n"
-        "5. Попробуйте скачать видео снова.",
-        parse_mode="Markdown",
-        disable_web_page_preview=True,
-    )
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
 
+    @staticmethod
+    def _escape(value: str) -> str:
+        # экранирование значений меток по текстовому формату Prometheus
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-@dp.message(F.text == "🍪 Cookies")
-async def prompt_cookies(message: types.Message):
-    await message.answer("Отправьте файл `cookies.txt` (формат Netscape).", parse_mode="Markdown")
+    def _fmt_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{n}="{self._escape(v)}"' for n, v in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
 
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{self._fmt_labels(key)} {value}")
+        return lines
 
-@dp.message(F.document & F.document.file_name.endswith(".txt"))
-async def handle_cookie_file(message: types.Message):
-    destination = COOKIES_PATH / f"cookies_{message.from_user.id}.txt"
-    file_info = await bot.get_file(message.document.file_id)
-    await bot.download_file(file_info.file_path, destination)
-    await message.answer("✅ Cookies сохранены.")
+    def snapshot(self):
+        return {",".join(k) or "_": v for k, v in self.values.items()}
 
 
-@dp.message(F.text == "⬇️ Скачать видео")
-async def prompt_video_url(message: types.Message):
-    if message.from_user.id not in ALLOWED_USERS:
-        return
-    await message.answer("Пришлите ссылку на видео.")
+class Counter(Metric):
+    kind = "counter"
 
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
 
-# ========================== #
-# 🎥 Загрузка
-# ========================== #
 
-async def download_media(
-    message: types.Message,
-    url: str,
-    user_id: int,
-    title: str,
-    *,
-    mode: str,
-    format_id: str | None = None,
-):
-    status = await message.answer("⏳ Подготовка к скачиванию...")
+class Gauge(Metric):
+    kind = "gauge"
 
-    opts = build_base_ydl_opts(user_id, skip_download=False, quiet=False)
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), fn=None):
+        super().__init__(name, help_text, labels)
+        self.fn = fn
 
-    if mode == "audio":
-        opts["format"] = "bestaudio/best"
-        opts["postprocessors"] = [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "192",
-        }]
-        emoji = "🎵"
-    else:
-        if mode == "pick" and not format_id:
-            await status.edit_text("❌ Не передан format_id.")
-            return
-        opts["format"] = get_format_string(mode, format_id)
-        emoji = "🎬" if mode in ("safe", "pick", "any") else "💎"
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
 
-    # 1) первая попытка — штатный downloader
-    try:
-        logger.info(f"Downloading url={url} mode={mode} format={opts.get('format')}")
-        info = ydl_extract(url, opts, download=True)
-    except Exception as e1:
-        logger.warning(f"Primary download failed, retry with ffmpeg downloader. err={e1}")
-
-        # 2) retry с ffmpeg downloader (часто спасает m3u8/HLS/SABR)
-        opts_ff = dict(opts)
-        opts_ff["downloader"] = "ffmpeg"
-        try:
-            info = ydl_extract(url, opts_ff, download=True)
-        except Exception as e2:
-            logger.exception(e2)
-            await status.edit_text(f"❌ Ошибка:\n`{e2}`", parse_mode="Markdown")
-            return
+    def render(self) -> list[str]:
+        if self.fn:
+            self.values[()] = self.fn()
+        return super().render()
 
-    path = find_downloaded_file(info)
-    if not path or not os.path.exists(path):
-        await status.edit_text("❌ Файл не найден после скачивания.")
-        return
+    def snapshot(self):
+        if self.fn:
+            self.values[()] = self.fn()
+        return super().snapshot()
 
-    ext = Path(path).suffix[1:] if Path(path).suffix else "bin"
-    unique = f"{hashlib.md5(title.encode()).hexdigest()[:8]}_{int(time.time())}.{ext}"
-    final = DOWNLOAD_PATH / unique
-    os.replace(path, final)
 
-    clean_title = sanitize_filename(title)
-    dlink = f"{DOWNLOAD_BASE_URL}/{quote(unique)}?filename={quote(clean_title + '.' + ext)}"
+class Histogram(Metric):
+    kind = "histogram"
 
-    await status.edit_text(
-        f"✅ {emoji} *{title}*\n\n[Скачать файл]({dlink})",
-        parse_mode="Markdown",
-        disable_web_page_preview=True,
-    )
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets or (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
 
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        self.sums[key] = self.sums.get(key, 0.0) + value
 
-# ========================== #
-# 🔗 Обработка ссылок
-# ========================== #
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, counts in self.counts.items():
+            for bound, count in zip(self.buckets, counts):
+                le = self._fmt_labels(key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {count}")
+            le = self._fmt_labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {counts[-1]}")
+            lines.append(f"{self.name}_sum{self._fmt_labels(key)} {self.sums[key]}")
+            lines.append(f"{self.name}_count{self._fmt_labels(key)} {counts[-1]}")
+        return lines
 
-@dp.message(F.text.regexp(r"https?://\S+"))
-async def handle_url(message: types.Message):
-    if message.from_user.id not in ALLOWED_USERS:
-        return
+    def snapshot(self):
+        return {
+            ",".join(k) or "_": {"count": c[-1], "sum": round(self.sums[k], 3)}
+            for k, c in self.counts.items()
+        }
 
-    purge_old_requests()
 
-    url = clean_youtube_url(message.text.strip())
-    user_id = message.from_user.id
-    status = await message.answer("🔎 Анализ ссылки...")
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list[Metric] = []
 
-    title = "Видео"
-    thumbnail_url = None
-    formats = []
+    def add(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
 
-    try:
-        opts_info = build_base_ydl_opts(user_id, skip_download=True, quiet=True)
-        # НЕ задаём format тут!
-        with yt_dlp.YoutubeDL(opts_info) as ydl:
-            info = ydl.extract_info(url, download=False)
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
 
-        title = info.get("title") or title
-        thumbnail_url = info.get("thumbnail")
-        formats = info.get("formats") or []
-    except Exception as e:
-        logger.exception(e)
+    def snapshot(self) -> dict:
+        return {m.name: m.snapshot() for m in self._metrics}
 
-    # Кнопки “всегда”
-    base_builder = InlineKeyboardBuilder()
-    base_builder.row(
-        types.InlineKeyboardButton(text="⬇️ Скачать (обычно/надёжно)", callback_data=json.dumps({"a": "d_safe"})),
-        types.InlineKeyboardButton(text="💎 Скачать в лучшем качестве", callback_data=json.dumps({"a": "d_bestq"})),
-    )
-    base_builder.row(
-        types.InlineKeyboardButton(text="🧩 Скачать (любой формат)", callback_data=json.dumps({"a": "d_any"})),
-        types.InlineKeyboardButton(text="🎵 Скачать MP3", callback_data=json.dumps({"a": "d_audio"})),
-    )
-    if thumbnail_url:
-        base_builder.row(types.InlineKeyboardButton(text="🖼️ Скачать обложку", callback_data=json.dumps({"a": "t"})))
 
-    # Попытка показать выбор качества (не режем m3u8, иначе на SABR будет пусто)
-    available: dict[str, str] = {}
-    for f in formats:
-        fid = f.get("format_id")
-        ext = (f.get("ext") or "").lower()
-        height = f.get("height")
-        vcodec = f.get("vcodec")
+def log_event(event: str, **fields):
+    """
+    Структурированное событие этапа обработки (одна JSON-строка в лог).
+    """
+    if METRICS_JSON_LOG:
+        metrics_logger.info(json.dumps({"event": event, "ts": round(time.time(), 3), **fields}, ensure_ascii=False))
 
-        if not fid:
-            continue
-        if ext == "mhtml" or "storyboard" in str(fid).lower():
-            continue
-        if not vcodec or vcodec == "none":
-            continue
-        if not height:
-            m = re.search(r"(\d{3,4})p", f.get("format", "") or "")
-            if m:
-                height = int(m.group(1))
-        if not height:
-            continue
 
-        size = f.get("filesize") or f.get("filesize_approx") or 0
-        # помечаем ext, но это может быть m3u8/ts/mp4/webm и т.п.
-        label = f"{height}p {ext}{fmt_size(size)}"
-        available[label] = fid
+metrics_logger = logging.getLogger("ytd_bot.metrics")
+metrics = MetricsRegistry()
 
-    if available:
-        qual_builder = InlineKeyboardBuilder()
-        for label, fid in sorted(
-            available.items(),
-            key=lambda x: int(re.search(r"(\d+)p", x[0]).group(1)),
-            reverse=True,
-        )[:12]:  # не раздуваем клаву
-            qual_builder.button(text=f"🎬 {label}", callback_data=json.dumps({"a": "pick", "f": fid}))
-        qual_builder.adjust(2)
+M_PROBE_SECONDS = metrics.add(Histogram("ytd_probe_seconds", "Время анализа ссылки (extract_info)", ("result",)))
+M_QUEUE_WAIT = metrics.add(Histogram("ytd_queue_wait_seconds", "Время ожидания задачи в очереди", ("mode",)))
+M_DOWNLOAD_SECONDS = metrics.add(Histogram("ytd_download_seconds", "Длительность скачивания", ("mode",)))
+M_DOWNLOAD_BYTES = metrics.add(Counter("ytd_download_bytes_total", "Размер скачанных файлов", ("mode",)))
+M_JOBS = metrics.add(Counter("ytd_jobs_total", "Завершённые задачи", ("mode", "result")))
+M_ATTEMPTS = metrics.add(Counter("ytd_download_attempts_total", "Попытки скачивания по downloader", ("downloader", "result")))
+M_POSTPROCESS = metrics.add(Histogram("ytd_postprocess_seconds", "Время постобработки (mp3, склейка)", ("postprocessor",)))
+M_CACHE = metrics.add(Counter("ytd_cache_requests_total", "Обращения к кэшам", ("cache", "result")))
+M_DISK_USED = metrics.add(Gauge("ytd_disk_used_bytes", "Занято файлами бота в DOWNLOAD_PATH", fn=lambda: storage.used()))
+M_DISK_FREE = metrics.add(Gauge("ytd_disk_free_bytes", "Свободно на диске DOWNLOAD_PATH", fn=lambda: shutil.disk_usage(DOWNLOAD_PATH).free))
+M_TRANSFER = metrics.add(Counter("ytd_transfer_bytes_total", "Байт получено по хукам прогресса"))
+M_SPEED = metrics.add(Gauge("ytd_transfer_speed_bytes", "Текущая суммарная скорость скачивания", fn=lambda: progress.current_speed))
+M_QUEUE = metrics.add(Gauge("ytd_queue_length", "Задач в очереди", fn=lambda: len(scheduler.order())))
+M_ACTIVE = metrics.add(Gauge("ytd_active_downloads", "Скачиваний в работе", fn=lambda: executor.active_downloads))
+M_COOKIE_READY = metrics.add(Gauge("ytd_cookie_profiles_ready", "Профилей пула cookies не на паузе", fn=lambda: cookie_pool.ready()))
+M_COOKIE_COOLDOWNS = metrics.add(Counter("ytd_cookie_cooldowns_total", "Паузы профилей пула cookies", ("profile",)))
 
-        for row in base_builder.export():
-            qual_builder.row(*row)
 
-        kb = qual_builder.as_markup()
-        text = f"*{title}*\n\nВыберите качество или используйте режимы скачивания:"
-    else:
-        kb = base_builder.as_markup()
-        text = f"*{title}*\n\nФорматы показать не удалось. Используйте режимы скачивания:"
+def observe_cache(cache: str, hit: bool):
+    M_CACHE.inc(cache=cache, result="hit" if hit else "miss")
 
-    msg = await status.edit_text(text, reply_markup=kb, parse_mode="Markdown")
 
-    active_url_requests[msg.message_id] = {
-        "url": url,
-        "timestamp": datetime.datetime.now(datetime.timezone.utc),
-        "title": title,
-        "thumbnail_url": thumbnail_url,
-    }
+async def metrics_log_loop(interval: float = 60):
+    while True:
+        await asyncio.sleep(interval)
+        log_event("metrics", **metrics.snapshot())
 
 
 # ========================== #
-# 🎛 Кнопки
+# ⚙️ Исполнитель yt-dlp
 # ========================== #
 
-@dp.callback_query(F.data.startswith("{"))
-async def handle_callback(query: types.CallbackQuery):
-    try:
-        data = json.loads(query.data)
-        user_id = query.from_user.id
-        msg_id = query.message.message_id
-
-        req = active_url_requests.get(msg_id)
-        if not req:
-            await query.answer("Запрос устарел.", show_alert=True)
-            return
+class DownloadExecutor:
+    """
+    Блокирующая работа yt-dlp уходит в пул потоков/процессов, чтобы не
+    замораживать event loop. Анализ ссылок и скачивания идут в разных
+    "полосах": долгие загрузки не задерживают показ меню.
+    """
 
-        url = req["url"]
-        title = req["title"]
-        thumb = req.get("thumbnail_url")
+    def __init__(self, *, workers: int, probe_workers: int, per_user: int, kind: str):
+        pool_size = workers + probe_workers
+        if kind == "process":
+            self._pool = ProcessPoolExecutor(max_workers=pool_size)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="ytdl")
+        self.kind = kind
+        self.workers = workers
+        self._downloads = asyncio.Semaphore(workers)
+        self._probes = asyncio.Semaphore(probe_workers)
+        self._per_user_limit = per_user
+        self._per_user: dict[int, asyncio.Semaphore] = {}
+        self.active_downloads = 0
 
-        action = data.get("a")
+    def _user_slot(self, user_id: int) -> asyncio.Semaphore:
+        sem = self._per_user.get(user_id)
+        if sem is None:
+            sem = asyncio.Semaphore(self._per_user_limit)
+            self._per_user[user_id] = sem
+        return sem
 
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
         try:
-            await query.message.edit_reply_markup(reply_markup=None)
-        except Exception:
-            pass
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # отмена задачи поток не останавливает: ждём, пока работа выйдет
+            # сама (скачивание прерывает хук прогресса), иначе слот и аренда
+            # освободились бы, пока поток ещё пишет в .part-файлы
+            await asyncio.wait([fut])
+            if not fut.cancelled():
+                fut.exception()  # DownloadCancelled из хука — ожидаемый исход
+            raise
 
-        if action == "pick":
-            await query.answer("🚀 Скачиваю выбранное качество...")
-            await download_media(query.message, url, user_id, title, mode="pick", format_id=data.get("f"))
+    async def probe(self, fn, *args, **kwargs):
+        async with self._probes:
+            return await self._run(fn, *args, **kwargs)
 
-        elif action == "d_safe":
-            await query.answer("⬇️ Скачиваю (надёжно)...")
-            await download_media(query.message, url, user_id, title, mode="safe")
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: int | None = None):
+        """
+        Слот скачивания: лимит пользователя (если user_id задан) и общий.
+        Отдельно от пула — для загрузок, которые ведёт ffmpeg сам.
+        """
+        async with self._user_slot(user_id) if user_id is not None else contextlib.nullcontext():
+            async with self._downloads:
+                self.active_downloads += 1
+                try:
+                    yield
+                finally:
+                    self.active_downloads -= 1
 
-        elif action == "d_bestq":
-            await query.answer("💎 Скачиваю (лучшее качество)...")
-            await download_media(query.message, url, user_id, title, mode="bestq")
+    async def download(self, user_id: int, fn, *args, **kwargs):
+        async with self.slot(user_id):
+            return await self._run(fn, *args, **kwargs)
 
-        elif action == "d_any":
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+executor = DownloadExecutor(
+    workers=DOWNLOAD_WORKERS,
+    probe_workers=PROBE_WORKERS,
+    per_user=PER_USER_DOWNLOADS,
+    kind=EXECUTOR_KIND,
+)
+
+
+
+# ========================== #
+# 📐 Форматы
+# ========================== #
+
+CODEC_NAMES = {
+    "avc1": "h264", "avc3": "h264", "h264": "h264",
+    "hev1": "h265", "hvc1": "h265", "h265": "h265",
+    "vp09": "vp9", "vp9": "vp9", "vp8": "vp8",
+    "av01": "av1",
+}
+
+# видео → аудио, с которым оно склеивается без смены контейнера
+PAIRED_AUDIO_EXT = {"mp4": "m4a", "webm": "webm"}
+
+
+def codec_name(codec: str | None) -> str:
+    if not codec or codec == "none":
+        return ""
+    family = codec.split(".")[0].lower()
+    return CODEC_NAMES.get(family, family)
+
+
+@dataclass(slots=True)
+class FormatEntry:
+    format_id: str
+    ext: str
+    height: int
+    fps: float
+    vcodec: str
+    acodec: str
+    tbr: float
+    protocol: str
+    size: int
+
+    @property
+    def has_video(self) -> bool:
+        return bool(self.vcodec)
+
+    @property
+    def has_audio(self) -> bool:
+        return bool(self.acodec)
+
+    @property
+    def fragmented(self) -> bool:
+        return is_fragmented(self.protocol)
+
+
+class FormatIndex:
+    """
+    Форматы одного анализа, разобранные один раз: высота, fps, кодеки,
+    битрейт, протокол и оценка размера (если сайт размер не отдал —
+    по битрейту и длительности). Видео без звука считается вместе
+    с аудио, которое к нему приклеится. По индексу строятся кнопки
+    качества, режимы «лучшее до N МБ» и «быстрее всего» и оценки для очереди.
+    Индекс компактно сериализуется в данные меню (dump/load).
+    """
+
+    # «быстрее всего» не значит 4K: выше этой высоты не берём, если есть из чего выбрать
+    FAST_MAX_HEIGHT = 720
+
+    def __init__(self, entries: list[FormatEntry], default_protocol: str = "https"):
+        self.entries = entries
+        self.default_protocol = default_protocol
+        self._by_id = {e.format_id: e for e in entries}
+        audio = [e for e in entries if e.has_audio and not e.has_video]
+        self.audio = sorted(audio, key=lambda e: (e.tbr, e.size), reverse=True)
+
+    @classmethod
+    def from_info(cls, info: dict) -> "FormatIndex":
+        duration = info.get("duration") or 0
+        entries = []
+        for f in info.get("formats") or []:
+            fid = f.get("format_id")
+            ext = (f.get("ext") or "").lower()
+            if not fid or ext == "mhtml" or "storyboard" in str(fid).lower():
+                continue
+            vcodec = f.get("vcodec") if f.get("vcodec") not in (None, "none") else ""
+            acodec = f.get("acodec") if f.get("acodec") not in (None, "none") else ""
+            height = f.get("height") or 0
+            if vcodec and not height:
+                m = re.search(r"(\d{3,4})p", f.get("format", "") or "")
+                height = int(m.group(1)) if m else 0
+            tbr = float(f.get("tbr") or 0)
+            size = f.get("filesize") or f.get("filesize_approx") or 0
+            if not size and tbr and duration:
+                size = tbr * 125 * duration
+            entries.append(FormatEntry(
+                format_id=str(fid),
+                ext=ext,
+                height=int(height),
+                fps=float(f.get("fps") or 0),
+                vcodec=vcodec or "",
+                acodec=acodec or "",
+                tbr=tbr,
+                protocol=f.get("protocol") or "https",
+                size=int(size),
+            ))
+        return cls(entries, info.get("protocol") or "https")
+
+    def dump(self) -> list:
+        return [
+            [e.format_id, e.ext, e.height, e.fps, e.vcodec, e.acodec, e.tbr, e.protocol, e.size]
+            for e in self.entries
+        ]
+
+    @classmethod
+    def load(cls, rows: list) -> "FormatIndex":
+        return cls([FormatEntry(*row) for row in rows])
+
+    def audio_for(self, video: FormatEntry) -> FormatEntry | None:
+        want = PAIRED_AUDIO_EXT.get(video.ext)
+        return next((a for a in self.audio if a.ext == want), None) or (self.audio[0] if self.audio else None)
+
+    def total(self, entry: FormatEntry) -> int:
+        """
+        Размер результата: видео без звука — вместе с парным аудио.
+        0 — размер неизвестен.
+        """
+        if entry.has_audio or not entry.has_video:
+            return entry.size
+        audio = self.audio_for(entry)
+        if not entry.size or (audio and not audio.size):
+            return 0
+        return entry.size + (audio.size if audio else 0)
+
+    def selector(self, entry: FormatEntry) -> str:
+        audio = None if entry.has_audio else self.audio_for(entry)
+        return f"{entry.format_id}+{audio.format_id}" if audio else entry.format_id
+
+    def videos(self) -> list[FormatEntry]:
+        return [e for e in self.entries if e.has_video and e.height]
+
+    def label(self, entry: FormatEntry) -> str:
+        fps = f"{entry.fps:.0f}" if entry.fps > 30 else ""
+        codec = codec_name(entry.vcodec)
+        return f"{entry.height}p{fps} {codec} {entry.ext}{fmt_size(self.total(entry))}".replace("  ", " ")
+
+    def choices(self, limit: int = 12) -> list[FormatEntry]:
+        """
+        Варианты для кнопок. Разные кодеки и fps одной высоты — разные
+        кнопки; из одинаковых (например, https и HLS) остаётся тот, что
+        без фрагментов и с большим битрейтом.
+        """
+        best: dict[tuple, FormatEntry] = {}
+        for e in self.videos():
+            key = (e.height, round(e.fps) > 30, codec_name(e.vcodec), e.ext)
+            cur = best.get(key)
+            if cur is None or (cur.fragmented, -cur.tbr) > (e.fragmented, -e.tbr):
+                best[key] = e
+        ordered = sorted(best.values(), key=lambda e: (-e.height, -e.fps, e.fragmented, self.total(e) or 0))
+        return ordered[:limit]
+
+    def best_under(self, limit: int) -> FormatEntry | None:
+        """
+        Лучшее качество, которое точно помещается в limit байт.
+        Форматы без известного размера не рассматриваются.
+        """
+        fits = [e for e in self.videos() if 0 < self.total(e) <= limit]
+        if not fits:
+            return None
+        return max(fits, key=lambda e: (e.height, e.fps, e.has_audio, not e.fragmented, e.tbr))
+
+    def fastest(self) -> FormatEntry | None:
+        """
+        Быстрее всего доставить: один файл по HTTP (без фрагментов
+        и склейки), mp4 без перепаковки, не выше FAST_MAX_HEIGHT.
+        """
+        videos = self.videos()
+        if not videos:
+            return None
+        return min(
+            videos,
+            key=lambda e: (
+                e.fragmented,
+                not e.has_audio,
+                e.height > self.FAST_MAX_HEIGHT,
+                e.ext != "mp4",
+                -e.height,
+                self.total(e) or float("inf"),
+            ),
+        )
+
+    def _parts(self, format_id: str | None) -> list[FormatEntry]:
+        return [self._by_id[fid] for fid in (format_id or "").split("+") if fid in self._by_id]
+
+    def _mode_entries(self, mode: str, format_id: str | None) -> list[FormatEntry]:
+        """
+        Форматы, которые скорее всего скачает режим.
+        """
+        if mode in ("fit", "fast"):
+            return self._parts(format_id)
+        if mode == "pick":
+            picked = self._parts(format_id)[:1]
+            if picked and not picked[0].has_audio and self.audio:
+                picked.append(self.audio_for(picked[0]))
+            return picked
+        if mode in AUDIO_MODES:
+            return self.audio[:1]
+        if mode == "shrink":
+            video = [e for e in self.videos() if e.height <= SHRINK_MAX_HEIGHT]
+            if video:
+                top = max(video, key=lambda e: (e.height, e.tbr))
+                return [top] + ([self.audio_for(top)] if not top.has_audio and self.audio else [])
+            return []
+        if mode == "bestq":
+            video = [e for e in self.entries if e.has_video and not e.has_audio]
+            if video:
+                top = max(video, key=lambda e: (e.height, e.tbr))
+                return [top] + ([self.audio_for(top)] if self.audio else [])
+        muxed = [e for e in self.entries if e.has_video and e.has_audio]
+        return [max(muxed, key=lambda e: (e.height, e.tbr))] if muxed else []
+
+    def protocol(self, mode: str, format_id: str | None) -> str:
+        parts = self._mode_entries(mode, format_id) or self.entries[-1:]
+        return parts[0].protocol if parts else self.default_protocol
+
+    def estimate(self, mode: str, format_id: str | None) -> int:
+        """
+        Оценка размера результата для очереди и резерва места; 0 — неизвестно.
+        """
+        parts = self._mode_entries(mode, format_id)
+        if not parts or not all(p.size for p in parts):
+            return 0
+        return sum(p.size for p in parts)
+
+
+# ========================== #
+# 🚦 Параметры передачи
+# ========================== #
+
+FRAGMENTED_PROTOCOLS = ("m3u8", "dash", "ism", "f4m")
+THROTTLE_MARKERS = ("HTTP Error 403", "HTTP Error 429", "Too Many Requests", "throttl")
+
+
+def is_fragmented(protocol: str) -> bool:
+    # подстрокой: у yt-dlp есть и http_dash_segments, и m3u8_native
+    return any(p in protocol for p in FRAGMENTED_PROTOCOLS)
+
+
+def guess_protocol(index: "FormatIndex | None", mode: str, format_id: str | None) -> str:
+    """
+    Протокол формата, который скорее всего выберет yt-dlp для режима.
+    Точный выбор делает сам yt-dlp, нам достаточно понять: фрагменты или нет.
+    """
+    return index.protocol(mode, format_id) if index else "https"
+
+
+class TransferTuner:
+    """
+    Подбирает concurrent_fragment_downloads и http_chunk_size под задачу:
+    фрагментированные протоколы качаем в несколько потоков, общий бюджет
+    делим между активными задачами. На 403/429 по сайту — сбавляем обороты
+    на THROTTLE_COOLDOWN секунд.
+    """
+
+    BASE_CHUNK = 10 * 1024 * 1024
+    MIN_CHUNK = 2 * 1024 * 1024
+
+    def __init__(self, max_fragments: int):
+        self.max_fragments = max_fragments
+        self._backoff: dict[str, tuple[int, float]] = {}
+
+    def _level(self, site: str) -> int:
+        level, since = self._backoff.get(site, (0, 0.0))
+        if level and time.time() - since > THROTTLE_COOLDOWN:
+            # остываем постепенно: по одному шагу за интервал
+            level -= 1
+            self._backoff[site] = (level, time.time())
+        return level
+
+    def params(self, site: str, protocol: str, active_jobs: int) -> dict:
+        level = self._level(site)
+        chunk = max(self.MIN_CHUNK, self.BASE_CHUNK >> level)
+        if not is_fragmented(protocol):
+            return {"concurrent_fragment_downloads": 1, "http_chunk_size": chunk}
+        share = max(1, self.max_fragments // max(1, active_jobs))
+        return {"concurrent_fragment_downloads": max(1, share >> level), "http_chunk_size": chunk}
+
+    def report(self, site: str, error: str | None):
+        if not error or not any(m.lower() in error.lower() for m in THROTTLE_MARKERS):
+            return
+        level = min(3, self._level(site) + 1)
+        self._backoff[site] = (level, time.time())
+        logger.warning(f"Throttling detected site={site}, backoff level={level}")
+
+
+def site_of(url: str, info: dict | None) -> str:
+    return (info or {}).get("extractor_key") or urlparse(url).netloc.lower()
+
+
+tuner = TransferTuner(FRAGMENT_CONCURRENCY_MAX)
+
+
+@dataclass(slots=True)
+class PathStats:
+    ok: int = 0
+    fail: int = 0
+    streak: int = 0  # неудач подряд
+    speed: float = 0.0  # EWMA, байт/с
+    opened_at: float = 0.0
+
+
+class StrategyEngine:
+    """
+    Какой downloader пробовать первым для (сайт, протокол, тип формата).
+    Оценка пути — доля успехов со сглаживанием × скорость: первым идёт
+    лучший с полным бюджетом ретраев, остальные — запасными с FAST_FAIL.
+    После STRATEGY_BREAKER_FAILS неудач подряд путь выключается
+    (предохранитель), по истечении STRATEGY_BREAKER_COOLDOWN получает одну
+    пробную попытку. Статистика хранится в SQLite и переживает перезапуск;
+    решения берутся из памяти, запись в файл уходит в поток кэша.
+    """
+
+    def __init__(self, db: "CacheDb"):
+        self.db = db
+        db.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS strategies (
+                key TEXT NOT NULL,
+                downloader TEXT NOT NULL,
+                ok INTEGER NOT NULL,
+                fail INTEGER NOT NULL,
+                streak INTEGER NOT NULL,
+                speed REAL NOT NULL,
+                opened_at REAL NOT NULL,
+                PRIMARY KEY (key, downloader)
+            )
+            """
+        )
+        db.conn.commit()
+        self._stats: dict[tuple[str, str], PathStats] = {
+            (key, downloader): PathStats(ok, fail, streak, speed, opened_at)
+            for key, downloader, ok, fail, streak, speed, opened_at in db.conn.execute(
+                "SELECT key, downloader, ok, fail, streak, speed, opened_at FROM strategies"
+            )
+        }
+
+    @staticmethod
+    def key(site: str, protocol: str, mode: str) -> str:
+        kind = "audio" if mode in AUDIO_MODES else "video"
+        return f"{site}|{protocol}|{kind}"
+
+    def _get(self, key: str, downloader: str) -> PathStats:
+        return self._stats.setdefault((key, downloader), PathStats())
+
+    @staticmethod
+    def _state(s: PathStats) -> str:
+        if s.streak < STRATEGY_BREAKER_FAILS:
+            return "closed"
+        if time.time() - s.opened_at < STRATEGY_BREAKER_COOLDOWN:
+            return "open"
+        return "half-open"
+
+    @staticmethod
+    def _score(s: PathStats) -> float:
+        success = (s.ok + 1) / (s.ok + s.fail + 2)
+        return success * (s.speed or DEFAULT_WORKER_SPEED)
+
+    def plan(self, key: str) -> tuple[tuple[str, bool], ...]:
+        # sorted устойчив: без статистики порядок как в DOWNLOADERS
+        ranked = sorted(DOWNLOADERS, key=lambda d: -self._score(self._get(key, d)))
+        usable = [d for d in ranked if self._state(self._get(key, d)) != "open"] or ranked[:1]
+        best = usable[0]
+        if len(usable) > 1 and random.random() < STRATEGY_EXPLORE:
+            usable[0], usable[1] = usable[1], usable[0]
+        return tuple(
+            (d, d != best or self._state(self._get(key, d)) == "half-open")
+            for d in usable
+        )
+
+    def report(self, key: str, attempts: list, size: int = 0):
+        # если не удалось ничем, скорее всего дело в самом видео (удалено,
+        # приватное), а не в downloader: предохранители не трогаем
+        any_ok = any(error is None for _, error, _ in attempts)
+        rows = []
+        for downloader, error, seconds in attempts:
+            s = self._get(key, downloader)
+            if error is None:
+                s.ok += 1
+                s.streak = 0
+                s.opened_at = 0.0
+                if size and seconds > 0:
+                    speed = size / seconds
+                    s.speed = speed if not s.speed else 0.7 * s.speed + 0.3 * speed
+            else:
+                s.fail += 1
+                if any_ok:
+                    s.streak += 1
+                    if s.streak >= STRATEGY_BREAKER_FAILS:
+                        s.opened_at = time.time()
+                        logger.warning(f"Downloader {downloader} disabled for {key} after {s.streak} failures")
+            rows.append((key, downloader, s.ok, s.fail, s.streak, s.speed, s.opened_at))
+        if rows:
+            self.db.post(self._save, rows)
+
+    @staticmethod
+    def _save(conn: sqlite3.Connection, rows: list[tuple]):
+        conn.executemany(
+            "INSERT OR REPLACE INTO strategies (key, downloader, ok, fail, streak, speed, opened_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.commit()
+
+
+# ========================== #
+# 🔍 Кэш анализа ссылок
+# ========================== #
+
+def normalize_url(url: str) -> str:
+    parsed = urlparse(url.strip())
+    return urlunparse(parsed._replace(netloc=parsed.netloc.lower(), fragment=""))
+
+
+def cookie_identity(cookie_file: str | Path | None) -> str:
+    if not cookie_file:
+        return "anon"
+    cookie_file = Path(cookie_file)
+    try:
+        return f"{cookie_file.parent.name}/{cookie_file.name}:{cookie_file.stat().st_mtime_ns}"
+    except OSError:
+        return "anon"
+
+
+class ProbeCache:
+    """
+    LRU-кэш результатов extract_info(download=False) с TTL.
+    Ключ — нормализованный URL + "личность" cookies, с которыми шёл запрос
+    (свой файл пользователя или профиль пула, и его mtime): ответ, полученный
+    под одним аккаунтом, не отдаётся запросам под другим, а после загрузки
+    новых cookies ссылка анализируется заново.
+    При PROBE_CACHE_DISK=1 записи дублируются на диск и переживают перезапуск.
+    """
+
+    def __init__(self, *, ttl: int, max_entries: int, disk_path: Path | None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        self._items: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._indexes: dict[str, FormatIndex] = {}
+        if disk_path:
+            disk_path.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(url: str, cookie_file: str | Path | None) -> str:
+        raw = f"{normalize_url(url)}|{cookie_identity(cookie_file)}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, url: str, cookie_file: str | Path | None) -> dict | None:
+        key = self.key(url, cookie_file)
+        item = self._items.get(key)
+        if item is None:
+            item = self._load(key)
+        if item is None:
+            return None
+        stored_at, info = item
+        if time.time() - stored_at > self.ttl:
+            self._drop(key)
+            return None
+        self._items[key] = item
+        self._items.move_to_end(key)
+        return info
+
+    def formats(self, url: str, cookie_file: str | Path | None) -> FormatIndex | None:
+        """
+        Индекс форматов записи: строится один раз на анализ.
+        """
+        info = self.get(url, cookie_file)
+        if info is None:
+            return None
+        key = self.key(url, cookie_file)
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = FormatIndex.from_info(info)
+        return index
+
+    def put(self, url: str, cookie_file: str | Path | None, info: dict):
+        key = self.key(url, cookie_file)
+        item = (time.time(), info)
+        self._items[key] = item
+        self._items.move_to_end(key)
+        self._indexes.pop(key, None)
+        while len(self._items) > self.max_entries:
+            old, _ = self._items.popitem(last=False)
+            self._indexes.pop(old, None)
+        if self.disk_path:
+            try:
+                (self.disk_path / f"{key}.json").write_text(
+                    json.dumps({"stored_at": item[0], "info": info}, ensure_ascii=False),
+                    encoding="utf-8",
+                )
+            except (OSError, TypeError, ValueError) as e:
+                logger.warning(f"Probe cache disk write failed: {e}")
+
+    def _load(self, key: str) -> tuple[float, dict] | None:
+        if not self.disk_path:
+            return None
+        path = self.disk_path / f"{key}.json"
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            return data["stored_at"], data["info"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            path.unlink(missing_ok=True)
+            return None
+
+    def _drop(self, key: str):
+        self._items.pop(key, None)
+        self._indexes.pop(key, None)
+        if self.disk_path:
+            (self.disk_path / f"{key}.json").unlink(missing_ok=True)
+
+    def purge_disk(self):
+        if not self.disk_path:
+            return
+        deadline = time.time() - self.ttl
+        for path in self.disk_path.glob("*.json"):
+            try:
+                if path.stat().st_mtime < deadline:
+                    path.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+
+probe_cache = ProbeCache(
+    ttl=PROBE_CACHE_TTL,
+    max_entries=PROBE_CACHE_SIZE,
+    disk_path=DATA_PATH / "probe" if PROBE_CACHE_DISK else None,
+)
+
+
+# ========================== #
+# 🗃 Кэш файлов
+# ========================== #
+
+class CacheDb:
+    """
+    cache.sqlite3 — общий для процессов на машине файл кэшей. Как и у
+    LocalState, запросы идут в отдельном потоке по одному: ожидание
+    блокировки файла другим процессом не останавливает event loop.
+    """
+
+    def __init__(self, path: Path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache")
+
+    async def call(self, fn, *args):
+        """
+        fn(conn, *args) в потоке кэша; результат — в event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io, fn, self.conn, *args)
+
+    def post(self, fn, *args):
+        """
+        Запись, результата которой не ждём (из синхронного кода).
+        """
+        fut = self._io.submit(fn, self.conn, *args)
+        fut.add_done_callback(lambda f: f.exception() and logger.warning(f"Cache write failed: {f.exception()}"))
+
+
+class DownloadCache:
+    """
+    Кэш готовых файлов по ключу (extractor, id видео, формат/постпроцессоры).
+    При превышении бюджета по диску удаляются давно не запрошенные файлы;
+    одинаковые одновременные запросы склеивает очередь (Scheduler.submit).
+    """
+
+    def __init__(self, db: CacheDb, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.db = db
+        db.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                key TEXT PRIMARY KEY,
+                file_name TEXT NOT NULL,
+                ext TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        db.conn.commit()
+
+    @staticmethod
+    def _get(conn: sqlite3.Connection, key: str) -> tuple[str, str] | None:
+        row = conn.execute("SELECT file_name, ext FROM files WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        if not (DOWNLOAD_PATH / row[0]).exists():
+            # файл уже удалён (cron/ручная чистка) — забываем запись
+            conn.execute("DELETE FROM files WHERE key = ?", (key,))
+            conn.commit()
+            return None
+        conn.execute("UPDATE files SET last_access = ? WHERE key = ?", (time.time(), key))
+        conn.commit()
+        return row[0], row[1]
+
+    async def get(self, key: str | None) -> tuple[str, str] | None:
+        if not key:
+            return None
+        found = await self.db.call(self._get, key)
+        if found:
+            storage.touch(found[0])
+        return found
+
+    @staticmethod
+    def _put(conn: sqlite3.Connection, key: str, file_name: str, ext: str, size: int) -> list:
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO files (key, file_name, ext, size, created_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, file_name, ext, size, now, now),
+        )
+        conn.commit()
+        return conn.execute("SELECT key, file_name, size FROM files ORDER BY last_access DESC").fetchall()
+
+    @staticmethod
+    def _forget(conn: sqlite3.Connection, keys: list[str]):
+        conn.executemany("DELETE FROM files WHERE key = ?", [(k,) for k in keys])
+        conn.commit()
+
+    async def put(self, key: str, file_name: str, ext: str, size: int):
+        rows = await self.db.call(self._put, key, file_name, ext, size)
+        # вытеснение по бюджету: решаем здесь, storage живёт в event loop
+        total = 0
+        evicted = []
+        for row_key, row_file, row_size in rows:
+            total += row_size
+            if total <= self.max_bytes or storage.busy(row_file):
+                continue
+            storage.delete(row_file)
+            evicted.append(row_key)
+            logger.info(f"Cache evicted {row_file} ({row_size} bytes)")
+        if evicted:
+            await self.db.call(self._forget, evicted)
+
+    @staticmethod
+    def _touch(conn: sqlite3.Connection, file_name: str):
+        conn.execute("UPDATE files SET last_access = ? WHERE file_name = ?", (time.time(), file_name))
+        conn.commit()
+
+    async def touch_file(self, file_name: str):
+        """
+        Файл реально отдали по ссылке — продлеваем ему жизнь в LRU.
+        """
+        await self.db.call(self._touch, file_name)
+
+    @staticmethod
+    def _drop(conn: sqlite3.Connection, file_name: str):
+        conn.execute("DELETE FROM files WHERE file_name = ?", (file_name,))
+        conn.commit()
+
+    def drop_file(self, file_name: str):
+        # зовётся из синхронной чистки диска — запись уходит в поток кэша
+        self.db.post(self._drop, file_name)
+
+
+class TelegramFileIndex:
+    """
+    file_id файлов, уже загруженных в Telegram, по тому же ключу, что и
+    кэш файлов. Повторная отправка идёт по file_id: без скачивания,
+    без диска и без повторной загрузки в Telegram.
+    """
+
+    def __init__(self, db: CacheDb):
+        self.db = db
+        db.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tg_files (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        db.conn.commit()
+
+    @staticmethod
+    def _get(conn: sqlite3.Connection, key: str):
+        return conn.execute("SELECT kind, file_id FROM tg_files WHERE key = ?", (key,)).fetchone()
+
+    @staticmethod
+    def _put(conn: sqlite3.Connection, key: str, kind: str, file_id: str):
+        conn.execute(
+            "INSERT OR REPLACE INTO tg_files (key, kind, file_id, created_at) VALUES (?, ?, ?, ?)",
+            (key, kind, file_id, time.time()),
+        )
+        conn.commit()
+
+    @staticmethod
+    def _forget(conn: sqlite3.Connection, key: str):
+        conn.execute("DELETE FROM tg_files WHERE key = ?", (key,))
+        conn.commit()
+
+    async def get(self, key: str | None) -> tuple[str, str] | None:
+        if not key:
+            return None
+        row = await self.db.call(self._get, key)
+        return (row[0], row[1]) if row else None
+
+    async def put(self, key: str, kind: str, file_id: str):
+        await self.db.call(self._put, key, kind, file_id)
+
+    async def forget(self, key: str):
+        await self.db.call(self._forget, key)
+
+
+cache_db = CacheDb(DATA_PATH / "cache.sqlite3")
+download_cache = DownloadCache(cache_db, CACHE_MAX_BYTES)
+tg_files = TelegramFileIndex(cache_db)
+strategies = StrategyEngine(cache_db)
+
+
+# ========================== #
+# 🌍 Общее состояние
+# ========================== #
+
+class LocalState:
+    """
+    Общее состояние в SQLite-файле (WAL): несколько процессов на одной
+    машине видят одни и те же меню, очередь и пользователей.
+    Аренда (lease) — запись с владельцем и сроком: взять можно свободную,
+    просроченную или уже свою (тогда срок продлевается).
+    Запросы идут в отдельном потоке по одному: ожидание блокировки файла
+    другим процессом (до timeout) не останавливает event loop.
+    """
+
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path: Path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS kv (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires REAL
+            );
+            CREATE TABLE IF NOT EXISTS sets (
+                key TEXT NOT NULL,
+                member TEXT NOT NULL,
+                PRIMARY KEY (key, member)
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS queue (
+                name TEXT NOT NULL,
+                id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (name, id)
+            );
+            """
+        )
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        self._purged = 0.0
+
+    def _exec(self, sql: str, params: tuple, fetch: str | None):
+        cur = self._db.execute(sql, params)
+        if fetch == "one":
+            return cur.fetchone()
+        if fetch == "all":
+            return cur.fetchall()
+        return cur.rowcount
+
+    async def _sql(self, sql: str, params: tuple = (), fetch: str | None = None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io, self._exec, sql, params, fetch)
+
+    async def _maybe_purge(self):
+        now = time.time()
+        if now - self._purged < self.PURGE_INTERVAL:
+            return
+        self._purged = now
+        await self._sql("DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?", (now,))
+        await self._sql("DELETE FROM leases WHERE expires <= ?", (now,))
+
+    async def get(self, key: str) -> str | None:
+        row = await self._sql(
+            "SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time()), "one"
+        )
+        return row[0] if row else None
+
+    async def set(self, key: str, value: str, ttl: float | None = None):
+        await self._sql(
+            "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl else None),
+        )
+        await self._maybe_purge()
+
+    async def delete(self, key: str):
+        await self._sql("DELETE FROM kv WHERE key = ?", (key,))
+
+    async def incr(self, key: str) -> int:
+        row = await self._sql(
+            """
+            INSERT INTO kv (key, value) VALUES (?, '1')
+            ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+            RETURNING value
+            """,
+            (key,),
+            "one",
+        )
+        return int(row[0])
+
+    async def sadd(self, key: str, member: str):
+        await self._sql("INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)", (key, member))
+
+    async def sismember(self, key: str, member: str) -> bool:
+        row = await self._sql("SELECT 1 FROM sets WHERE key = ? AND member = ?", (key, member), "one")
+        return row is not None
+
+    async def smembers(self, key: str) -> "set[str]":
+        return {row[0] for row in await self._sql("SELECT member FROM sets WHERE key = ?", (key,), "all")}
+
+    async def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        changed = await self._sql(
+            """
+            INSERT INTO leases (key, owner, expires) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+            WHERE leases.owner = excluded.owner OR leases.expires <= ?
+            """,
+            (key, owner, now + ttl, now),
+        )
+        return changed > 0
+
+    async def release(self, key: str, owner: str):
+        await self._sql("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+    async def owned(self, prefix: str, owner: str) -> list[str]:
+        rows = await self._sql(
+            "SELECT key FROM leases WHERE owner = ? AND expires > ? AND substr(key, 1, ?) = ?",
+            (owner, time.time(), len(prefix), prefix),
+            "all",
+        )
+        return [row[0] for row in rows]
+
+    async def push(self, name: str, item_id: str, payload: str):
+        await self._sql("INSERT OR REPLACE INTO queue (name, id, payload) VALUES (?, ?, ?)", (name, item_id, payload))
+
+    async def remove(self, name: str, item_id: str):
+        await self._sql("DELETE FROM queue WHERE name = ? AND id = ?", (name, item_id))
+        await self._sql("DELETE FROM leases WHERE key = ?", (f"{name}:{item_id}",))
+
+    async def items(self, name: str) -> list[tuple[str, str]]:
+        return await self._sql("SELECT id, payload FROM queue WHERE name = ?", (name,), "all")
+
+    async def queued(self, name: str) -> list[tuple[str, str]]:
+        """
+        Элементы очереди, которые сейчас никто не держит.
+        """
+        return await self._sql(
+            """
+            SELECT q.id, q.payload FROM queue q
+            LEFT JOIN leases l ON l.key = q.name || ':' || q.id AND l.expires > ?
+            WHERE q.name = ? AND l.key IS NULL
+            """,
+            (time.time(), name),
+            "all",
+        )
+
+
+class RedisState:
+    """
+    То же поверх Redis (или совместимого сервера) — для экземпляров
+    на разных машинах. Нужен пакет redis (асинхронный клиент redis.asyncio).
+    """
+
+    ACQUIRE = """
+    local owner = redis.call('GET', KEYS[1])
+    if not owner or owner == ARGV[1] then
+        redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+        return 1
+    end
+    return 0
+    """
+
+    RELEASE = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, url: str, prefix: str = "ytd:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("REDIS_URL is set but the redis package is not installed") from e
+        self._r = redis.Redis.from_url(url, decode_responses=True)
+        self._acquire = self._r.register_script(self.ACQUIRE)
+        self._release = self._r.register_script(self.RELEASE)
+        self.prefix = prefix
+
+    def _lease(self, key: str) -> str:
+        return f"{self.prefix}lease:{key}"
+
+    async def get(self, key: str) -> str | None:
+        return await self._r.get(self.prefix + key)
+
+    async def set(self, key: str, value: str, ttl: float | None = None):
+        await self._r.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def delete(self, key: str):
+        await self._r.delete(self.prefix + key)
+
+    async def incr(self, key: str) -> int:
+        return int(await self._r.incr(self.prefix + key))
+
+    async def sadd(self, key: str, member: str):
+        await self._r.sadd(self.prefix + key, member)
+
+    async def sismember(self, key: str, member: str) -> bool:
+        return bool(await self._r.sismember(self.prefix + key, member))
+
+    async def smembers(self, key: str) -> "set[str]":
+        return set(await self._r.smembers(self.prefix + key))
+
+    async def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        return bool(await self._acquire(keys=[self._lease(key)], args=[owner, int(ttl * 1000)]))
+
+    async def release(self, key: str, owner: str):
+        await self._release(keys=[self._lease(key)], args=[owner])
+
+    async def owned(self, prefix: str, owner: str) -> list[str]:
+        start = len(self._lease(""))
+        keys = [k async for k in self._r.scan_iter(self._lease(prefix) + "*")]
+        owners = await self._r.mget(keys) if keys else []
+        return [k[start:] for k, o in zip(keys, owners) if o == owner]
+
+    async def push(self, name: str, item_id: str, payload: str):
+        await self._r.hset(f"{self.prefix}queue:{name}", item_id, payload)
+
+    async def remove(self, name: str, item_id: str):
+        await self._r.hdel(f"{self.prefix}queue:{name}", item_id)
+        await self._r.delete(self._lease(f"{name}:{item_id}"))
+
+    async def items(self, name: str) -> list[tuple[str, str]]:
+        return list((await self._r.hgetall(f"{self.prefix}queue:{name}")).items())
+
+    async def queued(self, name: str) -> list[tuple[str, str]]:
+        items = await self._r.hgetall(f"{self.prefix}queue:{name}")
+        if not items:
+            return []
+        ids = list(items)
+        owners = await self._r.mget([self._lease(f"{name}:{i}") for i in ids])
+        return [(i, items[i]) for i, owner in zip(ids, owners) if owner is None]
+
+
+class AllowedUsers:
+    """
+    ALLOWED_USERS из окружения плюс допущенные по SPECIAL_CODE. Последние
+    хранятся в общем состоянии: видны всем экземплярам и переживают перезапуск.
+    Уже найденные запоминаются, так что сообщения своих пользователей
+    в общее состояние не ходят.
+    """
+
+    KEY = "allowed_users"
+
+    def __init__(self, static: list[int], state):
+        self._static = set(static)
+        self._known: set[int] = set()
+        self._state = state
+
+    async def has(self, user_id: int) -> bool:
+        if user_id in self._static or user_id in self._known:
+            return True
+        if await self._state.sismember(self.KEY, str(user_id)):
+            self._known.add(user_id)
+            return True
+        return False
+
+    async def add(self, user_id: int):
+        self._known.add(user_id)
+        await self._state.sadd(self.KEY, str(user_id))
+
+    async def members(self) -> set[int]:
+        return self._static | {int(m) for m in await self._state.smembers(self.KEY)}
+
+
+shared = RedisState(REDIS_URL) if REDIS_URL else LocalState(DATA_PATH / "shared.sqlite3")
+allowed_users = AllowedUsers(ALLOWED_USERS, shared)
+
+
+# ========================== #
+# 🍪 Пул cookies
+# ========================== #
+
+# ответы, после которых аккаунт надо оставить в покое
+COOKIE_BAN_MARKERS = (
+    "HTTP Error 429", "Too Many Requests", "Sign in to confirm", "not a bot",
+    "Please sign in", "login required", "rate-limit", "rate limit",
+)
+
+
+@dataclass(slots=True)
+class CookieProfile:
+    name: str
+    path: Path
+    mtime_ns: int
+    cookies: int
+    inflight: int = 0
+    strikes: int = 0
+    recent: deque = field(default_factory=deque)
+
+
+class CookiePool:
+    """
+    Аккаунты оператора: файлы *.txt в COOKIE_POOL_PATH, проверенные при
+    появлении или изменении. Запрос получает профиль с наименьшей нагрузкой
+    (в работе, затем запросов за RATE_WINDOW) среди тех, что не на паузе.
+    Пауза — в общем состоянии, её видят все экземпляры; снимается сама.
+    Выбор профиля идёт по локальной копии пауз: run() сверяет её с общим
+    состоянием раз в SYNC_INTERVAL, без запроса на каждое скачивание.
+    """
+
+    RATE_WINDOW = 600
+    RESCAN_INTERVAL = 30
+    SYNC_INTERVAL = 5
+
+    def __init__(self, path: Path, state, *, cooldown: int):
+        self.path = path
+        self.state = state
+        self.cooldown = cooldown
+        self.profiles: dict[str, CookieProfile] = {}
+        # имя профиля → время окончания паузы
+        self._paused: dict[str, float] = {}
+        self._scanned = 0.0
+
+    def _key(self, name: str) -> str:
+        return f"cookie_cooldown:{name}"
+
+    def scan(self) -> list[str]:
+        """
+        Подхватывает новые и изменённые файлы; битые пропускает с предупреждением.
+        Возвращает имена профилей, файлы которых оператор заменил.
+        """
+        self._scanned = time.monotonic()
+        found = {}
+        renewed = []
+        for path in sorted(self.path.glob("*.txt")) if self.path.is_dir() else []:
+            try:
+                mtime = path.stat().st_mtime_ns
+            except OSError:
+                continue
+            old = self.profiles.get(path.stem)
+            if old and old.mtime_ns == mtime:
+                found[path.stem] = old
+                continue
+            try:
+                jar = load_cookie_jar(path)
+            except (OSError, http.cookiejar.LoadError) as e:
+                logger.warning(f"Cookie profile {path.name} skipped: {e}")
+                continue
+            found[path.stem] = CookieProfile(path.stem, path, mtime, len(jar))
+            if old:
+                # файлы пула бот не пишет (YdlPool не сохраняет в них
+                # обновления от сайта), mtime меняет только оператор:
+                # новые cookies — новый шанс
+                self._paused.pop(path.stem, None)
+                renewed.append(path.stem)
+            logger.info(f"Cookie profile {path.stem}: {len(jar)} cookies")
+        self.profiles = found
+        return renewed
+
+    async def sync(self):
+        """
+        Пересканирует папку (не чаще RESCAN_INTERVAL) и сверяет паузы
+        с общим состоянием: их ставят и снимают и другие экземпляры.
+        """
+        if time.monotonic() - self._scanned > self.RESCAN_INTERVAL:
+            for name in await asyncio.to_thread(self.scan):
+                await self.state.delete(self._key(name))
+        paused = {}
+        for name in self.profiles:
+            raw = await self.state.get(self._key(name))
+            if raw:
+                paused[name] = json.loads(raw)["until"]
+        self._paused = paused
+
+    async def run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.warning(f"Cookie pool sync failed: {e}")
+            await asyncio.sleep(self.SYNC_INTERVAL)
+
+    def _cooling(self, profile: CookieProfile) -> bool:
+        return self._paused.get(profile.name, 0.0) > time.time()
+
+    def ready(self) -> int:
+        return sum(1 for p in self.profiles.values() if not self._cooling(p))
+
+    def pick(self, *, charge: bool = True) -> CookieProfile | None:
+        now = time.monotonic()
+        candidates = []
+        for profile in self.profiles.values():
+            while profile.recent and now - profile.recent[0] > self.RATE_WINDOW:
+                profile.recent.popleft()
+            if not self._cooling(profile):
+                candidates.append(profile)
+        if not candidates:
+            return None
+        profile = min(candidates, key=lambda p: (p.inflight, len(p.recent)))
+        if charge:
+            self.charge(profile)
+        return profile
+
+    def charge(self, profile: CookieProfile):
+        # учитываем сразу: несколько запросов подряд не упадут на один профиль
+        profile.recent.append(time.monotonic())
+
+    def profile_for(self, opts: dict) -> CookieProfile | None:
+        cookiefile = opts.get("cookiefile")
+        if not cookiefile:
+            return None
+        profile = self.profiles.get(Path(cookiefile).stem)
+        return profile if profile and str(profile.path) == cookiefile else None
+
+    async def report(self, profile: CookieProfile, error: str | None):
+        if not error:
+            profile.strikes = 0
+            return
+        if not any(m.lower() in error.lower() for m in COOKIE_BAN_MARKERS):
+            return
+        profile.strikes += 1
+        pause = self.cooldown * 2 ** min(profile.strikes - 1, 3)
+        until = time.time() + pause
+        self._paused[profile.name] = until
+        M_COOKIE_COOLDOWNS.inc(profile=profile.name)
+        logger.warning(f"Cookie profile {profile.name} cooled down for {pause}s: {error[:200]}")
+        raw = json.dumps({"until": until, "error": error[:200]}, ensure_ascii=False)
+        try:
+            await self.state.set(self._key(profile.name), raw, pause)
+        except Exception as e:
+            # пауза уже действует здесь; другие экземпляры узнают о ней позже
+            logger.warning(f"Cookie cooldown not shared: {e}")
+
+    @contextlib.asynccontextmanager
+    async def track(self, opts: dict):
+        """
+        Оборачивает запрос к сайту с этими opts: нагрузка и исход — профилю.
+        """
+        profile = self.profile_for(opts)
+        if not profile:
+            yield
+            return
+        profile.inflight += 1
+        try:
+            yield
+        except Exception as e:
+            await self.report(profile, str(e))
+            raise
+        else:
+            await self.report(profile, None)
+        finally:
+            profile.inflight -= 1
+
+
+cookie_pool = CookiePool(COOKIE_POOL_PATH, shared, cooldown=COOKIE_COOLDOWN)
+
+
+# ========================== #
+# 🗂 Меню: ожидающие нажатия
+# ========================== #
+
+CALLBACK_PREFIX = "r:"
+
+
+@dataclass(slots=True)
+class PendingRequest:
+    token: str
+    message_id: int
+    data: dict
+    actions: list[dict]
+    expires: float
+
+
+class Menu:
+    """
+    Кнопки одного меню. В callback_data уходит только короткий токен и
+    номер кнопки ("r:<token>:<n>"), само действие хранится в RequestStore,
+    поэтому лимит Telegram в 64 байта на callback_data не мешает.
+    """
+
+    def __init__(self):
+        self.token = secrets.token_urlsafe(6)
+        self.actions: list[dict] = []
+
+    def callback(self, action: dict) -> str:
+        self.actions.append(action)
+        return f"{CALLBACK_PREFIX}{self.token}:{len(self.actions) - 1}"
+
+
+class RequestStore:
+    """
+    Меню, ждущие нажатия. Истечение по TTL — через кучу сроков (O(log n)
+    на запись, без обхода всех меню), сверх REQUEST_STORE_SIZE вытесняются
+    давно не использованные. С state записи дублируются в общее состояние:
+    меню, показанное одним экземпляром бота, нажимается на любом другом и
+    после перезапуска; в памяти — только локальный кэш.
+    """
+
+    def __init__(self, state, *, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items: OrderedDict[str, PendingRequest] = OrderedDict()
+        self._by_message: dict[int, str] = {}
+        self._expiry: list[tuple[float, str]] = []
+        self._state = state
+
+    def _remember(self, item: PendingRequest):
+        self._items[item.token] = item
+        self._items.move_to_end(item.token)
+        self._by_message[item.message_id] = item.token
+        heapq.heappush(self._expiry, (item.expires, item.token))
+        while len(self._items) > self.max_entries:
+            _, old = self._items.popitem(last=False)
+            self._forget(old)
+
+    async def _load(self, token: str) -> PendingRequest | None:
+        raw = await self._state.get(f"menu:{token}") if self._state else None
+        if not raw:
+            return None
+        data = json.loads(raw)
+        if data["expires"] <= time.time():
+            return None
+        item = PendingRequest(token, data["message_id"], data["data"], data["actions"], data["expires"])
+        self._remember(item)
+        return item
+
+    def _forget(self, item: PendingRequest):
+        if self._by_message.get(item.message_id) == item.token:
+            del self._by_message[item.message_id]
+
+    def expire(self):
+        now = time.time()
+        while self._expiry and self._expiry[0][0] <= now:
+            _, token = heapq.heappop(self._expiry)
+            item = self._items.get(token)
+            # запись в куче могла остаться от вытесненного или перезаписанного меню
+            if item and item.expires <= now:
+                del self._items[token]
+                self._forget(item)
+
+    async def put(self, menu: Menu | None, message_id: int, data: dict):
+        self.expire()
+        item = PendingRequest(
+            token=menu.token if menu else secrets.token_urlsafe(6),
+            message_id=message_id,
+            data=data,
+            actions=menu.actions if menu else [],
+            expires=time.time() + self.ttl,
+        )
+        # меню в том же сообщении (например, пакет поверх ссылки) заменяет прежнее
+        previous = self._by_message.get(message_id)
+        if previous:
+            self._items.pop(previous, None)
+        self._remember(item)
+        if self._state:
+            if previous:
+                await self._state.delete(f"menu:{previous}")
+            raw = {"message_id": message_id, "data": data, "actions": item.actions, "expires": item.expires}
+            await self._state.set(f"menu:{item.token}", json.dumps(raw, ensure_ascii=False), self.ttl)
+
+    async def _touch(self, token: str | None) -> PendingRequest | None:
+        self.expire()
+        if not token:
+            return None
+        item = self._items.get(token)
+        if item:
+            self._items.move_to_end(token)
+            return item
+        return await self._load(token)
+
+    async def get(self, token: str) -> PendingRequest | None:
+        return await self._touch(token)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+pending = RequestStore(
+    shared if REQUEST_STORE_DISK else None,
+    ttl=REQUEST_TTL,
+    max_entries=REQUEST_STORE_SIZE,
+)
+
+
+# ========================== #
+# 📋 Очередь задач
+# ========================== #
+
+@dataclass(slots=True)
+class Job:
+    id: int
+    user_id: int
+    chat_id: int
+    status_msg_id: int
+    url: str
+    title: str
+    mode: str
+    format_id: str | None
+    est_size: int
+    priority: int
+    created_at: float
+    # журнал: queued → downloading → delivering; output — готовый файл
+    state: str = "queued"
+    cache_key: str | None = None
+    output: str | None = None
+    # запись пакета: номер пакета и место в нём (см. BatchRunner)
+    batch: int | None = None
+    batch_index: int = 0
+
+    @property
+    def tag(self) -> str:
+        """
+        Метка в именах файлов задачи: %(id)s.<tag>.%(ext)s
+        """
+        return f"j{self.id}"
+
+
+def job_priority(mode: str, est_size: int) -> int:
+    """
+    Меньше — раньше. Аудио и короткие ролики не ждут за 4K-видео.
+    """
+    if mode in AUDIO_MODES:
+        return 0
+    if est_size < 100 * 1024 * 1024:
+        return 1
+    if est_size < 1024 * 1024 * 1024:
+        return 2
+    return 3
+
+
+class JobQueue:
+    """
+    Очередь задач в общем состоянии: после перезапуска задачи не теряются,
+    а при нескольких воркерах каждую берёт ровно один. Взятая задача —
+    аренда jobs:<id> на имя воркера, которую он продлевает, пока качает;
+    аренда упавшего воркера истекает через JOB_LEASE, и задачу берёт другой.
+    Запись задачи — заодно журнал: этап переписывается до того, как
+    начат (update), и задача уходит из очереди только после выдачи файла.
+    Все методы — корутины: запросы к состоянию не блокируют event loop.
+    """
+
+    NAME = "jobs"
+    # запросы того же файла, ждущие задачу: followers:<id задачи>
+    FOLLOWERS = "followers"
+
+    # колонки очереди из версии, где она жила в отдельном queue.sqlite3
+    LEGACY_COLUMNS = (
+        "id", "user_id", "chat_id", "status_msg_id", "url", "title",
+        "mode", "format_id", "est_size", "priority", "created_at", "state",
+        "cache_key",
+    )
+
+    def __init__(self, state, *, owner: str, lease: float):
+        self.state = state
+        self.owner = owner
+        self.lease = lease
+        # этот процесс: два процесса с одним WORKER_ID брали бы одни задачи
+        self.instance = f"{os.getpid()}:{secrets.token_hex(4)}"
+
+    def _key(self, job: Job) -> str:
+        return f"{self.NAME}:{job.id}"
+
+    async def _push(self, job: Job):
+        await self.state.push(self.NAME, str(job.id), json.dumps(asdict(job), ensure_ascii=False))
+
+    async def add(
+        self,
+        *,
+        user_id: int,
+        chat_id: int,
+        status_msg_id: int,
+        url: str,
+        title: str,
+        mode: str,
+        format_id: str | None,
+        est_size: int,
+        cache_key: str | None = None,
+        batch: int | None = None,
+        batch_index: int = 0,
+    ) -> Job:
+        job = Job(
+            id=await self.state.incr("job_seq"),
+            user_id=user_id,
+            chat_id=chat_id,
+            status_msg_id=status_msg_id,
+            url=url,
+            title=title,
+            mode=mode,
+            format_id=format_id,
+            est_size=est_size,
+            priority=job_priority(mode, est_size),
+            created_at=time.time(),
+            cache_key=cache_key,
+            batch=batch,
+            batch_index=batch_index,
+        )
+        await self._push(job)
+        return job
+
+    async def update(self, job: Job):
+        await self._push(job)
+
+    async def tags(self) -> set[str]:
+        """
+        Метки всех незавершённых задач, включая взятые другими воркерами.
+        """
+        return {f"j{item_id}" for item_id, _ in await self.state.items(self.NAME)}
+
+    async def load(self) -> list[Job]:
+        """
+        Задачи, которые сейчас никто не качает.
+        """
+        jobs = [Job(**json.loads(payload)) for _, payload in await self.state.queued(self.NAME)]
+        return sorted(jobs, key=lambda j: j.id)
+
+    async def claim(self, job: Job) -> bool:
+        """
+        Берёт задачу себе или продлевает уже взятую.
+        """
+        return await self.state.acquire(self._key(job), self.owner, self.lease)
+
+    async def unclaim(self, job: Job):
+        await self.state.release(self._key(job), self.owner)
+
+    async def remove(self, job: Job):
+        await self.state.remove(self.NAME, str(job.id))
+
+    async def find(self, cache_key: str, before: int | None = None) -> Job | None:
+        """
+        Самая ранняя незавершённая задача с тем же ключом кэша (где бы она
+        ни качалась); before — только задачи, поставленные раньше неё.
+        """
+        found = None
+        for item_id, payload in await self.state.items(self.NAME):
+            if before is not None and int(item_id) >= before:
+                continue
+            job = Job(**json.loads(payload))
+            if job.cache_key == cache_key and (found is None or job.id < found.id):
+                found = job
+        return found
+
+    def _followers_name(self, leader: Job) -> str:
+        return f"{self.FOLLOWERS}:{leader.id}"
+
+    async def _take(self, name: str, item_id: str) -> str | None:
+        """
+        Забирает запись ровно одной стороной: ведущая задача раздаёт её,
+        а добавившая — отзывает, если ведущая уже завершилась. Аренда с
+        разовым владельцем решает, кто успел; запись после неё перечитываем:
+        remove снимает и аренду, и опоздавший мог бы взять её заново.
+        """
+        token = f"{self.owner}:{secrets.token_hex(4)}"
+        if not await self.state.acquire(f"{name}:{item_id}", token, self.lease):
+            return None
+        payload = dict(await self.state.items(name)).get(item_id)
+        if payload is None:
+            await self.state.release(f"{name}:{item_id}", token)
+            return None
+        await self.state.remove(name, item_id)
+        return payload
+
+    async def follow(self, leader: Job, job: Job) -> bool:
+        """
+        Прикрепляет запрос к задаче, которая уже качает тот же файл: он
+        ждёт её без своей задачи и слота. False — ведущая успела
+        завершиться, запрос нужно ставить как обычно.
+        """
+        name = self._followers_name(leader)
+        item_id = f"{job.chat_id}:{job.status_msg_id}"
+        await self.state.push(name, item_id, json.dumps(asdict(job), ensure_ascii=False))
+        if any(int(i) == leader.id for i, _ in await self.state.items(self.NAME)):
+            return True
+        return await self._take(name, item_id) is None
+
+    async def followers(self, leader: Job) -> list[Job]:
+        """
+        Забирает запросы, ждавшие задачу; вызывается после её удаления из очереди.
+        """
+        name = self._followers_name(leader)
+        taken = []
+        for item_id, _ in await self.state.items(name):
+            payload = await self._take(name, item_id)
+            if payload is not None:
+                taken.append(Job(**json.loads(payload)))
+        return taken
+
+    async def release_owned(self) -> list[int]:
+        """
+        Отпускает задачи, взятые этим воркером до перезапуска, — они
+        прерваны и должны вернуться в очередь сразу, а не по истечении аренды.
+        """
+        ids = []
+        for key in await self.state.owned(f"{self.NAME}:", self.owner):
+            await self.state.release(key, self.owner)
+            ids.append(int(key.rsplit(":", 1)[1]))
+        return ids
+
+    async def hold_worker(self) -> bool:
+        """
+        Аренда имени воркера на этот процесс; продлевается вместе с задачами.
+        """
+        return await self.state.acquire(f"workers:{self.owner}", self.instance, self.lease)
+
+    async def drop_worker(self):
+        await self.state.release(f"workers:{self.owner}", self.instance)
+
+    async def claim_worker(self):
+        """
+        Ждёт, пока имя воркера освободится: аренда упавшего прежнего
+        процесса истекает за lease. Если её продлевает живой процесс —
+        запускаться нельзя.
+        """
+        deadline = time.monotonic() + self.lease * 2
+        while not await self.hold_worker():
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"WORKER_ID={self.owner} is used by another running process")
+            logger.warning(f"WORKER_ID={self.owner} is held by another process, waiting for its lease to expire")
+            await asyncio.sleep(5)
+
+    async def lead(self) -> bool:
+        """
+        Ведущий воркер — один на всех — показывает места в очереди.
+        """
+        return await self.state.acquire("queue-status", self.owner, self.lease)
+
+    async def import_legacy(self, path: Path) -> list[int]:
+        """
+        Переносит незавершённые задачи из прежнего queue.sqlite3.
+        """
+        if not path.exists():
+            return []
+        db = sqlite3.connect(path)
+        try:
+            rows = db.execute(
+                f"SELECT {', '.join(self.LEGACY_COLUMNS)} FROM jobs WHERE state IN ('queued', 'running') ORDER BY id"
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Legacy queue not imported: {e}")
+            rows = []
+        finally:
+            db.close()
+        ids = []
+        for row in rows:
+            job = Job(*row)
+            # id сохраняем: метка j<id> — в именах недокачанных файлов
+            job.state = "downloading" if job.state == "running" else "queued"
+            await self._push(job)
+            ids.append(job.id)
+        if ids and max(ids) > int(await self.state.get("job_seq") or 0):
+            await self.state.set("job_seq", str(max(ids)))
+        path.rename(path.with_suffix(".migrated"))
+        return ids
+
+
+class DownloadScheduler:
+    """
+    Диспетчер перед download_media. Честная очередь: пользователи
+    обслуживаются по кругу, внутри пользователя — по приоритету и времени.
+    Один пользователь с десятью 4K-видео не блокирует остальных.
+    Воркеров может быть несколько: каждый видит общую очередь и берёт
+    задачу через claim; лимиты и ETA считаются в пределах воркера.
+    """
+
+    def __init__(self, queue: JobQueue, *, workers: int, per_user: int):
+        self.queue = queue
+        self.workers = workers
+        self.per_user = per_user
+        # False у экземпляра с ROLE=bot: задачи только ставятся в очередь
+        self.consume = True
+        self._renewed = 0.0
+        self._pending: dict[int, Job] = {}
+        self._running: dict[int, Job] = {}
+        self._last_served: dict[int, float] = {}
+        self._shown_position: dict[int, tuple[int, bool]] = {}
+        self._waiting_disk: set[int] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        # поиск ведущей задачи и постановка — одним шагом внутри экземпляра
+        self._submit_lock = asyncio.Lock()
+        self.worker_speed = float(DEFAULT_WORKER_SPEED)
+
+    async def restore(self) -> list[Job]:
+        """
+        Возвращает в очередь задачи, прерванные перезапуском этого воркера,
+        и переносит очередь старого формата. Возвращает их для уведомления.
+        """
+        returned = set(await self.queue.release_owned())
+        returned.update(await self.queue.import_legacy(DATA_PATH / "queue.sqlite3"))
+        await self.sync()
+        self._wakeup.set()
+        return [job for job in self._pending.values() if job.id in returned]
+
+    async def sync(self):
+        """
+        Подтягивает общую очередь: задачи, поставленные другими
+        экземплярами, и снятые с неё (взятые другими воркерами).
+        """
+        queued = {job.id: job for job in await self.queue.load() if job.id not in self._running}
+        self._pending = {jid: self._pending.get(jid, job) for jid, job in queued.items()}
+
+    async def submit(self, **fields) -> Job:
+        """
+        Ставит задачу в очередь. Если тот же файл (ключ кэша) уже в очереди
+        или качается, запрос прикрепляется к той задаче и получит её файл,
+        не занимая ни места в очереди, ни слота скачивания.
+        """
+        # записи пакета не склеиваем: их итог собирает пакет, а не чат
+        key = None if fields.get("batch") else fields.get("cache_key")
+        async with self._submit_lock:
+            leader = await self.queue.find(key) if key else None
+            if leader:
+                job = Job(id=leader.id, priority=leader.priority, created_at=time.time(), **fields)
+                followed = await self.queue.follow(leader, job)
+            if not leader or not followed:
+                job = await self.queue.add(**fields)
+                leader = None
+                logger.info(f"Queued job={job.id} url={job.url} mode={job.mode} user={job.user_id} est={job.est_size}")
+        if leader:
+            logger.info(f"Request chat={job.chat_id} follows job={leader.id} key={key}")
+            await edit_status(job, "⏳ Этот файл уже скачивается по другому запросу, пришлю, когда будет готов.")
+            return job
+        if self.consume:
+            self._pending[job.id] = job
+            self._wakeup.set()
+        return job
+
+    async def _abandon(self, job: Job):
+        """
+        Задача снята без результата: пакет считает запись ошибкой, а
+        ждавшие её запросы ставятся сами.
+        """
+        try:
+            if job.batch:
+                await batches.record(job, None)
+            else:
+                await self._release_followers(job)
+        except Exception as e:
+            logger.warning(f"Job {job.id} abandoned without notifying waiters: {e}")
+
+    async def _release_followers(self, job: Job):
+        """
+        Отдаёт файл запросам, ждавшим задачу. Если скачать не удалось,
+        они становятся обычными задачами (первая из них — новой ведущей).
+        """
+        followers = await self.queue.followers(job)
+        if not followers:
+            return
+        cached = await download_cache.get(job.cache_key)
+        for follower in followers:
+            try:
+                if cached:
+                    await deliver(follower, *cached)
+                else:
+                    await self.submit(
+                        user_id=follower.user_id,
+                        chat_id=follower.chat_id,
+                        status_msg_id=follower.status_msg_id,
+                        url=follower.url,
+                        title=follower.title,
+                        mode=follower.mode,
+                        format_id=follower.format_id,
+                        est_size=follower.est_size,
+                        cache_key=follower.cache_key,
+                    )
+            except Exception as e:
+                logger.warning(f"Follower chat={follower.chat_id} of job={job.id} not served: {e}")
+
+    def running_for(self, user_id: int) -> int:
+        return sum(1 for j in self._running.values() if j.user_id == user_id)
+
+    def order(self) -> list[Job]:
+        """
+        Порядок обслуживания: round-robin по пользователям. Первыми идут те,
+        у кого сейчас меньше задач в работе и кто дольше не обслуживался.
+        """
+        per_user: dict[int, list[Job]] = {}
+        for job in self._pending.values():
+            per_user.setdefault(job.user_id, []).append(job)
+        for jobs in per_user.values():
+            jobs.sort(key=lambda j: (j.priority, j.created_at))
+
+        users = sorted(
+            per_user,
+            key=lambda u: (self.running_for(u), self._last_served.get(u, 0.0)),
+        )
+        ordered: list[Job] = []
+        depth = max((len(j) for j in per_user.values()), default=0)
+        for i in range(depth):
+            for u in users:
+                if i < len(per_user[u]):
+                    ordered.append(per_user[u][i])
+        return ordered
+
+    def eta_for(self, position: int, ordered: list[Job]) -> float:
+        ahead = sum(j.est_size or DEFAULT_JOB_SIZE for j in ordered[:position])
+        ahead += sum(j.est_size or DEFAULT_JOB_SIZE for j in self._running.values()) / 2
+        return ahead / (self.worker_speed * self.workers)
+
+    def record_speed(self, size: int, seconds: float):
+        if size <= 0 or seconds <= 0:
+            return
+        # EWMA, чтобы ETA не прыгал от одного быстрого/медленного файла
+        self.worker_speed = 0.7 * self.worker_speed + 0.3 * (size / seconds)
+
+    async def active_tags(self) -> set[str]:
+        tags = {j.tag for j in self._pending.values()} | {j.tag for j in self._running.values()}
+        try:
+            return tags | await self.queue.tags()
+        except Exception as e:
+            logger.warning(f"Shared queue unavailable: {e}")
+            return tags
+
+    async def mark(self, job: Job, state: str, **fields):
+        """
+        Запись в журнал до начала этапа: после падения задача продолжится с него.
+        """
+        job.state = state
+        for name, value in fields.items():
+            setattr(job, name, value)
+        try:
+            await self.queue.update(job)
+        except Exception as e:
+            logger.warning(f"Journal write failed job={job.id}: {e}")
+
+    async def _dispatch(self) -> list[Job]:
+        """
+        Запускает всё, что помещается в лимиты. Возвращает задачи,
+        которые не влезут на диск никогда — их надо снять с очереди.
+        """
+        rejected = []
+        self._waiting_disk.clear()
+        for job in self.order():
+            if len(self._running) >= self.workers:
+                break
+            if self.running_for(job.user_id) >= self.per_user:
+                continue
+            if job.batch and not await batches.claim(job.batch):
+                # пакет собирает другой воркер
+                continue
+            if not await self.queue.claim(job):
+                # задачу уже взял другой воркер
+                self._pending.pop(job.id, None)
+                continue
+            admitted = storage.admit(job)
+            if admitted is None:
+                self._pending.pop(job.id, None)
+                await self.queue.remove(job)
+                rejected.append(job)
+                continue
+            if not admitted:
+                # пусть её возьмёт воркер, у которого место есть
+                await self.queue.unclaim(job)
+                self._waiting_disk.add(job.id)
+                continue
+            self._pending.pop(job.id, None)
+            self._shown_position.pop(job.id, None)
+            progress.drop_queue_status(set(self._pending))
+            wait = time.time() - job.created_at
+            M_QUEUE_WAIT.observe(wait, mode=job.mode)
+            log_event("dispatch", job=job.id, user=job.user_id, mode=job.mode, queue_wait=round(wait, 3))
+            self._running[job.id] = job
+            self._last_served[job.user_id] = time.time()
+            task = asyncio.create_task(self._execute(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return rejected
+
+    async def _execute(self, job: Job):
+        started = time.monotonic()
+        try:
+            size = await download_media(job)
+            if size:
+                self.record_speed(size, time.monotonic() - started)
+        except (asyncio.CancelledError, DownloadCancelled) as e:
+            # остановка бота: поток скачивания уже вышел (DownloadExecutor._run
+            # ждёт его), задача остаётся в журнале и за этим воркером —
+            # release_owned после перезапуска вернёт её в очередь, а
+            # недокачанные файлы на диске продолжат скачивание
+            storage.release_reservation(job.tag)
+            self._running.pop(job.id, None)
+            with contextlib.suppress(Exception):
+                await edit_status(job, "⏸ Бот перезапускается, задача продолжится после запуска.")
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        except Exception as e:
+            logger.exception(e)
+            if job.batch:
+                await self._abandon(job)
+        storage.release(job)
+        self._running.pop(job.id, None)
+        try:
+            await self.queue.remove(job)
+            await self._release_followers(job)
+        except Exception as e:
+            # аренда истечёт, задачу возьмут заново и отдадут из кэша
+            logger.warning(f"Shared queue unavailable, job={job.id} not removed: {e}")
+        self._wakeup.set()
+
+    async def stop(self):
+        """
+        Прерывает задачи при остановке, оставляя их в журнале: yt-dlp —
+        через хук прогресса на ближайшем куске, ffmpeg — сразу. Ждёт, пока
+        потоки скачивания действительно выйдут (внешний загрузчик ffmpeg
+        внутри yt-dlp прервать нельзя — его доделываем), и всё это время
+        продлевает аренды: иначе задачу взял бы другой воркер и писал
+        в те же .part-файлы.
+        """
+        progress.interrupt()
+        tasks = set(self._tasks)
+        for task in tasks:
+            task.cancel()
+        while tasks:
+            _, tasks = await asyncio.wait(tasks, timeout=self.queue.lease / 3)
+            try:
+                await self._renew()
+            except Exception as e:
+                logger.warning(f"Lease renewal failed while stopping: {e}")
+
+    def _refresh_positions(self):
+        """
+        Позиции в очереди уходят через progress: правки в одном чате
+        ограничены так же, как прогресс, 10 задач не дают 10 правок разом.
+        """
+        ordered = self.order()
+        progress.drop_queue_status({job.id for job in ordered})
+        for pos, job in enumerate(ordered):
+            shown = (pos, job.id in self._waiting_disk)
+            if self._shown_position.get(job.id) == shown:
+                continue
+            self._shown_position[job.id] = shown
+            eta = fmt_eta(self.eta_for(pos, ordered))
+            text = f"🕒 В очереди: {pos + 1}-й\nПримерное ожидание: {eta}"
+            if job.id in self._waiting_disk:
+                text += "\n💾 Ждём, пока освободится место на диске."
+            progress.queue_status(job, text)
+
+    async def _renew(self):
+        """
+        Продлевает аренду задач в работе, пока они качаются.
+        """
+        if time.monotonic() - self._renewed < self.queue.lease / 3:
+            return
+        self._renewed = time.monotonic()
+        if not await self.queue.hold_worker():
+            logger.error(f"WORKER_ID={self.queue.owner} was taken by another process, jobs may run twice")
+        for job in list(self._running.values()):
+            if not await self.queue.claim(job):
+                logger.warning(f"Lease on job {job.id} lost, it may run twice")
+        # пакет держим и между его записями, пока они ждут в очереди
+        jobs = list(self._running.values()) + list(self._pending.values())
+        for batch_id in {job.batch for job in jobs if job.batch}:
+            await batches.claim(batch_id)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.sync()
+                await self._renew()
+                rejected = await self._dispatch()
+            except Exception as e:
+                logger.warning(f"Shared queue unavailable: {e}")
+                rejected = []
+            for job in rejected:
+                await edit_status(job, "❌ Файл слишком большой для этого сервера.")
+                await self._abandon(job)
+            try:
+                if await self.queue.lead():
+                    self._refresh_positions()
+            except Exception as e:
+                logger.warning(f"Queue status refresh failed: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=QUEUE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+job_queue = JobQueue(shared, owner=WORKER_ID, lease=JOB_LEASE)
+scheduler = DownloadScheduler(job_queue, workers=DOWNLOAD_WORKERS, per_user=PER_USER_DOWNLOADS)
+
+
+async def edit_message(chat_id: int, message_id: int, text: str, **kwargs):
+    """
+    Правка сообщения по chat_id/message_id: после перезапуска объекта
+    Message у нас уже нет.
+    """
+    try:
+        await bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id, **kwargs)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logger.warning(f"Status edit failed chat={chat_id} msg={message_id}: {e}")
+
+
+async def edit_status(job: Job, text: str, **kwargs):
+    if job.batch:
+        # у записей пакета одно общее сообщение, его ведёт BatchRunner
+        return
+    await edit_message(job.chat_id, job.status_msg_id, text, **kwargs)
+
+
+# ========================== #
+# 💾 Место на диске
+# ========================== #
+
+TEMP_FILE_RE = re.compile(r"(\.part$|\.part-Frag|\.ytdl$|\.temp$|\.f\d+\.|\.[jb]\d+(?:i\d+)?\.)")
+JOB_TAG_RE = re.compile(r"\.([jb]\d+(?:i\d+)?)\.")
+
+
+@dataclass(slots=True)
+class StoredFile:
+    name: str
+    # downloading — задача ещё не отдала файл, его не трогаем; ready —
+    # готов; served — уже отдан, вытесняется первым. Удалённый (expired)
+    # уходит из таблицы
+    state: str
+    size: int
+    last_access: float
+
+
+class StorageManager:
+    """
+    Жизненный цикл файлов в DOWNLOAD_PATH вместо слепой чистки по cron:
+    - перед стартом задачи резервируем место по оценке размера (admission);
+    - файл, который задача ещё не отдала, не удаляется ни по сроку, ни при
+      нехватке места;
+    - готовые файлы живут FILE_TTL после последнего обращения;
+    - при нехватке места вытесняем сначала уже отданные, затем давно не
+      запрошенные готовые файлы;
+    - подчищаем брошенные .part/.fNNN.* от задач, которых уже нет.
+    """
+
+    def __init__(self, root: Path, *, quota: int, min_free: int, ttl: int):
+        self.root = root
+        self.quota = quota
+        self.min_free = min_free
+        self.ttl = ttl
+        self.files: dict[str, StoredFile] = {}
+        self._reserved: dict[str, int] = {}
+
+    def scan(self):
+        """
+        После перезапуска подхватываем уже лежащие готовые файлы.
+        """
+        for path in self.root.iterdir():
+            if not path.is_file() or TEMP_FILE_RE.search(path.name):
+                continue
+            st = path.stat()
+            self.files[path.name] = StoredFile(path.name, "ready", st.st_size, st.st_mtime)
+
+    def used(self) -> int:
+        return sum(f.size for f in self.files.values()) + sum(self._reserved.values())
+
+    def _free(self) -> int:
+        return shutil.disk_usage(self.root).free - sum(self._reserved.values())
+
+    def _fits(self, need: int) -> bool:
+        return self.used() + need <= self.quota and self._free() - need >= self.min_free
+
+    @staticmethod
+    def need_for(job: Job) -> int:
+        need = job.est_size or DEFAULT_JOB_SIZE
+        # раздельные видео+аудио и перекодирование в MP3: на время
+        # склейки/перекодирования на диске лежат обе копии
+        if job.mode == "shrink":
+            # исходник, куски до и после кодирования, итоговый файл
+            return need * 2 + FIT_SIZE_BYTES * 2
+        return need * 2 if job.mode in ("bestq", "pick", "fit", "fast", "audio") else need
+
+    def admit(self, job: Job) -> bool | None:
+        return self.admit_bytes(job.tag, self.need_for(job))
+
+    def admit_bytes(self, tag: str, need: int) -> bool | None:
+        """
+        True — место зарезервировано, False — подождать, None — не влезет никогда.
+        """
+        if need > self.quota:
+            return None
+        if not self._fits(need):
+            self.evict_for(need)
+            if not self._fits(need):
+                return False
+        self._reserved[tag] = need
+        return True
+
+    async def wait_admit(self, tag: str, need: int) -> bool:
+        while True:
+            admitted = self.admit_bytes(tag, need)
+            if admitted is not None:
+                if admitted:
+                    return True
+                await asyncio.sleep(5)
+            else:
+                return False
+
+    def release(self, job: Job):
+        self.release_tag(job.tag)
+
+    def release_tag(self, tag: str):
+        self._reserved.pop(tag, None)
+        self.cleanup_job(tag)
+
+    def release_reservation(self, tag: str):
+        """
+        Снять резерв, не трогая файлы задачи: она продолжится позже.
+        """
+        self._reserved.pop(tag, None)
+
+    def partial_bytes(self, tag: str) -> int:
+        total = 0
+        for path in self.root.glob(f"*.{glob.escape(tag)}.*"):
+            try:
+                total += path.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def add_ready(self, name: str, size: int, state: str = "ready"):
+        self.files[name] = StoredFile(name, state, size, time.time())
+
+    def hold(self, name: str):
+        """
+        Файл снова нужен незавершённой задаче (например, пакету).
+        """
+        f = self.files.get(name)
+        if f:
+            f.state = "downloading"
+
+    def finish(self, name: str):
+        f = self.files.get(name)
+        if f and f.state == "downloading":
+            f.state = "ready"
+            f.last_access = time.time()
+
+    def busy(self, name: str) -> bool:
+        f = self.files.get(name)
+        return f is not None and f.state == "downloading"
+
+    def touch(self, name: str):
+        f = self.files.get(name)
+        if f:
+            f.last_access = time.time()
+            if f.state == "ready":
+                f.state = "served"
+
+    def delete(self, name: str):
+        self.files.pop(name, None)
+        (self.root / name).unlink(missing_ok=True)
+
+    def _expire(self, name: str, reason: str):
+        f = self.files.get(name)
+        self.delete(name)
+        download_cache.drop_file(name)
+        logger.info(f"Storage removed {name} ({reason}, {f.size if f else 0} bytes)")
+
+    def evict_for(self, need: int):
+        now = time.time()
+        # сначала уже отданные, внутри — давно не запрошенные
+        for f in sorted(self.files.values(), key=lambda f: (f.state != "served", f.last_access)):
+            if self._fits(need):
+                return
+            # только что выданный файл не трогаем: его могут начать качать
+            if f.state == "downloading" or now - f.last_access < 60:
+                continue
+            self._expire(f.name, "lru")
+
+    def cleanup_job(self, tag: str):
+        """
+        Хвосты конкретной задачи: промежуточные .fNNN.*, .part, .ytdl.
+        """
+        for path in self.root.glob(f"*.{glob.escape(tag)}.*"):
+            path.unlink(missing_ok=True)
+
+    def sweep(self, active_tags: set[str]):
+        now = time.time()
+        for f in list(self.files.values()):
+            if f.state != "downloading" and now - f.last_access > self.ttl:
+                self._expire(f.name, "ttl")
+
+        for path in self.root.iterdir():
+            if not path.is_file() or not TEMP_FILE_RE.search(path.name):
+                continue
+            m = JOB_TAG_RE.search(path.name)
+            if m and m.group(1) in active_tags:
+                continue
+            try:
+                if now - path.stat().st_mtime > ORPHAN_AGE:
+                    path.unlink(missing_ok=True)
+                    logger.info(f"Storage removed orphan {path.name}")
+            except OSError:
+                pass
+
+    async def run(self, active_tags):
+        while True:
+            await asyncio.sleep(STORAGE_SWEEP_INTERVAL)
+            try:
+                self.sweep(await active_tags())
+            except Exception as e:
+                logger.warning(f"Storage sweep failed: {e}")
+
+
+storage = StorageManager(DOWNLOAD_PATH, quota=STORAGE_QUOTA_BYTES, min_free=MIN_FREE_BYTES, ttl=FILE_TTL)
+
+
+# ========================== #
+# 📶 Прогресс скачивания
+# ========================== #
+
+class ProgressHook:
+    """
+    progress_hooks/postprocessor_hooks для yt-dlp. Работает в потоке или
+    процессе воркера и складывает компактные события в общую очередь,
+    сам Telegram не трогает. Объект должен оставаться picklable.
+    Когда бот останавливается (stop), прерывает скачивание на очередном
+    куске через DownloadCancelled.
+    """
+
+    def __init__(self, job_id: int, channel_queue, stop=None):
+        self.job_id = job_id
+        self.queue = channel_queue
+        self.stop = stop
+        self._last = 0.0
+
+    def __call__(self, d: dict):
+        status = d.get("status")
+        if "encode" in d:
+            self.queue.put({"job": self.job_id, "stage": "encode", "status": status, **d["encode"]})
+            return
+        if "postprocessor" in d:
+            self.queue.put({
+                "job": self.job_id,
+                "stage": "postprocess",
+                "status": status,
+                "pp": d.get("postprocessor"),
+                "ts": time.time(),
+            })
+            return
+        now = time.monotonic()
+        # промежуточные события прореживаем, конечные отдаём всегда
+        if status == "downloading" and now - self._last < 0.5:
+            return
+        self._last = now
+        if status == "downloading" and self.stop is not None and self.stop.is_set():
+            raise DownloadCancelled("bot is stopping")
+        self.queue.put({
+            "job": self.job_id,
+            "stage": "download",
+            "status": status,
+            "file": os.path.basename(d.get("filename") or ""),
+            "downloaded": d.get("downloaded_bytes") or 0,
+            "total": d.get("total_bytes") or d.get("total_bytes_estimate") or 0,
+            "speed": d.get("speed") or 0,
+            "eta": d.get("eta"),
+        })
+
+
+class ProgressChannel:
+    """
+    Мост от хуков yt-dlp к event loop: очередь потокобезопасная (для пула
+    процессов — через multiprocessing.Manager). Цикл в asyncio забирает
+    события, оставляет по задаче только последнее и правит статус не чаще
+    PROGRESS_EDIT_INTERVAL на чат. Тем же лимитом идут позиции в очереди
+    от диспетчера. Счётчики байт/скорости общие для метрик.
+    """
+
+    def __init__(self, kind: str, edit_interval: float):
+        self.kind = kind
+        self.edit_interval = edit_interval
+        self._manager = None
+        self._queue = None
+        self._stop = None
+        self._jobs: dict[int, Job] = {}
+        self._latest: dict[int, dict] = {}
+        self._queue_status: dict[int, tuple[Job, str]] = {}
+        self._seen_bytes: dict[tuple[int, str], int] = {}
+        self._chat_edited: dict[int, float] = {}
+        self._pp_started: dict[tuple[int, str], float] = {}
+        self._lock = asyncio.Lock()
+        self.bytes_total = 0
+        self.speeds: dict[int, float] = {}
+
+    @property
+    def queue(self):
+        if self._queue is None:
+            if self.kind == "process":
+                self._manager = multiprocessing.Manager()
+                self._queue = self._manager.Queue()
+                self._stop = self._manager.Event()
+            else:
+                self._queue = queue.SimpleQueue()
+                self._stop = threading.Event()
+        return self._queue
+
+    def interrupt(self):
+        """
+        Хуки всех скачиваний прервут их на ближайшем куске.
+        """
+        if self._queue is not None:
+            self._stop.set()
+
+    def queue_status(self, job: Job, text: str):
+        """
+        Позиция в очереди: уйдёт при следующей правке, разрешённой для чата;
+        до неё более свежий текст заменяет прежний.
+        """
+        self._queue_status[job.id] = (job, text)
+
+    def drop_queue_status(self, keep: set[int]):
+        # задача ушла в работу или снята с очереди — старая позиция не нужна
+        for job_id in [j for j in self._queue_status if j not in keep]:
+            del self._queue_status[job_id]
+
+    def hook_for(self, job: Job) -> ProgressHook:
+        self._jobs[job.id] = job
+        return ProgressHook(job.id, self.queue, self._stop)
+
+    async def unregister(self, job: Job):
+        async with self._lock:
+            # добираем последние события, чтобы счётчик байт был точным
+            self._drain()
+            self._jobs.pop(job.id, None)
+            self._latest.pop(job.id, None)
+            self.speeds.pop(job.id, None)
+            for k in [k for k in self._seen_bytes if k[0] == job.id]:
+                del self._seen_bytes[k]
+            for k in [k for k in self._pp_started if k[0] == job.id]:
+                del self._pp_started[k]
+
+    @property
+    def current_speed(self) -> float:
+        return sum(self.speeds.values())
+
+    def _drain(self):
+        q = self.queue
+        while True:
+            try:
+                event = q.get_nowait()
+            except queue.Empty:
+                return
+            job_id = event["job"]
+            if job_id not in self._jobs:
+                continue
+            if event["stage"] == "download":
+                key = (job_id, event["file"])
+                prev = self._seen_bytes.get(key, 0)
+                if event["downloaded"] > prev:
+                    self.bytes_total += event["downloaded"] - prev
+                    M_TRANSFER.inc(event["downloaded"] - prev)
+                    self._seen_bytes[key] = event["downloaded"]
+                self.speeds[job_id] = event["speed"] if event["status"] == "downloading" else 0.0
+            elif event["stage"] == "postprocess":
+                self._track_postprocess(job_id, event)
+            self._latest[job_id] = event
+
+    def _track_postprocess(self, job_id: int, event: dict):
+        key = (job_id, event.get("pp") or "")
+        if event["status"] == "started":
+            self._pp_started[key] = event["ts"]
+        elif event["status"] == "finished" and key in self._pp_started:
+            seconds = event["ts"] - self._pp_started.pop(key)
+            M_POSTPROCESS.observe(seconds, postprocessor=key[1])
+            log_event("postprocess", job=job_id, postprocessor=key[1], seconds=round(seconds, 3))
+
+    @staticmethod
+    def render(event: dict) -> str:
+        if event["stage"] == "encode":
+            text = f"📉 Сжимаю: {min(100, int(event['done'] * 100 / event['total']))}%" if event["total"] else "📉 Сжимаю"
+            if event["fps"]:
+                text += f" · {event['fps']:.0f} к/с · {event['realtime']:.1f}x реального времени"
+            if event.get("eta"):
+                text += f"\nОсталось: {fmt_eta(event['eta'])}"
+            return text
+        if event["stage"] == "postprocess":
+            return f"⚙️ Обработка ({event.get('pp') or 'ffmpeg'})..."
+        if event["status"] == "finished":
+            return "⚙️ Файл скачан, обработка..."
+        downloaded, total = event["downloaded"], event["total"]
+        parts = []
+        if total:
+            parts.append(f"{min(100, downloaded * 100 // total)}%")
+            parts.append(f"{fmt_mb(downloaded)} из {fmt_mb(total)}")
+        else:
+            parts.append(fmt_mb(downloaded))
+        if event["speed"]:
+            parts.append(f"{fmt_mb(event['speed'])}/с")
+        text = "⏬ Скачиваю: " + " · ".join(parts)
+        if event.get("eta"):
+            text += f"\nОсталось: {fmt_eta(event['eta'])}"
+        return text
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(0.5)
+            try:
+                self._drain()
+                await self._flush()
+            except Exception as e:
+                logger.warning(f"Progress update failed: {e}")
+
+    def _may_edit(self, chat_id: int, now: float) -> bool:
+        if now - self._chat_edited.get(chat_id, 0.0) < self.edit_interval:
+            return False
+        self._chat_edited[chat_id] = now
+        return True
+
+    async def _edit(self, job: Job, text: str) -> bool:
+        try:
+            await edit_status(job, text)
+        except TelegramRetryAfter as e:
+            # чат перегружен правками: следующая — не раньше, чем разрешит Telegram
+            self._chat_edited[job.chat_id] = time.monotonic() + e.retry_after
+            return False
+        return True
+
+    async def _flush(self):
+        now = time.monotonic()
+        for job_id in list(self._latest):
+            async with self._lock:
+                job = self._jobs.get(job_id)
+                event = self._latest.get(job_id)
+                if not job or not event or not self._may_edit(job.chat_id, now):
+                    continue
+                del self._latest[job_id]
+                if not await self._edit(job, self.render(event)):
+                    self._latest.setdefault(job_id, event)
+        for job_id in list(self._queue_status):
+            job, text = self._queue_status[job_id]
+            if not self._may_edit(job.chat_id, now):
+                continue
+            del self._queue_status[job_id]
+            if not await self._edit(job, text):
+                self._queue_status.setdefault(job_id, (job, text))
+
+
+progress = ProgressChannel(EXECUTOR_KIND, PROGRESS_EDIT_INTERVAL)
+
+
+# ========================== #
+# 🧭 Команды
+# ========================== #
+
+main_keyboard = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="⬇️ Скачать видео"), KeyboardButton(text="🍪 Cookies")],
+        [KeyboardButton(text="ℹ️ Инструкция")],
+    ],
+    resize_keyboard=True,
+    persistent=True,
+)
+
+
+@dp.message(Command("start"))
+async def cmd_start(message: types.Message):
+    user_id = message.from_user.id
+    args = message.text.split(maxsplit=1)
+
+    if len(args) > 1 and args[1] == SPECIAL_CODE and not await allowed_users.has(user_id):
+        await allowed_users.add(user_id)
+        await message.answer("✅ Доступ разрешён! Добро пожаловать.")
+    elif not await allowed_users.has(user_id):
+        await message.answer("❌ Доступ запрещён. Введите специальный код.")
+        return
+
+    await message.answer("Привет! Отправь ссылку на видео для скачивания.", reply_markup=main_keyboard)
+
+
+@dp.message(F.text == "ℹ️ Инструкция")
+async def show_help(message: types.Message):
+    await message.answer(
+        "*Инструкция для использования бота:*\n\n"
+        "*⬇️ Скачать видео* - Нажмите эту кнопку, затем отправьте боту ссылку на видео.\n"
+        "  - Бот предложит выбрать качество видео.\n"
+        "  - Будет кнопка \"🎵 Скачать MP3\" для извлечения аудиодорожки.\n"
+        "  - Будет кнопка \"🖼️ Обложка\" для скачивания превью.\n"
+        "*🍪 Cookies* - Используйте, если видео требует авторизации или не скачивается.\n"
+        "1. Установите [Get cookies.txt LOCALLY](https://chromewebstore.google.com/detail/get-cookiestxt-locally/cclelndahbckbenkjhflpdbgdldlbecc).\n"
+        "2. Зайдите в аккаунт на нужном сайте.\n"
+        "3. Нажмите иконку расширения -> Export (формат **Netscape**).\n"
+        "4. Нажмите \"🍪 Cookies\" в боте -> отправьте `.txt` файл.\n"
+        "5. Попробуйте скачать видео снова.",
+        parse_mode="Markdown",
+        disable_web_page_preview=True,
+    )
+
+
+@dp.message(F.text == "🍪 Cookies")
+async def prompt_cookies(message: types.Message):
+    await message.answer("Отправьте файл `cookies.txt` (формат Netscape).", parse_mode="Markdown")
+
+
+@dp.message(F.document & F.document.file_name.endswith(".txt"))
+async def handle_cookie_file(message: types.Message):
+    """
+    Файл проверяется и разбирается один раз здесь: в папку попадает только
+    корректный cookies.txt, пересохранённый в нормальном виде.
+    """
+    destination = COOKIES_PATH / f"cookies_{message.from_user.id}.txt"
+    upload = destination.with_suffix(".upload")
+    file_info = await bot.get_file(message.document.file_id)
+    await bot.download_file(file_info.file_path, upload)
+    try:
+        jar = await asyncio.to_thread(load_cookie_jar, upload)
+    except (OSError, http.cookiejar.LoadError, UnicodeDecodeError) as e:
+        logger.info(f"Rejected cookies from user={message.from_user.id}: {e}")
+        await message.answer("❌ Это не cookies.txt в формате Netscape. Экспортируйте cookies ещё раз.")
+        return
+    finally:
+        upload.unlink(missing_ok=True)
+    await asyncio.to_thread(jar.save, str(destination))
+    now = time.time()
+    expired = sum(1 for c in jar if c.expires and c.expires < now)
+    domains = sorted({c.domain.lstrip(".") for c in jar})
+    text = f"✅ Cookies сохранены: {len(jar)} шт., сайты: {', '.join(domains[:5])}"
+    if len(domains) > 5:
+        text += f" и ещё {len(domains) - 5}"
+    if expired:
+        text += f"\n⚠️ Просрочено: {expired}. Если скачивание не пойдёт, экспортируйте cookies заново."
+    await message.answer(text)
+
+
+@dp.message(F.text == "⬇️ Скачать видео")
+async def prompt_video_url(message: types.Message):
+    if not await allowed_users.has(message.from_user.id):
+        return
+    await message.answer("Пришлите ссылку на видео.")
+
+
+# ========================== #
+# 🖼 Обложки
+# ========================== #
+
+def best_thumbnail(info: dict | None) -> str | None:
+    """
+    Лучшая обложка из info["thumbnails"]: самая большая (больше
+    THUMB_MAX_SIDE всё равно уменьшим), при равенстве — JPEG, затем
+    по предпочтению yt-dlp (список отсортирован от худшей к лучшей).
+    """
+    info = info or {}
+    thumbs = [t for t in info.get("thumbnails") or [] if t.get("url")]
+    if not thumbs:
+        return info.get("thumbnail")
+    cap = ThumbnailService.MAX_SIDE ** 2
+
+    def score(item):
+        i, t = item
+        area = min((t.get("width") or 0) * (t.get("height") or 0), cap)
+        jpeg = urlparse(t["url"]).path.lower().endswith((".jpg", ".jpeg"))
+        return area, jpeg, t.get("preference") or 0, i
+
+    return max(enumerate(thumbs), key=score)[1]["url"]
+
+
+class ThumbnailService:
+    """
+    Обложки через один общий HTTP-клиент (пул соединений на всё время
+    работы). Картинка качается один раз, ffmpeg приводит её к JPEG не
+    больше MAX_SIDE по стороне — WebP и огромные PNG Telegram сам не
+    всегда принимает. Байты лежат на диске, после первой отправки —
+    file_id в tg_files; одновременные запросы одной обложки склеиваются.
+    Тот же JPEG вшивается в MP3.
+    """
+
+    MAX_SIDE = 1280
+    MAX_SOURCE_BYTES = 20 * 1024 * 1024
+    TIMEOUT = 20
+
+    def __init__(self, root: Path, max_files: int):
+        self.root = root
+        self.max_files = max_files
+        self._session: aiohttp.ClientSession | None = None
+        self._inflight: dict[str, asyncio.Future] = {}
+        root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.TIMEOUT),
+                headers={"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+
+    async def _fetch(self, url: str) -> bytes:
+        async with self.session().get(url) as resp:
+            resp.raise_for_status()
+            data = bytearray()
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) > self.MAX_SOURCE_BYTES:
+                    raise ValueError("thumbnail too large")
+        return bytes(data)
+
+    async def _to_jpeg(self, data: bytes) -> bytes:
+        side = self.MAX_SIDE
+        proc = await asyncio.create_subprocess_exec(
+            transcoder.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0",
+            "-vf", f"scale='min({side},iw)':'min({side},ih)':force_original_aspect_ratio=decrease,format=yuvj420p",
+            "-frames:v", "1", "-q:v", "3", "-f", "mjpeg", "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        out, err = await proc.communicate(data)
+        if proc.returncode != 0 or not out:
+            raise RuntimeError(f"ffmpeg: {err.decode(errors='replace').strip()[-300:]}")
+        return out
+
+    def _trim(self):
+        files = sorted(self.root.glob("*.jpg"), key=lambda p: p.stat().st_mtime)
+        for path in files[: max(0, len(files) - self.max_files)]:
+            path.unlink(missing_ok=True)
+
+    async def path(self, url: str) -> Path | None:
+        """
+        JPEG обложки на диске; None — скачать или перекодировать не вышло.
+        """
+        path = self.root / f"{self.key(url)}.jpg"
+        if path.exists():
+            observe_cache("thumb", True)
+            return path
+        observe_cache("thumb", False)
+        fut = self._inflight.get(url)
+        if fut:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[url] = fut
+        result = None
+        try:
+            jpeg = await self._to_jpeg(await self._fetch(url))
+            tmp = path.with_suffix(".tmp")
+            await asyncio.to_thread(tmp.write_bytes, jpeg)
+            os.replace(tmp, path)
+            self._trim()
+            result = path
+        except Exception as e:
+            logger.warning(f"Thumbnail failed url={url}: {e}")
+        finally:
+            self._inflight.pop(url, None)
+            fut.set_result(result)
+        return result
+
+    async def send(self, chat_id: int, url: str, caption: str) -> bool:
+        key = f"thumb:{self.key(url)}"
+        known = await tg_files.get(key)
+        if known:
+            try:
+                await bot.send_photo(chat_id, known[1], caption=caption, parse_mode="Markdown")
+                observe_cache("file_id", True)
+                return True
+            except TelegramBadRequest as e:
+                logger.warning(f"Stale thumbnail file_id key={key}: {e}")
+                await tg_files.forget(key)
+        path = await self.path(url)
+        if not path:
+            return False
+        photo = BufferedInputFile(await asyncio.to_thread(path.read_bytes), filename="cover.jpg")
+        msg = await bot.send_photo(chat_id, photo, caption=caption, parse_mode="Markdown")
+        if msg.photo:
+            await tg_files.put(key, "photo", msg.photo[-1].file_id)
+        return True
+
+    def cover_for(self, info: dict | None) -> asyncio.Task | None:
+        """
+        Обложка для MP3 качается параллельно со звуком.
+        """
+        url = best_thumbnail(info) if EMBED_COVER else None
+        return asyncio.create_task(self.path(url)) if url else None
+
+    @staticmethod
+    async def wait_cover(task: asyncio.Task | None, timeout: float = 10) -> Path | None:
+        if not task:
+            return None
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+thumbnails = ThumbnailService(DATA_PATH / "thumbs", THUMB_CACHE_FILES)
+
+
+# ========================== #
+# 🎧 Перекодирование аудио
+# ========================== #
+
+class Transcoder:
+    """
+    MP3 кодирует отдельный процесс ffmpeg, одновременно не больше
+    TRANSCODE_WORKERS (по числу ядер). Перекодирование не занимает слот
+    пула скачивания и не отнимает ядра у потоков загрузки. Источник —
+    готовый файл или сразу URL потока: тогда ffmpeg кодирует, пока байты
+    ещё идут, и исходник на диск не пишется вовсе.
+    """
+
+    def __init__(self, workers: int):
+        self._slots = asyncio.Semaphore(workers)
+        self.ffmpeg = shutil.which("ffmpeg") or "ffmpeg"
+
+    async def to_mp3(
+        self,
+        source: str,
+        dest: Path,
+        *,
+        headers: dict | None = None,
+        cookies: str = "",
+        duration: float = 0,
+        size: int = 0,
+        hook: ProgressHook | None = None,
+        cover: Path | None = None,
+    ):
+        cmd = [self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-y"]
+        if headers:
+            cmd += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+        if cookies:
+            cmd += ["-cookies", cookies]
+        cmd += ["-i", source]
+        if cover:
+            # обложка — второй вход, в ID3 кладётся как есть (уже JPEG)
+            cmd += [
+                "-i", str(cover),
+                "-map", "0:a:0", "-map", "1:v:0", "-c:v", "copy",
+                "-disposition:v", "attached_pic", "-id3v2_version", "3",
+                "-metadata:s:v", "title=Album cover", "-metadata:s:v", "comment=Cover (front)",
+            ]
+        else:
+            cmd += ["-vn", "-map", "0:a:0"]
+        cmd += [
+            "-c:a", "libmp3lame", "-b:a", MP3_BITRATE,
+            "-progress", "pipe:1",
+            "-f", "mp3", str(dest),
+        ]
+        async with self._slots:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                await self._follow(proc, dest.name, duration, size, hook)
+                _, stderr = await proc.communicate()
+            except BaseException:
+                proc.kill()
+                await proc.wait()
+                raise
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg: {stderr.decode(errors='replace').strip()[-300:]}")
+
+    async def run(self, args: list[str], progress=None):
+        """
+        Произвольный вызов ffmpeg в том же лимите процессов. progress
+        получает блоки -progress (словарь ключ → значение).
+        """
+        cmd = [self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-y"]
+        if progress:
+            cmd += ["-progress", "pipe:1"]
+        cmd += args
+        async with self._slots:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE if progress else asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                if progress:
+                    block = {}
+                    async for raw in proc.stdout:
+                        key, _, value = raw.decode(errors="replace").strip().partition("=")
+                        block[key] = value
+                        if key == "progress":
+                            progress(block)
+                            block = {}
+                _, stderr = await proc.communicate()
+            except BaseException:
+                proc.kill()
+                await proc.wait()
+                raise
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg: {stderr.decode(errors='replace').strip()[-300:]}")
+
+    @staticmethod
+    async def _follow(proc, name: str, duration: float, size: int, hook: ProgressHook | None):
+        """
+        Прогресс из -progress: доля по out_time от длительности,
+        в байтах — пересчётом на размер источника.
+        """
+        started = time.monotonic()
+        out_us = 0
+        async for raw in proc.stdout:
+            key, _, value = raw.decode(errors="replace").strip().partition("=")
+            if key == "out_time_us" and value.isdigit():
+                out_us = int(value)
+            elif key == "progress" and hook and duration and size:
+                done = min(size, int(size * out_us / 1e6 / duration))
+                elapsed = time.monotonic() - started
+                speed = done / elapsed if elapsed else 0
+                hook({
+                    "status": "downloading" if value != "end" else "finished",
+                    "filename": name,
+                    "downloaded_bytes": done,
+                    "total_bytes": size,
+                    "speed": speed,
+                    "eta": (size - done) / speed if speed else None,
+                })
+
+
+transcoder = Transcoder(TRANSCODE_WORKERS)
+
+
+async def pipe_audio_to_mp3(
+    url: str,
+    opts: dict,
+    info: dict,
+    tag: str,
+    hook: ProgressHook | None,
+    cover: asyncio.Task | None = None,
+    *,
+    user_id: int | None = None,
+) -> str | None:
+    """
+    MP3 без промежуточного файла: ffmpeg читает поток по ссылке. None —
+    путь не подходит или упал, тогда качаем файл и перекодируем его.
+    Чтение потока — та же загрузка: в слоте исполнителя (user_id=None —
+    только общий лимит) и с учётом профиля cookies.
+    """
+    try:
+        stream = await executor.probe(resolve_audio_stream, url, opts, info)
+    except Exception as e:
+        logger.warning(f"Audio stream resolve failed tag={tag}: {e}")
+        return None
+    if not stream:
+        return None
+    dest = DOWNLOAD_PATH / f"{stream['id']}.{tag}.mp3"
+    try:
+        cover_path = await thumbnails.wait_cover(cover)
+        async with executor.slot(user_id):
+            async with cookie_pool.track(opts):
+                await transcoder.to_mp3(
+                    stream["url"],
+                    dest,
+                    headers=stream["headers"],
+                    cookies=stream["cookies"],
+                    duration=stream["duration"],
+                    size=stream["size"],
+                    hook=hook,
+                    cover=cover_path,
+                )
+    except DownloadCancelled:
+        dest.unlink(missing_ok=True)
+        raise
+    except Exception as e:
+        logger.warning(f"Pipelined MP3 failed tag={tag}, falling back to download: {e}")
+        dest.unlink(missing_ok=True)
+        return None
+    return str(dest)
+
+
+# ========================== #
+# 📉 Сжатие до размера
+# ========================== #
+
+SHRINK_MAX_HEIGHT = 720
+# высота кадра по битрейту видео: меньше пикселей — меньше кубиков
+SHRINK_LADDER = ((1500, 720), (800, 480), (400, 360), (0, 240))
+SHRINK_MIN_VIDEO_KBPS = 80
+
+
+class ShrinkError(Exception):
+    """Видео нельзя сжать под размер; текст показывается пользователю как есть."""
+
+
+def shrink_plan(duration: float, target: int) -> dict:
+    """
+    Битрейты под размер: бюджет target минус ~5% на контейнер и промахи
+    кодировщика делится между звуком и видео; двухпроходное кодирование
+    выдерживает средний битрейт, а значит и размер.
+    """
+    if duration <= 0:
+        # трансляции и битые файлы отдают Duration: 00:00:00.00
+        raise ShrinkError("У видео не удалось определить длительность, сжать его под размер нельзя.")
+    total_kbps = target * 8 * 0.95 / duration / 1000
+    audio_kbps = 96 if total_kbps > 640 else 64 if total_kbps > 256 else 32
+    video_kbps = int(total_kbps - audio_kbps)
+    if video_kbps < SHRINK_MIN_VIDEO_KBPS:
+        raise ShrinkError(f"Видео слишком длинное, чтобы сжать его до {target // 1024 // 1024} МБ.")
+    height = next(h for kbps, h in SHRINK_LADDER if video_kbps >= kbps)
+    return {"video_kbps": video_kbps, "audio_kbps": audio_kbps, "height": height}
+
+
+async def probe_media(path: Path) -> tuple[float, bool]:
+    """
+    Длительность и наличие звука по заголовку файла, без ffprobe:
+    ffmpeg -i печатает их в stderr.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        transcoder.ffmpeg, "-hide_banner", "-i", str(path),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, err = await proc.communicate()
+    text = err.decode(errors="replace")
+    m = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", text)
+    if not m:
+        raise ShrinkError("У видео не удалось определить длительность, сжать его под размер нельзя.")
+    return int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3)), "Audio:" in text
+
+
+class EncodeProgress:
+    """
+    Сводный прогресс кодирования кусков: секунды видео и кадры по всем
+    процессам и проходам → доля, к/с и «x реального времени» для хука.
+    """
+
+    def __init__(self, duration: float, passes: int, hook: ProgressHook | None):
+        self.duration = duration
+        self.passes = passes
+        self.hook = hook
+        self.started = time.monotonic()
+        self._seconds: dict[tuple, float] = {}
+        self._frames: dict[tuple, int] = {}
+        self._reported = 0.0
+
+    def track(self, key: tuple):
+        def update(block: dict):
+            us = block.get("out_time_us", "")
+            if us.isdigit():
+                self._seconds[key] = int(us) / 1e6
+            if block.get("frame", "").isdigit():
+                self._frames[key] = int(block["frame"])
+            self.report()
+        return update
+
+    def report(self, final: bool = False):
+        now = time.monotonic()
+        if not self.hook or (not final and now - self._reported < 0.5):
+            return
+        self._reported = now
+        elapsed = max(now - self.started, 1e-6)
+        done = min(self.duration, sum(self._seconds.values()) / self.passes)
+        realtime = done / elapsed
+        self.hook({
+            "status": "finished" if final else "encoding",
+            "encode": {
+                "done": done,
+                "total": self.duration,
+                "fps": sum(self._frames.values()) / self.passes / elapsed,
+                "realtime": realtime,
+                "eta": (self.duration - done) / realtime if realtime and not final else None,
+            },
+        })
+
+
+async def shrink_video(source: Path, dest: Path, *, target: int, hook: ProgressHook | None = None):
+    """
+    Перекодирование под размер: видео режется по ключевым кадрам без
+    перекодирования, куски кодируются в два прохода параллельно (по
+    процессу ffmpeg на кусок, в лимите TRANSCODE_WORKERS — по числу ядер),
+    звук — отдельно одним процессом, затем всё склеивается через concat
+    с -c copy. Промежуточные файлы — с меткой задачи в имени, так что после
+    падения процесса их найдёт и уберёт storage.
+    """
+    duration, has_audio = await probe_media(source)
+    plan = shrink_plan(duration, target)
+    base = dest.with_suffix("")
+    # кусков хотя бы вдвое больше, чем процессов, чтобы хвост не ждал одного
+    segment_time = max(10, min(120, duration / (TRANSCODE_WORKERS * 2)))
+    started = time.monotonic()
+    audio_task = None
+    pp_hook = hook or (lambda d: None)
+    pp_hook({"postprocessor": "Shrink", "status": "started"})
+    try:
+        await transcoder.run([
+            "-i", str(source), "-map", "0:v:0", "-c", "copy",
+            "-f", "segment", "-segment_time", f"{segment_time:.2f}", "-reset_timestamps", "1",
+            f"{base}.seg%04d.mkv",
+        ])
+        segments = sorted(dest.parent.glob(f"{glob.escape(base.name)}.seg*.mkv"))
+        if not segments:
+            raise RuntimeError("ffmpeg не разрезал видео")
+
+        audio = Path(f"{base}.audio.m4a")
+        if has_audio:
+            audio_task = asyncio.create_task(transcoder.run([
+                "-i", str(source), "-map", "0:a:0", "-vn", "-c:a", "aac", "-b:a", f"{plan['audio_kbps']}k", str(audio),
+            ]))
+
+        async def encode(i: int, seg: Path, video_opts: list[str], progress_: EncodeProgress) -> Path:
+            log = f"{base}.pass{i:04d}"
+            out = seg.with_name(f"{base.name}.enc{i:04d}.mp4")
+            await transcoder.run(
+                ["-i", str(seg), *video_opts, "-pass", "1", "-passlogfile", log, "-an", "-f", "null", os.devnull],
+                progress_.track((i, 1)),
+            )
+            await transcoder.run(
+                ["-i", str(seg), *video_opts, "-pass", "2", "-passlogfile", log, "-an", str(out)],
+                progress_.track((i, 2)),
+            )
+            return out
+
+        vf = f"scale=-2:'min({plan['height']},ih)',setsar=1,format=yuv420p"
+        # на коротких кусках x264 может промахнуться на проценты — тогда
+        # второй заход с битрейтом, уменьшенным пропорционально промаху
+        for attempt in range(2):
+            progress_ = EncodeProgress(duration, 2, hook)
+            video_opts = [
+                "-vf", vf, "-c:v", "libx264", "-preset", SHRINK_PRESET, "-b:v", f"{plan['video_kbps']}k",
+                # один поток на процесс: параллельность — за счёт кусков
+                "-threads", "1",
+            ]
+            encoded = await asyncio.gather(*(encode(i, seg, video_opts, progress_) for i, seg in enumerate(segments)))
+            if has_audio:
+                await audio_task
+            progress_.report(final=True)
+
+            listing = Path(f"{base}.list.txt")
+            listing.write_text("".join(f"file '{p.name}'\n" for p in encoded), encoding="utf-8")
+            args = ["-f", "concat", "-safe", "0", "-i", str(listing)]
+            if has_audio:
+                args += ["-i", str(audio), "-map", "0:v", "-map", "1:a"]
+            args += ["-c", "copy", "-movflags", "+faststart", str(dest)]
+            await transcoder.run(args)
+
+            size = dest.stat().st_size
+            if size <= target or attempt:
+                break
+            plan["video_kbps"] = int(plan["video_kbps"] * target / size * 0.97)
+            logger.info(f"Shrink retry {dest.name}: {size} > {target}, video {plan['video_kbps']}k")
+    finally:
+        if audio_task and not audio_task.done():
+            audio_task.cancel()
+            await asyncio.gather(audio_task, return_exceptions=True)
+        for leftover in dest.parent.glob(f"{glob.escape(base.name)}.*"):
+            if leftover != dest:
+                leftover.unlink(missing_ok=True)
+    pp_hook({"postprocessor": "Shrink", "status": "finished"})
+
+    size = dest.stat().st_size
+    log_event(
+        "shrink",
+        file=dest.name,
+        seconds=round(time.monotonic() - started, 3),
+        duration=round(duration, 3),
+        segments=len(segments),
+        target=target,
+        bytes=size,
+        **plan,
+    )
+    if size > target:
+        logger.warning(f"Shrink overshoot {dest.name}: {size} > {target}")
+
+
+# ========================== #
+# 🎥 Загрузка
+# ========================== #
+
+async def enqueue_download(
+    message: types.Message,
+    req: dict,
+    user_id: int,
+    *,
+    mode: str,
+    format_id: str | None = None,
+):
+    if mode == "pick" and not format_id:
+        await message.answer("❌ Не передан format_id.")
+        return
+
+    index = FormatIndex.load(req.get("formats") or [])
+    if mode in ("fit", "fast"):
+        entry = index.best_under(FIT_SIZE_BYTES) if mode == "fit" else index.fastest()
+        if mode == "fit" and entry is None:
+            await message.answer(f"❌ Ни один формат не помещается в {FIT_SIZE_BYTES // 1024 // 1024} МБ.")
+            return
+        format_id = index.selector(entry) if entry else None
+
+    cache_key = cache_key_for(req.get("extractor"), req.get("video_id"), media_profile(mode, format_id))
+    if DIRECT_UPLOAD and await send_known_file(message.chat.id, cache_key, req["title"], mode):
+        return
+
+    cached = await download_cache.get(cache_key)
+    if cache_key:
+        observe_cache("files", cached is not None)
+    if cached:
+        file_name, ext = cached
+        logger.info(f"Cache hit key={cache_key} file={file_name}")
+        await message.answer(
+            f"✅ {mode_emoji(mode)} *{req['title']}*\n\n[Скачать файл]({make_download_link(file_name, req['title'], ext)})",
+            parse_mode="Markdown",
+            disable_web_page_preview=True,
+        )
+        return
+
+    status = await message.answer("⏳ Подготовка к скачиванию...")
+    est_size = index.estimate(mode, format_id)
+    job = await scheduler.submit(
+        user_id=user_id,
+        chat_id=status.chat.id,
+        status_msg_id=status.message_id,
+        url=req["url"],
+        title=req["title"],
+        mode=mode,
+        format_id=format_id,
+        est_size=est_size,
+        cache_key=cache_key,
+    )
+
+
+async def send_link(job: Job, file_name: str, ext: str):
+    await edit_status(
+        job,
+        f"✅ {mode_emoji(job.mode)} *{job.title}*\n\n[Скачать файл]({make_download_link(file_name, job.title, ext)})",
+        parse_mode="Markdown",
+        disable_web_page_preview=True,
+    )
+
+
+def media_kind(ext: str) -> str:
+    if ext in AUDIO_EXTS:
+        return "audio"
+    if ext == "mp4":
+        return "video"
+    return "document"
+
+
+async def send_media(chat_id: int, kind: str, media, caption: str) -> types.Message:
+    # большие файлы грузятся долго, стандартного таймаута aiogram не хватает
+    kwargs = {"caption": caption, "request_timeout": 600}
+    if kind == "audio":
+        return await bot.send_audio(chat_id, media, **kwargs)
+    if kind == "video":
+        return await bot.send_video(chat_id, media, supports_streaming=True, **kwargs)
+    return await bot.send_document(chat_id, media, **kwargs)
+
+
+async def send_known_file(chat_id: int, key: str | None, title: str, mode: str) -> bool:
+    known = await tg_files.get(key)
+    if not known:
+        return False
+    kind, file_id = known
+    try:
+        await send_media(chat_id, kind, file_id, f"{mode_emoji(mode)} {title}")
+    except TelegramBadRequest as e:
+        # file_id может стать недействительным (другой бот/токен) — забываем
+        logger.warning(f"Stale file_id key={key}: {e}")
+        await tg_files.forget(key)
+        return False
+    observe_cache("file_id", True)
+    logger.info(f"Sent by file_id key={key}")
+    return True
+
+
+async def upload_file(job: Job, file_name: str, ext: str) -> bool:
+    """
+    Отправка файла прямо в чат. FSInputFile читает файл с диска кусками,
+    целиком в память он не загружается.
+    """
+    path = DOWNLOAD_PATH / file_name
+    try:
+        size = path.stat().st_size
+    except OSError:
+        return False
+    if size > UPLOAD_LIMIT_BYTES:
+        return False
+
+    await edit_status(job, "📤 Отправляю файл в Telegram...")
+    kind = media_kind(ext)
+    media = FSInputFile(path, filename=f"{sanitize_filename(job.title)}.{ext}")
+    try:
+        msg = await send_media(job.chat_id, kind, media, f"{mode_emoji(job.mode)} {job.title}")
+    except Exception as e:
+        logger.warning(f"Upload failed job={job.id}, fallback to link: {e}")
+        return False
+
+    # Telegram может "переклассифицировать" файл, берём то, что пришло
+    for sent_kind in ("audio", "video", "document"):
+        sent = getattr(msg, sent_kind, None)
+        if sent and job.cache_key:
+            await tg_files.put(job.cache_key, sent_kind, sent.file_id)
+            break
+    storage.touch(file_name)
+    await edit_status(job, f"✅ {mode_emoji(job.mode)} *{job.title}*", parse_mode="Markdown")
+    return True
+
+
+async def deliver(job: Job, file_name: str, ext: str):
+    if DIRECT_UPLOAD:
+        if await send_known_file(job.chat_id, job.cache_key, job.title, job.mode):
+            await edit_status(job, f"✅ {mode_emoji(job.mode)} *{job.title}*", parse_mode="Markdown")
+            return
+        if await upload_file(job, file_name, ext):
+            return
+    await send_link(job, file_name, ext)
+
+
+async def download_media(job: Job) -> int | None:
+    """
+    Выполнение задачи из очереди. Возвращает размер скачанного файла
+    (None, если файл взят из кэша или скачать не удалось).
+    """
+    if job.batch:
+        return await batches.run_item(job)
+    if job.state == "delivering" and job.output and (DOWNLOAD_PATH / job.output).exists():
+        # упали между скачиванием и выдачей: файл готов, осталось отдать
+        await deliver(job, job.output, Path(job.output).suffix[1:])
+        return None
+
+    key = job.cache_key
+    if DIRECT_UPLOAD and await send_known_file(job.chat_id, key, job.title, job.mode):
+        await edit_status(job, f"✅ {mode_emoji(job.mode)} *{job.title}*", parse_mode="Markdown")
+        return None
+
+    if key:
+        cached = await download_cache.get(key)
+        if cached:
+            await deliver(job, *cached)
+            return None
+        # две задачи одного файла разминулись при постановке (другой
+        # экземпляр, гонка) — младшая ждёт старшую, не занимая слот
+        leader = await scheduler.queue.find(key, before=job.id)
+        if leader and await scheduler.queue.follow(leader, job):
+            await edit_status(job, "⏳ Этот файл уже скачивается по другому запросу, пришлю, когда будет готов.")
+            return None
+
+    result = await _download_job(job)
+    if not result:
+        return None
+    file_name, ext, size = result
+    try:
+        if key:
+            await download_cache.put(key, file_name, ext, size)
+        await scheduler.mark(job, "delivering", output=file_name)
+        await deliver(job, file_name, ext)
+    finally:
+        storage.finish(file_name)
+    return size
+
+
+async def _download_job(job: Job) -> tuple[str, str, int] | None:
+    partial = storage.partial_bytes(job.tag) if job.state == "downloading" else 0
+    if partial:
+        # .part-файлы с той же меткой: yt-dlp докачает их (continuedl)
+        await edit_status(job, f"♻️ Продолжаю скачивание, уже есть {fmt_mb(partial)}...")
+    else:
+        await edit_status(job, "⏳ Скачиваю...")
+    await scheduler.mark(job, "downloading")
+    hook = progress.hook_for(job)
+    try:
+        return await fetch_media(
+            user_id=job.user_id,
+            url=job.url,
+            title=job.title,
+            mode=job.mode,
+            format_id=job.format_id,
+            cache_key=job.cache_key,
+            tag=job.tag,
+            hook=hook,
+        )
+    except DownloadCancelled:
+        raise
+    except FileNotFoundError:
+        await edit_status(job, "❌ Файл не найден после скачивания.")
+        return None
+    except ShrinkError as e:
+        await edit_status(job, f"❌ {e}")
+        return None
+    except Exception as e:
+        logger.exception(e)
+        await edit_status(job, f"❌ Ошибка:\n`{e}`", parse_mode="Markdown")
+        return None
+    finally:
+        await progress.unregister(job)
+
+
+async def fetch_media(
+    *,
+    user_id: int,
+    url: str,
+    title: str,
+    mode: str,
+    format_id: str | None,
+    cache_key: str | None,
+    tag: str,
+    hook: ProgressHook | None = None,
+) -> tuple[str, str, int]:
+    """
+    Скачивание в DOWNLOAD_PATH под итоговым именем. Общая часть для
+    одиночных задач и записей пакетов; сообщения пользователю — на вызывающем.
+    """
+    opts = build_base_ydl_opts(user_id, skip_download=False, quiet=False, tag=tag)
+    opts.update(media_profile(mode, format_id))
+    shrink_to = opts.pop("shrink_to", 0)
+    # MP3 кодирует transcoder, а не постпроцессор внутри слота скачивания
+    to_mp3 = mode == "audio"
+    if to_mp3:
+        opts.pop("postprocessors")
+    if hook:
+        opts["progress_hooks"] = [hook]
+        opts["postprocessor_hooks"] = [hook]
+
+    # ответ анализа годится, только если он получен под теми же cookies
+    cached_info = probe_cache.get(url, opts.get("cookiefile"))
+    site = site_of(url, cached_info)
+    protocol = guess_protocol(probe_cache.formats(url, opts.get("cookiefile")), mode, format_id)
+    if ADAPTIVE_FRAGMENTS:
+        transfer = tuner.params(site, protocol, executor.active_downloads + 1)
+        opts.update(transfer)
+        logger.info(f"Transfer tag={tag} site={site} protocol={protocol} {transfer}")
+
+    strategy_key = strategies.key(site, protocol, mode)
+    plan = strategies.plan(strategy_key)
+
+    def report_attempts(attempts: list, size: int = 0):
+        strategies.report(strategy_key, attempts, size)
+        for downloader, error, _ in attempts:
+            # ошибки попыток показывают троттлинг
+            tuner.report(site, error)
+            M_ATTEMPTS.inc(downloader=downloader, result="error" if error else "ok")
+
+    started = time.monotonic()
+    path = None
+    attempts = []
+    cover = thumbnails.cover_for(cached_info) if to_mp3 else None
+    if to_mp3 and AUDIO_PIPELINE and cached_info:
+        path = await pipe_audio_to_mp3(url, opts, cached_info, tag, hook, cover, user_id=user_id)
+
+    if not path:
+        try:
+            async with cookie_pool.track(opts):
+                info = await executor.download(user_id, run_download, url, opts, cached_info, plan)
+        except DownloadCancelled:
+            raise
+        except Exception as e:
+            attempts = getattr(e, "attempts", None)
+            if attempts:
+                report_attempts(attempts)
+            else:
+                tuner.report(site, str(e))
+            M_JOBS.inc(mode=mode, result="error")
+            log_event("download_failed", tag=tag, mode=mode, error=str(e)[:300])
+            raise
+        attempts = info.get("_attempts") or []
+
+        path = find_downloaded_file(info, tag)
+        if not path or not os.path.exists(path):
+            raise FileNotFoundError(tag)
+
+        if to_mp3 and not path.endswith(".mp3"):
+            source = Path(path)
+            path = str(source.with_suffix(".mp3"))
+            pp_hook = hook or (lambda d: None)
+            pp_hook({"postprocessor": "MP3", "status": "started"})
+            try:
+                cover_path = await thumbnails.wait_cover(cover or thumbnails.cover_for(info))
+                await transcoder.to_mp3(str(source), Path(path), cover=cover_path)
+            except Exception:
+                Path(path).unlink(missing_ok=True)
+                M_JOBS.inc(mode=mode, result="error")
+                raise
+            finally:
+                source.unlink(missing_ok=True)
+            pp_hook({"postprocessor": "MP3", "status": "finished"})
+
+        if shrink_to:
+            source = Path(path)
+            path = str(source.with_name(f"{source.stem}.small.mp4"))
+            try:
+                await shrink_video(source, Path(path), target=shrink_to, hook=hook)
+            except Exception:
+                Path(path).unlink(missing_ok=True)
+                M_JOBS.inc(mode=mode, result="error")
+                raise
+            finally:
+                source.unlink(missing_ok=True)
+    seconds = time.monotonic() - started
+
+    ext = Path(path).suffix[1:] if Path(path).suffix else "bin"
+    if cache_key:
+        file_name = f"{cache_key[:20]}.{ext}"
+    else:
+        file_name = f"{hashlib.md5(title.encode()).hexdigest()[:8]}_{int(time.time())}_{tag}.{ext}"
+    final = DOWNLOAD_PATH / file_name
+    os.replace(path, final)
+    size = final.stat().st_size
+    # до выдачи файл держит задача: ни срок, ни вытеснение его не трогают
+    storage.add_ready(file_name, size, state="downloading")
+    report_attempts(attempts, size)
+    M_DOWNLOAD_SECONDS.observe(seconds, mode=mode)
+    M_DOWNLOAD_BYTES.inc(size, mode=mode)
+    M_JOBS.inc(mode=mode, result="ok")
+    log_event(
+        "download",
+        tag=tag,
+        mode=mode,
+        site=site,
+        bytes=size,
+        seconds=round(seconds, 3),
+        downloader=attempts[-1][0] if attempts else "ffmpeg-pipe",
+        fallback=len(attempts) > 1,
+    )
+    return file_name, ext, size
+
+
+# ========================== #
+# 📦 Пакеты
+# ========================== #
+
+URL_RE = re.compile(r"https?://\S+")
+
+
+def markdown_safe(text: str) -> str:
+    return re.sub(r"[\[\]*_`]", "", text)
+
+
+def playlist_url(url: str) -> str | None:
+    """
+    Для ссылки вида watch?v=...&list=... — ссылка на сам плейлист.
+    """
+    parsed = urlparse(url)
+    list_id = parse_qs(parsed.query).get("list")
+    if not list_id or "v" not in parse_qs(parsed.query):
+        return None
+    return urlunparse(parsed._replace(path="/playlist", query=f"list={list_id[0]}"))
+
+
+def playlist_items(info: dict) -> list[dict]:
+    """
+    Записи плейлиста после extract_flat: страницы отдельных видео ещё не
+    разбирались, это делает скачивание каждой записи.
+    """
+    items = []
+    for entry in info.get("entries") or []:
+        if not entry:
+            continue
+        url = entry.get("url") or entry.get("webpage_url")
+        if not url or not url.startswith("http"):
+            continue
+        items.append({
+            "url": url,
+            "title": entry.get("title") or f"Видео {len(items) + 1}",
+            "ie_key": entry.get("ie_key"),
+            "id": entry.get("id"),
+        })
+        if len(items) >= BATCH_MAX_ITEMS:
+            break
+    return items
+
+
+async def offer_batch(status: types.Message, items: list[dict], title: str):
+    menu = Menu()
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        types.InlineKeyboardButton(text="⬇️ Видео ссылками", callback_data=menu.callback({"a": "b", "m": "safe"})),
+        types.InlineKeyboardButton(text="🎵 MP3 ссылками", callback_data=menu.callback({"a": "b", "m": "audio"})),
+    )
+    builder.row(
+        types.InlineKeyboardButton(text="🗜 Видео одним ZIP", callback_data=menu.callback({"a": "b", "m": "safe", "z": 1})),
+        types.InlineKeyboardButton(text="🗜 MP3 одним ZIP", callback_data=menu.callback({"a": "b", "m": "audio", "z": 1})),
+    )
+    msg = await status.edit_text(
+        f"📦 *{markdown_safe(title)}*\n\nВидео в пакете: {len(items)}. Как скачать?",
+        reply_markup=builder.as_markup(),
+        parse_mode="Markdown",
+    )
+    await pending.put(menu, msg.message_id, {
+        "url": items[0]["url"],
+        "title": title,
+        "batch": items,
+    })
+
+
+class ZipSink:
+    """
+    ZIP без сжатия (видео и так сжато). Архив собирается, когда готовы
+    все записи, поэтому на время сборки ему нужно место размером с пакет;
+    файлы, скачанные только для архива, удаляются сразу после добавления.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._zf = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._lock = asyncio.Lock()
+        self.count = 0
+
+    async def add(self, src: Path, arcname: str):
+        async with self._lock:
+            await asyncio.to_thread(self._zf.write, src, arcname)
+            self.count += 1
+
+    async def close(self):
+        async with self._lock:
+            await asyncio.to_thread(self._zf.close)
+
+
+@dataclass(slots=True)
+class Batch:
+    id: int
+    user_id: int
+    chat_id: int
+    status_msg_id: int
+    title: str
+    mode: str
+    zip: bool
+    total: int
+
+
+class BatchRunner:
+    """
+    Пакет из плейлиста или нескольких ссылок. Каждая запись — обычная
+    задача очереди с номером пакета: к ней применяются очередь по
+    пользователям, лимиты, журнал и роли, как к одиночным задачам.
+    Итоги записей копятся в общем состоянии (batch:<id>), прогресс —
+    в одном сообщении; последняя завершённая запись собирает результат —
+    ссылками или одним ZIP. Все записи пакета качает один воркер (аренда
+    batches:<id>:worker): результат собирается из его DOWNLOAD_PATH, а
+    готовые записи до сборки держатся на диске (storage.hold).
+    """
+
+    NAME = "batches"
+    RESULTS = "batch"
+
+    def __init__(self, state):
+        self.state = state
+        # ZIP, которые сейчас собираются: их временные файлы не трогает чистка
+        self._active: set[str] = set()
+        self._edited: dict[int, float] = {}
+
+    def active_tags(self) -> set[str]:
+        return set(self._active)
+
+    async def _load(self, batch_id: int) -> Batch | None:
+        payload = dict(await self.state.items(self.NAME)).get(str(batch_id))
+        return Batch(**json.loads(payload)) if payload else None
+
+    async def start(self, message: types.Message, user_id: int, req: dict, *, mode: str, as_zip: bool):
+        items = req["batch"]
+        status = await message.answer(f"📦 Пакет: 0 из {len(items)}")
+        batch = Batch(
+            id=await self.state.incr("batch_seq"),
+            user_id=user_id,
+            chat_id=status.chat.id,
+            status_msg_id=status.message_id,
+            title=req["title"],
+            mode=mode,
+            zip=as_zip,
+            total=len(items),
+        )
+        await self.state.push(self.NAME, str(batch.id), json.dumps(asdict(batch), ensure_ascii=False))
+        for i, item in enumerate(items):
+            key = cache_key_for(item.get("ie_key"), item.get("id"), media_profile(mode, None))
+            cached = await download_cache.get(key)
+            observe_cache("files", cached is not None)
+            if cached:
+                await self._save(batch.id, i, {"file": cached[0], "ext": cached[1], "title": item["title"], "own": False})
+                continue
+            await scheduler.submit(
+                user_id=user_id,
+                chat_id=batch.chat_id,
+                status_msg_id=batch.status_msg_id,
+                url=item["url"],
+                title=item["title"],
+                mode=mode,
+                format_id=None,
+                est_size=0,
+                # в архив: файл временный, в кэш не кладём
+                cache_key=None if as_zip else key,
+                batch=batch.id,
+                batch_index=i,
+            )
+
+    async def claim(self, batch_id: int) -> bool:
+        """
+        Берёт пакет этому воркеру или продлевает аренду; пакет упавшего
+        воркера через JOB_LEASE доделывает другой.
+        """
+        return await self.state.acquire(f"{self.NAME}:{batch_id}:worker", WORKER_ID, JOB_LEASE)
+
+    async def resume(self):
+        """
+        После перезапуска: снова держим на диске готовые записи пакетов
+        и собираем те, все записи которых готовы, а результат собрать
+        не успели.
+        """
+        for batch_id, _ in await self.state.items(self.NAME):
+            for _, payload in await self.state.items(f"{self.RESULTS}:{batch_id}"):
+                entry = json.loads(payload)
+                if entry:
+                    storage.hold(entry["file"])
+            await self._advance(int(batch_id))
+
+    async def run_item(self, job: Job) -> int | None:
+        """
+        Задача-запись пакета: скачивание без сообщений в чат, итог — в пакет.
+        """
+        size = None
+        if job.state == "delivering" and job.output and (DOWNLOAD_PATH / job.output).exists():
+            done = job.output, Path(job.output).suffix[1:]
+        else:
+            done = await download_cache.get(job.cache_key)
+            if not done:
+                result = await _download_job(job)
+                if result:
+                    file_name, ext, size = result
+                    if job.cache_key:
+                        await download_cache.put(job.cache_key, file_name, ext, size)
+                    await scheduler.mark(job, "delivering", output=file_name)
+                    done = file_name, ext
+        entry = None
+        if done:
+            entry = {"file": done[0], "ext": done[1], "title": job.title, "own": job.cache_key is None}
+        await self.record(job, entry)
+        return size
+
+    async def record(self, job: Job, entry: dict | None):
+        """
+        Итог записи пакета; None — скачать не удалось.
+        """
+        await self._save(job.batch, job.batch_index, entry)
+
+    async def _save(self, batch_id: int, index: int, entry: dict | None):
+        if not await self._load(batch_id):
+            # пакет уже собран (задачу повторили после сбоя воркера)
+            if entry and entry["own"]:
+                storage.delete(entry["file"])
+            return
+        if entry:
+            # до сборки пакета файл не должны удалить ни срок, ни вытеснение
+            storage.hold(entry["file"])
+        await self.state.push(f"{self.RESULTS}:{batch_id}", str(index), json.dumps(entry, ensure_ascii=False))
+        await self._advance(batch_id)
+
+    async def _advance(self, batch_id: int):
+        batch = await self._load(batch_id)
+        if not batch:
+            return
+        results = {int(i): json.loads(p) for i, p in await self.state.items(f"{self.RESULTS}:{batch_id}")}
+        if len(results) < batch.total:
+            await self._report(batch, results)
+            return
+        # последние записи могут завершиться одновременно на разных воркерах
+        token = f"{WORKER_ID}:{secrets.token_hex(4)}"
+        if not await self.state.acquire(f"{self.NAME}:{batch_id}", token, JOB_LEASE):
+            return
+        for i, r in results.items():
+            if r and not (DOWNLOAD_PATH / r["file"]).exists():
+                # файл пропал (ручная чистка, другой диск) — запись не удалась
+                logger.warning(f"Batch {batch_id} item {i}: {r['file']} is missing")
+                results[i] = None
+        tag = f"b{batch_id}"
+        self._active.add(tag)
+        ordered = [results[i] for i in sorted(results)]
+        try:
+            await self._report(batch, results, final=True)
+            if batch.zip:
+                await self._finish_zip(batch, ordered)
+            else:
+                await self._finish_links(batch, ordered)
+        finally:
+            self._active.discard(tag)
+            self._edited.pop(batch_id, None)
+            for r in ordered:
+                if r:
+                    storage.finish(r["file"])
+        await self.state.remove(self.NAME, str(batch_id))
+        for i in results:
+            await self.state.remove(f"{self.RESULTS}:{batch_id}", str(i))
+        await self.state.release(f"{self.NAME}:{batch_id}:worker", WORKER_ID)
+
+    async def _report(self, batch: Batch, results: dict, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self._edited.get(batch.id, 0.0) < PROGRESS_EDIT_INTERVAL:
+            return
+        self._edited[batch.id] = now
+        failed = sum(1 for r in results.values() if r is None)
+        text = f"📦 Пакет: {len(results) - failed} из {batch.total}"
+        if failed:
+            text += f", ошибок: {failed}"
+        await edit_message(batch.chat_id, batch.status_msg_id, text)
+
+    async def _finish_zip(self, batch: Batch, results: list):
+        tag = f"b{batch.id}"
+        need = sum((DOWNLOAD_PATH / r["file"]).stat().st_size for r in results if r)
+        if not storage.admit_bytes(tag, need):
+            # архиву нет места, а записи уже на диске — отдаём их ссылками
+            await edit_message(batch.chat_id, batch.status_msg_id, "⚠️ Архив не помещается на диск, отправляю ссылками.")
+            await self._finish_links(batch, results)
+            return
+        sink = ZipSink(DOWNLOAD_PATH / f"batch.{tag}.zip")
+        try:
+            for i, r in enumerate(results):
+                if not r:
+                    continue
+                await sink.add(DOWNLOAD_PATH / r["file"], f"{i + 1:02d} - {sanitize_filename(r['title'])}.{r['ext']}")
+                if r["own"]:
+                    storage.delete(r["file"])
+            await sink.close()
+        finally:
+            storage.release_reservation(tag)
+        if not sink.count:
+            sink.path.unlink(missing_ok=True)
+            await edit_message(batch.chat_id, batch.status_msg_id, "❌ Ни одно видео из пакета скачать не удалось.")
+            return
+        file_name = f"{hashlib.md5(batch.title.encode()).hexdigest()[:8]}_{batch.id}.zip"
+        final = DOWNLOAD_PATH / file_name
+        os.replace(sink.path, final)
+        storage.add_ready(file_name, final.stat().st_size)
+        await edit_message(
+            batch.chat_id,
+            batch.status_msg_id,
+            f"✅ 🗜 *{markdown_safe(batch.title)}*\nФайлов в архиве: {sink.count}\n\n"
+            f"[Скачать архив]({make_download_link(file_name, batch.title, 'zip')})",
+            parse_mode="Markdown",
+            disable_web_page_preview=True,
+        )
+
+    async def _finish_links(self, batch: Batch, results: list):
+        lines = [
+            f"{i + 1}. [{markdown_safe(r['title'])}]({make_download_link(r['file'], r['title'], r['ext'])})"
+            for i, r in enumerate(results)
+            if r
+        ]
+        if not lines:
+            await edit_message(batch.chat_id, batch.status_msg_id, "❌ Ни одно видео из пакета скачать не удалось.")
+            return
+        # лимит сообщения Telegram — 4096 символов
+        chunk: list[str] = []
+        for line in lines + [None]:
+            if line is None or sum(len(x) + 1 for x in chunk) + len(line) > 3500:
+                if chunk:
+                    await bot.send_message(
+                        batch.chat_id,
+                        f"{mode_emoji(batch.mode)}\n" + "\n".join(chunk),
+                        parse_mode="Markdown",
+                        disable_web_page_preview=True,
+                    )
+                chunk = []
+            if line is not None:
+                chunk.append(line)
+
+
+batches = BatchRunner(shared)
+
+
+# ========================== #
+# 🔗 Обработка ссылок
+# ========================== #
+
+@dp.message(F.text.regexp(r"https?://\S+"))
+async def handle_url(message: types.Message):
+    if not await allowed_users.has(message.from_user.id):
+        return
+
+    user_id = message.from_user.id
+    urls = list(dict.fromkeys(clean_youtube_url(u) for u in URL_RE.findall(message.text)))
+    if len(urls) > 1:
+        status = await message.answer("🔎 Несколько ссылок...")
+        items = [{"url": u, "title": f"{i + 1:02d} {urlparse(u).netloc}"} for i, u in enumerate(urls[:BATCH_MAX_ITEMS])]
+        await offer_batch(status, items, f"Ссылок: {len(items)}")
+        return
+
+    url = clean_youtube_url(message.text.strip())
+    status = await message.answer("🔎 Анализ ссылки...")
+
+    title = "Видео"
+    thumbnail_url = None
+    index = FormatIndex([])
+    extractor = None
+    video_id = None
+
+    try:
+        # профиль выбираем до кэша, а запрос на него записываем только при промахе
+        cookie_file = cookie_for(user_id, charge=False)
+        info = probe_cache.get(url, cookie_file)
+        observe_cache("probe", info is not None)
+        if info is None:
+            opts_info = build_base_ydl_opts(None, skip_download=True, quiet=True, cookie_file=cookie_file)
+            if profile := cookie_pool.profile_for(opts_info):
+                cookie_pool.charge(profile)
+            # НЕ задаём format тут! Плейлист разбираем "плоско": записи — потом
+            opts_info["extract_flat"] = "in_playlist"
+            started = time.monotonic()
+            try:
+                async with cookie_pool.track(opts_info):
+                    info = await executor.probe(ydl_extract, url, opts_info, download=False)
+            except Exception:
+                M_PROBE_SECONDS.observe(time.monotonic() - started, result="error")
+                raise
+            probe_seconds = time.monotonic() - started
+            M_PROBE_SECONDS.observe(probe_seconds, result="ok")
+            log_event("probe", user=user_id, url=url, seconds=round(probe_seconds, 3))
+            probe_cache.put(url, cookie_file, info)
+        else:
+            logger.info(f"Probe cache hit url={url}")
+
+        if info.get("_type") == "playlist":
+            items = playlist_items(info)
+            if items:
+                await offer_batch(status, items, info.get("title") or "Плейлист")
+                return
+
+        title = info.get("title") or title
+        thumbnail_url = best_thumbnail(info)
+        index = probe_cache.formats(url, cookie_file) or FormatIndex.from_info(info)
+        extractor = info.get("extractor_key") or info.get("extractor")
+        video_id = info.get("id")
+    except Exception as e:
+        logger.exception(e)
+
+    # Кнопки “всегда”
+    menu = Menu()
+    base_builder = InlineKeyboardBuilder()
+    base_builder.row(
+        types.InlineKeyboardButton(text="⬇️ Скачать (обычно/надёжно)", callback_data=menu.callback({"a": "d_safe"})),
+        types.InlineKeyboardButton(text="💎 Скачать в лучшем качестве", callback_data=menu.callback({"a": "d_bestq"})),
+    )
+    base_builder.row(
+        types.InlineKeyboardButton(text="🧩 Скачать (любой формат)", callback_data=menu.callback({"a": "d_any"})),
+        types.InlineKeyboardButton(text="🎵 Скачать MP3", callback_data=menu.callback({"a": "d_audio"})),
+    )
+    base_builder.row(
+        types.InlineKeyboardButton(text="🎧 Аудио без перекодирования (m4a/opus)", callback_data=menu.callback({"a": "d_acopy"})),
+    )
+    if thumbnail_url:
+        base_builder.row(types.InlineKeyboardButton(text="🖼️ Скачать обложку", callback_data=menu.callback({"a": "t"})))
+    if playlist_url(url):
+        base_builder.row(types.InlineKeyboardButton(text="📃 Весь плейлист", callback_data=menu.callback({"a": "pl"})))
+
+    fit = index.best_under(FIT_SIZE_BYTES)
+    fast = index.fastest()
+    if fit or fast:
+        row = []
+        if fit:
+            row.append(types.InlineKeyboardButton(
+                text=f"🎯 До {FIT_SIZE_BYTES // 1024 // 1024} МБ: {fit.height}p",
+                callback_data=menu.callback({"a": "d_fit"}),
+            ))
+        if fast:
+            row.append(types.InlineKeyboardButton(
+                text=f"⚡ Быстрее всего: {fast.height}p",
+                callback_data=menu.callback({"a": "d_fast"}),
+            ))
+        base_builder.row(*row)
+    top = max((e.height for e in index.videos()), default=0)
+    if top and (not fit or fit.height < min(top, SHRINK_MAX_HEIGHT)):
+        # готового формата нужного размера нет — сожмём сами
+        base_builder.row(types.InlineKeyboardButton(
+            text=f"📉 Сжать до {FIT_SIZE_BYTES // 1024 // 1024} МБ",
+            callback_data=menu.callback({"a": "d_shrink"}),
+        ))
+
+    # Выбор качества (m3u8 не режем, иначе на SABR будет пусто)
+    choices = index.choices()
+    if choices:
+        qual_builder = InlineKeyboardBuilder()
+        for entry in choices:
+            qual_builder.button(text=f"🎬 {index.label(entry)}", callback_data=menu.callback({"a": "pick", "f": entry.format_id}))
+        qual_builder.adjust(2)
+
+        for row in base_builder.export():
+            qual_builder.row(*row)
+
+        kb = qual_builder.as_markup()
+        text = f"*{title}*\n\nВыберите качество или используйте режимы скачивания:"
+    else:
+        kb = base_builder.as_markup()
+        text = f"*{title}*\n\nФорматы показать не удалось. Используйте режимы скачивания:"
+
+    msg = await status.edit_text(text, reply_markup=kb, parse_mode="Markdown")
+
+    await pending.put(menu, msg.message_id, {
+        "url": url,
+        "title": title,
+        "thumbnail_url": thumbnail_url,
+        "formats": index.dump(),
+        "extractor": extractor,
+        "video_id": video_id,
+    })
+
+
+async def offer_playlist(message: types.Message, url: str, user_id: int):
+    status = await message.answer("🔎 Анализ плейлиста...")
+    opts = build_base_ydl_opts(user_id, skip_download=True, quiet=True)
+    opts["extract_flat"] = "in_playlist"
+    opts["noplaylist"] = False
+    try:
+        async with cookie_pool.track(opts):
+            info = await executor.probe(ydl_extract, playlist_url(url) or url, opts, download=False)
+    except Exception as e:
+        logger.exception(e)
+        await status.edit_text("❌ Не удалось получить плейлист.")
+        return
+    items = playlist_items(info)
+    if not items:
+        await status.edit_text("❌ Плейлист пуст.")
+        return
+    await offer_batch(status, items, info.get("title") or "Плейлист")
+
+
+# ========================== #
+# 🎛 Кнопки
+# ========================== #
+
+@dp.callback_query(F.data.startswith(CALLBACK_PREFIX))
+async def handle_callback(query: types.CallbackQuery):
+    token, _, index = query.data[len(CALLBACK_PREFIX):].partition(":")
+    item = await pending.get(token)
+    if not item or not index.isdigit() or int(index) >= len(item.actions):
+        await query.answer("Запрос устарел.", show_alert=True)
+        return
+    await run_action(query, item.data, item.actions[int(index)])
+
+
+@dp.callback_query(F.data.startswith("{"))
+async def handle_legacy_callback(query: types.CallbackQuery):
+    """
+    Кнопки старого формата (JSON прямо в callback_data) у меню, отправленных
+    до обновления бота: их данные жили в памяти прежнего процесса.
+    """
+    await query.answer("Меню устарело после обновления бота. Отправьте ссылку ещё раз.", show_alert=True)
+
+
+async def run_action(query: types.CallbackQuery, req: dict, data: dict):
+    try:
+        user_id = query.from_user.id
+
+        title = req["title"]
+        thumb = req.get("thumbnail_url")
+
+        action = data.get("a")
+
+        try:
+            await query.message.edit_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+
+        if action == "pick":
+            await query.answer("🚀 Скачиваю выбранное качество...")
+            await enqueue_download(query.message, req, user_id, mode="pick", format_id=data.get("f"))
+
+        elif action == "d_safe":
+            await query.answer("⬇️ Скачиваю (надёжно)...")
+            await enqueue_download(query.message, req, user_id, mode="safe")
+
+        elif action == "d_bestq":
+            await query.answer("💎 Скачиваю (лучшее качество)...")
+            await enqueue_download(query.message, req, user_id, mode="bestq")
+
+        elif action == "d_fit":
+            await query.answer("🎯 Скачиваю (лучшее по размеру)...")
+            await enqueue_download(query.message, req, user_id, mode="fit")
+
+        elif action == "d_fast":
+            await query.answer("⚡ Скачиваю (быстрее всего)...")
+            await enqueue_download(query.message, req, user_id, mode="fast")
+
+        elif action == "d_shrink":
+            await query.answer("📉 Скачиваю и сжимаю...")
+            await enqueue_download(query.message, req, user_id, mode="shrink")
+
+        elif action == "d_any":
             await query.answer("🧩 Скачиваю (любой формат)...")
-            await download_media(query.message, url, user_id, title, mode="any")
+            await enqueue_download(query.message, req, user_id, mode="any")
 
         elif action == "d_audio":
             await query.answer("🎧 MP3...")
-            await download_media(query.message, url, user_id, title, mode="audio")
+            await enqueue_download(query.message, req, user_id, mode="audio")
+
+        elif action == "d_acopy":
+            await query.answer("🎧 Аудио без перекодирования...")
+            await enqueue_download(query.message, req, user_id, mode="audio_copy")
 
         elif action == "t":
             await query.answer("🖼️ Обложка...")
-            if thumb:
-                await query.message.answer_photo(photo=thumb, caption=f"Обложка:\n*{title}*", parse_mode="Markdown")
-            else:
+            caption = f"Обложка:\n*{markdown_safe(title)}*"
+            if thumb and not await thumbnails.send(query.message.chat.id, thumb, caption):
+                # не вышло скачать сами — пусть попробует Telegram
+                await query.message.answer_photo(photo=thumb, caption=caption, parse_mode="Markdown")
+            elif not thumb:
                 await query.message.answer("❌ Нет обложки.")
 
+        elif action == "b" and req.get("batch"):
+            await query.answer("📦 Скачиваю пакет...")
+            await batches.start(query.message, user_id, req, mode=data.get("m", "safe"), as_zip=bool(data.get("z")))
+
+        elif action == "pl":
+            await query.answer("📃 Плейлист...")
+            await offer_playlist(query.message, req["url"], user_id)
+
         else:
             await query.answer("Неизвестное действие", show_alert=True)
 
@@ -559,13 +4967,197 @@ async def handle_callback(query: types.CallbackQuery):
         await query.message.answer(f"⚠️ Ошибка кнопки:\n`{e}`", parse_mode="Markdown")
 
 
+# ========================== #
+# 🌐 Раздача файлов
+# ========================== #
+
+def http_prefix() -> str:
+    """
+    Путь раздачи берём из DOWNLOAD_BASE_URL, чтобы ссылки не менялись
+    при переходе с nginx на встроенный сервер.
+    """
+    return urlparse(DOWNLOAD_BASE_URL).path.rstrip("/")
+
+
+def content_disposition(display_name: str) -> str:
+    fallback = display_name.encode("ascii", "ignore").decode().replace('"', "") or "download"
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(display_name)}"
+
+
+async def serve_file(request: web.Request) -> web.StreamResponse:
+    """
+    Отдача файла из DOWNLOAD_PATH. FileResponse сам умеет Range/докачку
+    и sendfile без копирования в user space.
+    """
+    name = request.match_info["name"]
+    if "/" in name or name.startswith(".") or name.endswith((".part", ".ytdl", ".temp")):
+        raise web.HTTPNotFound()
+
+    if LINK_SECRET:
+        try:
+            expires = int(request.query.get("e", "0"))
+        except ValueError:
+            raise web.HTTPForbidden()
+        signature = request.query.get("s", "")
+        if expires < time.time() or not hmac.compare_digest(signature, sign_link(name, expires)):
+            raise web.HTTPForbidden(text="Ссылка устарела.")
+
+    path = DOWNLOAD_PATH / name
+    if not path.is_file():
+        raise web.HTTPNotFound()
+
+    await download_cache.touch_file(name)
+    storage.touch(name)
+    display_name = sanitize_filename(request.query.get("filename") or name) or name
+    return web.FileResponse(path, headers={"Content-Disposition": content_disposition(display_name)})
+
+
+def build_http_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get(f"{http_prefix()}/{{name}}", serve_file)
+    return app
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def metrics_json_handler(request: web.Request) -> web.Response:
+    return web.json_response(metrics.snapshot())
+
+
+def build_metrics_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/metrics.json", metrics_json_handler)
+    return app
+
+
+def webhook_path() -> str:
+    return urlparse(WEBHOOK_URL).path or "/webhook"
+
+
+def mount_webhook(app: web.Application):
+    """
+    Обновления от Telegram принимаются на том же HTTP-сервере, что и файлы.
+    Секрет в заголовке отсекает запросы не от Telegram.
+    """
+    SimpleRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET).register(app, path=webhook_path())
+
+
+async def start_http_server(app: web.Application, host: str = HTTP_HOST, port: int = HTTP_PORT) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"HTTP сервер: http://{host}:{port}")
+    return runner
+
+
 # ========================== #
 # 🚀 Запуск
 # ========================== #
 
+async def warm_ydl_pool():
+    """
+    По экземпляру YoutubeDL на профиль (без cookies, аккаунты пула и каждый,
+    кто загрузил свои), чтобы первый запрос после старта не платил за инициализацию.
+    """
+    profiles = [None] + [p.path for p in cookie_pool.profiles.values()]
+    profiles += [get_cookie_file(uid) for uid in await allowed_users.members() if get_cookie_file(uid)]
+    for cookie_file in profiles:
+        opts = build_base_ydl_opts(None, skip_download=True, quiet=True, cookie_file=cookie_file)
+        try:
+            await executor.probe(warm_profile, opts)
+        except Exception as e:
+            logger.warning(f"YoutubeDL warm-up failed cookies={cookie_file}: {e}")
+
+
+async def wait_for_shutdown():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
 async def main():
-    logger.info("Бот запущен.")
-    await dp.start_polling(bot)
+    # bot — принимает обновления, worker — качает, all — и то и другое
+    receive = ROLE in ("bot", "all")
+    scheduler.consume = ROLE in ("worker", "all")
+    logger.info(f"Бот запущен. role={ROLE} worker={WORKER_ID} workers={DOWNLOAD_WORKERS} executor={EXECUTOR_KIND}")
+    if scheduler.consume:
+        await job_queue.claim_worker()
+        restored = await scheduler.restore()
+        for job in restored:
+            partial = storage.partial_bytes(job.tag)
+            text = "♻️ Бот перезапущен, задача снова в очереди."
+            if partial:
+                text += f"\nУже скачано {fmt_mb(partial)}, продолжим с этого места."
+            await edit_status(job, text)
+        if restored:
+            logger.info(f"Restored {len(restored)} queued jobs")
+        await batches.resume()
+
+    try:
+        await cookie_pool.sync()
+    except Exception as e:
+        logger.warning(f"Cookie pool sync failed: {e}")
+    cookie_task = asyncio.create_task(cookie_pool.run())
+    probe_cache.purge_disk()
+    storage.scan()
+    storage.sweep(await scheduler.active_tags())
+
+    async def active_tags():
+        return await scheduler.active_tags() | batches.active_tags()
+
+    storage_task = asyncio.create_task(storage.run(active_tags))
+    scheduler_task = asyncio.create_task(scheduler.run()) if scheduler.consume else None
+    progress_task = asyncio.create_task(progress.run())
+
+    http_app = build_http_app() if HTTP_SERVER else None
+    if receive and WEBHOOK_URL:
+        http_app = http_app or web.Application()
+        mount_webhook(http_app)
+    http_runner = await start_http_server(http_app) if http_app else None
+    metrics_runner = (
+        await start_http_server(build_metrics_app(), METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    )
+    metrics_task = asyncio.create_task(metrics_log_loop()) if METRICS_JSON_LOG else None
+    warm_task = asyncio.create_task(warm_ydl_pool()) if YDL_POOL else None
+    try:
+        if receive and not WEBHOOK_URL:
+            await dp.start_polling(bot)
+        else:
+            if receive:
+                await bot.set_webhook(
+                    WEBHOOK_URL,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=dp.resolve_used_update_types(),
+                )
+                logger.info(f"Webhook: {WEBHOOK_URL}")
+            await wait_for_shutdown()
+    finally:
+        if scheduler_task:
+            scheduler_task.cancel()
+            await scheduler.stop()
+            with contextlib.suppress(Exception):
+                await job_queue.drop_worker()
+        progress_task.cancel()
+        storage_task.cancel()
+        cookie_task.cancel()
+        if metrics_task:
+            metrics_task.cancel()
+        if warm_task:
+            warm_task.cancel()
+        if http_runner:
+            await http_runner.cleanup()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await thumbnails.close()
+        if not receive or WEBHOOK_URL:
+            # start_polling закрывает сессию сам, в остальных режимах — мы
+            await bot.session.close()
+        executor.shutdown()
 
 
 if __name__ == "__main__":